@@ -6,19 +6,54 @@ Telegram Bot с интеграцией Cerebras LLM
 
 import os
 import logging
+import logging.handlers
 import asyncio
-from typing import Optional
-from dataclasses import dataclass, field
+import atexit
+import argparse
+import cProfile
+import csv
+import gc
+import io
+import pstats
+import queue
+import json
+import signal
+import socket
+import sqlite3
+import random
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import zlib
+import multiprocessing
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import suppress
+from contextvars import ContextVar, copy_context
+from typing import Any, Awaitable, Callable, Optional
+from dataclasses import dataclass, field, asdict, replace
+from functools import lru_cache
+from string import Template
 from enum import Enum
 import re
 import html
 
-from aiogram import Bot, Dispatcher, Router, F
-from aiogram.filters import Command, StateFilter
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
+    Update,
+    BufferedInputFile,
+    InlineQuery,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
     Message, 
     CallbackQuery,
     InlineKeyboardMarkup, 
@@ -28,20 +63,188 @@ from aiogram.types import (
     ReplyKeyboardRemove
 )
 from aiogram.enums import ParseMode
-from cerebras.cloud.sdk import Cerebras
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError
+import httpx
+from cerebras.cloud.sdk import AsyncCerebras
 
 # ============== КОНФИГУРАЦИЯ ==============
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 CEREBRAS_API_KEY = os.environ.get("CEREBRAS_API_KEY")
-CEREBRAS_MODEL = "gpt-oss-120b"  # Или другая доступная модель
+CEREBRAS_MODEL = os.environ.get("CEREBRAS_MODEL", "gpt-oss-120b")  # Или другая доступная модель
+# Дополнительные LLM-бэкенды (JSON-список), см. load_backends
+LLM_BACKENDS = os.environ.get("LLM_BACKENDS", "")
+# Параллельных запросов на бэкенд по умолчанию; сверх лимита запросы уходят на другие бэкенды
+LLM_BACKEND_CONCURRENCY = int(os.environ.get("LLM_BACKEND_CONCURRENCY", "4"))
+LLM_REQUEST_TIMEOUT = float(os.environ.get("LLM_REQUEST_TIMEOUT", "120"))
+# Как часто сбрасывать накопленный учёт токенов в DATA_DIR/usage.db, секунды
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", "60"))
+# Формат ответа модели: markdown (свободный текст) или json (отчёт по схеме + шаблоны)
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "markdown")
+
+# Локальное хранилище (журнал генераций и т.п.)
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+# Сколько секунд SQLite ждёт чужую блокировку записи и сколько раз повторяем запрос после этого
+SQLITE_BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", "1"))
+SQLITE_LOCK_RETRIES = int(os.environ.get("SQLITE_LOCK_RETRIES", "5"))
+# Сколько секунд при остановке ждём завершения текущих генераций
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "25"))
+# Очередь генераций: сколько раз выдаём задачу воркерам, прежде чем сдаться
+MAX_JOB_ATTEMPTS = int(os.environ.get("MAX_JOB_ATTEMPTS", "3"))
+# Аренда задачи воркером; по истечении задача выдаётся другому воркеру
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "180"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+DELIVERY_POLL_INTERVAL = float(os.environ.get("DELIVERY_POLL_INTERVAL", "1"))
+# Как часто воркер проверяет, не отменены ли его текущие задачи
+CANCEL_POLL_INTERVAL = float(os.environ.get("CANCEL_POLL_INTERVAL", "1"))
+# LLM-воркеры внутри процесса бота (0 — только отдельные `python bot.py worker`)
+LLM_WORKERS = int(os.environ.get("LLM_WORKERS", "2"))
+
+# История отчётов: квоты на пользователя (сжатые байты) и срок хранения
+HISTORY_MAX_REPORTS = int(os.environ.get("HISTORY_MAX_REPORTS", "300"))
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", str(5 * 1024 * 1024)))
+HISTORY_MAX_AGE_DAYS = float(os.environ.get("HISTORY_MAX_AGE_DAYS", "180"))
+HISTORY_PAGE_SIZE = 5
+
+# Общий кэш отчётов (0 — выключен) и порог похожести свободного ввода (Жаккар по 3-граммам)
+REPORT_CACHE_TTL_HOURS = float(os.environ.get("REPORT_CACHE_TTL_HOURS", "24"))
+SIMILARITY_THRESHOLD = float(os.environ.get("SIMILARITY_THRESHOLD", "0.75"))
+# «Сгенерировать ещё» в течение стольких секунд после похожего попадания считается ложным попаданием
+SIMILAR_REJECT_WINDOW = 600
+
+# Спекулятивная генерация: запускать LLM сразу после выбора рынка, не дожидаясь подтверждения
+SPECULATIVE_GENERATION = os.environ.get("SPECULATIVE_GENERATION", "0") == "1"
+SPECULATIVE_MAX_CONCURRENT = int(os.environ.get("SPECULATIVE_MAX_CONCURRENT", "4"))
+# Неподтверждённая спекуляция отбрасывается через столько секунд
+SPECULATIVE_TTL = float(os.environ.get("SPECULATIVE_TTL", "600"))
+
+# Лимиты запросов: «N/секунд» — не больше N за столько секунд (с запасом в N подряд), пусто или 0 — без лимита
+RATE_LIMIT_GENERATION = os.environ.get("RATE_LIMIT_GENERATION", "6/600")  # генерации одного пользователя
+RATE_LIMIT_NAVIGATION = os.environ.get("RATE_LIMIT_NAVIGATION", "60/60")  # остальные кнопки и сообщения
+RATE_LIMIT_GLOBAL_GENERATION = os.environ.get("RATE_LIMIT_GLOBAL_GENERATION", "120/60")  # генерации всех пользователей
+RATE_LIMIT_SPECULATION = os.environ.get("RATE_LIMIT_SPECULATION", "6/600")  # спекулятивные генерации одного пользователя
+# Сколько счётчиков держать в памяти (самые давние вытесняются)
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "10000"))
+# 1 — счётчики в DATA_DIR/ratelimit.db, общие для нескольких экземпляров бота
+RATE_LIMIT_SHARED = os.environ.get("RATE_LIMIT_SHARED", "0") == "1"
+
+# Сколько последних update_id / callback query id помнить для отсева повторных доставок
+UPDATE_DEDUP_SIZE = int(os.environ.get("UPDATE_DEDUP_SIZE", "10000"))
+
+# Постобработка ответов длиннее POSTPROCESS_INLINE_LIMIT символов — в пуле из стольких процессов (0 — всегда в event loop)
+POSTPROCESS_WORKERS = int(os.environ.get("POSTPROCESS_WORKERS", "2"))
+POSTPROCESS_INLINE_LIMIT = int(os.environ.get("POSTPROCESS_INLINE_LIMIT", "6000"))
+# Сторож event loop: интервал замеров и задержка, после которой логируется стек блокирующего кода (секунды)
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.25"))
+LOOP_LAG_THRESHOLD = float(os.environ.get("LOOP_LAG_THRESHOLD", "0.5"))
+
+# Инлайн-режим (@bot запрос): результатов на страницу
+INLINE_PAGE_SIZE = int(os.environ.get("INLINE_PAGE_SIZE", "10"))
+
+# Профилирование по командам администратора: предел длительности и частота сэмплов (секунды)
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "120"))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.01"))
+
+# Администраторы бота (user id через запятую); нечисловые значения пропускаются с предупреждением в логе
+ADMIN_IDS_RAW = os.environ.get("ADMIN_IDS", "").replace(",", " ").split()
+ADMIN_IDS = {int(x) for x in ADMIN_IDS_RAW if x.isdigit()}
 
 # Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json / text
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Доля генераций, для которых пишутся отладочные строки горячего пути (целиком, по correlation id)
+LOG_DEBUG_SAMPLE_RATE = 1.0 if LOG_LEVEL == "DEBUG" else float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+
+# Связывает строки лога одной генерации: апдейт → вызов LLM → постобработка → отправка частей
+correlation_id: ContextVar[str] = ContextVar("correlation_id", default="-")
+
+
+class CorrelationFilter(logging.Filter):
+    """Добавляет correlation_id текущего контекста в запись"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из extra= попадают в JSON как есть"""
+
+    STANDARD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "correlation_id"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "correlation_id": getattr(record, "correlation_id", "-"),
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# Поток вывода логов (background=True); при перенастройке прежний останавливается
+log_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging(background: bool = True):
+    """
+    Логирование в stdout.
+
+    background: запись форматируется в вызывающем потоке (там известен correlation_id),
+    а пишет её фоновый поток QueueListener — event loop не ждёт stdout/диск. Поток
+    запускается только после fork пула постобработки (см. start_postprocess_pool):
+    при импорте логи пишутся напрямую.
+    """
+    global log_listener
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s")
+    stream = logging.StreamHandler()
+    listener = None
+    if background:
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, stream)
+        listener.start()
+        atexit.register(listener.stop)
+        handler = logging.handlers.QueueHandler(records)
+        stream.setFormatter(logging.Formatter("%(message)s"))
+    else:
+        handler = stream
+    handler.setFormatter(formatter)
+    handler.addFilter(CorrelationFilter())
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    if log_listener is not None:
+        # Дописать то, что уже в очереди прежнего потока
+        log_listener.stop()
+        atexit.unregister(log_listener.stop)
+    log_listener = listener
+
+setup_logging(background=False)
 logger = logging.getLogger(__name__)
+# Отладочные строки горячего пути — только через log_sampled
+trace_logger = logging.getLogger(f"{__name__}.trace")
+trace_logger.setLevel(logging.DEBUG)
+
+if len(ADMIN_IDS) < len(ADMIN_IDS_RAW):
+    logger.warning("ADMIN_IDS: skipped invalid user ids %s", [x for x in ADMIN_IDS_RAW if not x.isdigit()])
+
+def log_sampled(msg: str, *args, **kwargs):
+    """DEBUG-строка для доли LOG_DEBUG_SAMPLE_RATE генераций; генерация попадает в выборку целиком"""
+    if LOG_DEBUG_SAMPLE_RATE <= 0:
+        return
+    if zlib.crc32(correlation_id.get().encode("utf-8")) % 10000 < LOG_DEBUG_SAMPLE_RATE * 10000:
+        trace_logger.debug(msg, *args, **kwargs)
 
 # ============== СИСТЕМНЫЙ ПРОМПТ ==============
 
@@ -96,6 +299,50 @@ SYSTEM_PROMPT = """Ты — профессиональный продукт-ме
 • Срок разработки: 6 месяцев
 """
 
+JSON_SYSTEM_PROMPT = """Ты — профессиональный продукт-менеджер и генератор идей цифровых продуктов.
+Твоя задача: по данным пользователя (ниша, бюджет, рынок/география) формировать структурированный отчёт.
+
+Верни ТОЛЬКО JSON-объект без Markdown и пояснений, строго по схеме:
+{
+  "analysis": "2–3 предложения о текущем состоянии рынка и трендах",
+  "ideas": [
+    {
+      "title": "Название — суть в нескольких словах",
+      "value": "Краткое описание ценности (1-2 предложения)",
+      "audience": "Целевая аудитория",
+      "features": ["минимум 5-6 конкретных фич"]
+    }
+  ],
+  "timeline": {"mvp": "X-Y месяцев", "full": "X-Y месяцев"},
+  "cost": {"mvp": "$X,XXX - $XX,XXX", "full": "$XX,XXX - $XXX,XXX"},
+  "monetization": ["минимум 3 конкретных варианта с примерами цен"],
+  "risks": ["3-4 риска и рекомендации"]
+}
+
+Требования к содержанию:
+- Конкретика, никаких общих фраз типа "зависит от многих факторов"
+- Реалистичные оценки на основе рыночных данных
+- Пиши на русском языке, без разметки внутри строк
+- Адаптируй сложность под указанный бюджет
+- Если бюджет маленький — предлагай более простые решения
+- Если бюджет большой — предлагай более амбициозные идеи
+"""
+
+SECTION_SYSTEM_PROMPT = """Ты — профессиональный продукт-менеджер и генератор идей цифровых продуктов.
+Тебе дают краткое содержание готового отчёта и просят заменить в нём ОДНУ секцию. Весь отчёт не пиши.
+
+Верни ТОЛЬКО JSON-объект запрошенной секции без Markdown и пояснений.
+Идея:
+{"title": "Название — суть в нескольких словах", "value": "Ценность (1-2 предложения)", "audience": "Целевая аудитория", "features": ["минимум 5-6 конкретных фич"]}
+Монетизация:
+{"monetization": ["минимум 3 конкретных варианта с примерами цен"]}
+
+Требования к содержанию:
+- Новая секция не повторяет текущую и согласуется с остальным отчётом
+- Конкретика, реалистичные оценки с учётом бюджета и рынка
+- Пиши на русском языке, без разметки внутри строк
+"""
+
 # ============== ДАННЫЕ И КОНСТАНТЫ ==============
 
 NICHES = [
@@ -128,6 +375,15 @@ MARKETS = [
     ("✍️ Указать свой", "custom"),
 ]
 
+DELIVERY_MODES = [
+    ("📨 Несколькими сообщениями", "messages"),
+    ("🗜 Одним сообщением", "compact"),
+    ("📄 HTML-файлом", "document"),
+]
+
+# Начало текста, которым LLMClient сообщает об ошибке вместо отчёта
+LLM_ERROR_PREFIX = "❌ Произошла ошибка при генерации"
+
 # Примеры идей для демонстрации
 EXAMPLE_IDEAS = """
 🎯 <b>Пример генерации: Ниша "Фитнес", бюджет $15-50K, рынок Россия</b>
@@ -195,6 +451,7 @@ class UserSession:
     market_display: Optional[str] = None
     ideas_count: int = 4
     report_format: str = "detailed"  # detailed / short
+    delivery: str = "messages"  # messages / compact / document
 
 # ============== КЛАВИАТУРЫ ==============
 
@@ -203,6 +460,7 @@ def get_main_menu_keyboard() -> InlineKeyboardMarkup:
     buttons = [
         [InlineKeyboardButton(text="🎯 Сгенерировать идеи", callback_data="generate")],
         [InlineKeyboardButton(text="🧩 Примеры идей", callback_data="examples")],
+        [InlineKeyboardButton(text="📚 История отчётов", callback_data="history")],
         [InlineKeyboardButton(text="🛠 Настройки", callback_data="settings")],
         [InlineKeyboardButton(text="ℹ️ О боте", callback_data="about")],
     ]
@@ -253,9 +511,18 @@ def get_confirm_keyboard() -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def get_after_generation_keyboard() -> InlineKeyboardMarkup:
-    """Клавиатура после генерации"""
-    buttons = [
+def get_after_generation_keyboard(report_seq: Optional[int] = None, ideas_count: int = 0) -> InlineKeyboardMarkup:
+    """Клавиатура после генерации (для JSON-отчёта — с частичной перегенерацией)"""
+    buttons = []
+    if report_seq is not None and ideas_count:
+        buttons.append([
+            InlineKeyboardButton(text=f"🔁 Идея {n}", callback_data=f"partial_{report_seq}_idea_{n}")
+            for n in range(1, ideas_count + 1)
+        ])
+        buttons.append([
+            InlineKeyboardButton(text="💸 Другой план монетизации", callback_data=f"partial_{report_seq}_monetization")
+        ])
+    buttons += [
         [InlineKeyboardButton(text="🔄 Сгенерировать ещё", callback_data="regenerate")],
         [InlineKeyboardButton(text="🎯 Новый запрос", callback_data="generate")],
         [InlineKeyboardButton(text="🏠 В главное меню", callback_data="main_menu")],
@@ -265,6 +532,7 @@ def get_after_generation_keyboard() -> InlineKeyboardMarkup:
 def get_settings_keyboard(session: UserSession) -> InlineKeyboardMarkup:
     """Меню настроек"""
     format_text = "📝 Подробный" if session.report_format == "detailed" else "📋 Краткий"
+    delivery_text = next((display for display, code in DELIVERY_MODES if code == session.delivery), DELIVERY_MODES[0][0])
     buttons = [
         [InlineKeyboardButton(
             text=f"🔢 Количество идей: {session.ideas_count}", 
@@ -274,10 +542,20 @@ def get_settings_keyboard(session: UserSession) -> InlineKeyboardMarkup:
             text=f"📄 Формат отчёта: {format_text}", 
             callback_data="settings_format"
         )],
+        [InlineKeyboardButton(
+            text=f"📬 Доставка: {delivery_text}",
+            callback_data="settings_delivery"
+        )],
         [InlineKeyboardButton(text="🏠 В главное меню", callback_data="main_menu")],
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+def get_delivery_keyboard() -> InlineKeyboardMarkup:
+    """Выбор способа доставки отчёта"""
+    buttons = [[InlineKeyboardButton(text=display, callback_data=f"delivery_{code}")] for display, code in DELIVERY_MODES]
+    buttons.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="settings")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 def get_ideas_count_keyboard() -> InlineKeyboardMarkup:
     """Выбор количества идей"""
     buttons = [
@@ -299,22 +577,266 @@ def get_format_keyboard() -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+def get_generation_status_keyboard() -> InlineKeyboardMarkup:
+    """Кнопка отмены под статусом «Генерирую...»"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_generation")]
+    ])
+
+def get_history_keyboard(reports: list["ReportSummary"], has_newer: bool, has_older: bool) -> InlineKeyboardMarkup:
+    """Страница истории отчётов"""
+    buttons = [
+        [InlineKeyboardButton(
+            text=f"#{r.seq} · {time.strftime('%d.%m', time.localtime(r.created_at))} · {r.niche_display}"[:60],
+            callback_data=f"history_show_{r.seq}"
+        )]
+        for r in reports
+    ]
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"history_after_{reports[0].seq}"))
+    if has_older:
+        nav.append(InlineKeyboardButton(text="Старше ➡️", callback_data=f"history_before_{reports[-1].seq}"))
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton(text="🏠 В главное меню", callback_data="main_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def get_history_report_keyboard() -> InlineKeyboardMarkup:
+    """Клавиатура под отчётом из истории"""
+    buttons = [
+        [InlineKeyboardButton(text="📚 К истории", callback_data="history")],
+        [InlineKeyboardButton(text="🏠 В главное меню", callback_data="main_menu")],
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 def get_cancel_keyboard() -> InlineKeyboardMarkup:
     """Кнопка отмены для текстового ввода"""
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")]
     ])
 
-# ============== CEREBRAS LLM ==============
+# ============== LLM-БЭКЕНДЫ ==============
+
+@dataclass
+class Completion:
+    """Ответ модели и его стоимость"""
+    text: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    backend: str = ""
+    latency: float = 0.0
+
+
+class LLMBackend(ABC):
+    """
+    Провайдер/модель, к которому можно отправить запрос.
+
+    Все вызовы асинхронные: отмена задачи обрывает HTTP-запрос к модели.
+    Повторы запросов — дело LLMRouter, сам бэкенд их не делает.
+    """
+
+    def __init__(self, name: str, model: str, max_concurrency: int):
+        self.name = name
+        self.model = model
+        self.max_concurrency = max_concurrency
+
+    @abstractmethod
+    async def complete(self, messages: list[dict], max_tokens: int, json_mode: bool) -> Completion:
+        """Один запрос к модели; исключение — при любой ошибке"""
+
+
+class CerebrasBackend(LLMBackend):
+    """Cerebras Cloud через официальный SDK"""
+
+    def __init__(self, name: str, model: str, api_key: str, max_concurrency: int):
+        super().__init__(name, model, max_concurrency)
+        # Без повторов внутри SDK: при ошибке роутер сразу переходит к следующему бэкенду
+        self.client = AsyncCerebras(api_key=api_key, timeout=LLM_REQUEST_TIMEOUT, max_retries=0)
+
+    async def complete(self, messages: list[dict], max_tokens: int, json_mode: bool) -> Completion:
+        extra_params = {}
+        if json_mode:
+            extra_params["response_format"] = {"type": "json_object"}
+        response = await self.client.chat.completions.create(
+            messages=messages,
+            model=self.model,
+            max_tokens=max_tokens,
+            temperature=0.7,
+            **extra_params,
+        )
+        usage = response.usage
+        return Completion(
+            response.choices[0].message.content,
+            prompt_tokens=(usage.prompt_tokens or 0) if usage else 0,
+            completion_tokens=(usage.completion_tokens or 0) if usage else 0,
+        )
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """Любой HTTP-эндпоинт с OpenAI-совместимым /chat/completions (OpenAI, vLLM, Ollama, OpenRouter...)"""
+
+    def __init__(self, name: str, model: str, base_url: str, api_key: Optional[str], max_concurrency: int):
+        super().__init__(name, model, max_concurrency)
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.client = httpx.AsyncClient(base_url=base_url.rstrip("/"), headers=headers, timeout=LLM_REQUEST_TIMEOUT)
+
+    async def complete(self, messages: list[dict], max_tokens: int, json_mode: bool) -> Completion:
+        body = {"model": self.model, "messages": messages, "max_tokens": max_tokens, "temperature": 0.7}
+        if json_mode:
+            body["response_format"] = {"type": "json_object"}
+        response = await self.client.post("/chat/completions", json=body)
+        response.raise_for_status()
+        data = response.json()
+        usage = data.get("usage") or {}
+        return Completion(
+            data["choices"][0]["message"]["content"],
+            prompt_tokens=usage.get("prompt_tokens") or 0,
+            completion_tokens=usage.get("completion_tokens") or 0,
+        )
+
+
+def load_backends() -> list[LLMBackend]:
+    """
+    Бэкенды из конфигурации.
+
+    CEREBRAS_API_KEY даёт бэкенд "cerebras" с моделью CEREBRAS_MODEL. LLM_BACKENDS добавляет
+    остальные: [{"name": "local", "type": "openai", "base_url": "http://localhost:8000/v1",
+    "model": "...", "api_key_env": "LOCAL_KEY", "max_concurrency": 8}, ...].
+    """
+    backends: list[LLMBackend] = []
+    if CEREBRAS_API_KEY:
+        backends.append(CerebrasBackend("cerebras", CEREBRAS_MODEL, CEREBRAS_API_KEY, LLM_BACKEND_CONCURRENCY))
+    if not LLM_BACKENDS:
+        return backends
+
+    try:
+        configs = json.loads(LLM_BACKENDS)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"LLM_BACKENDS: некорректный JSON ({e})")
+    for config in configs:
+        name = config.get("name") or config.get("model")
+        backend_type = config.get("type", "openai")
+        api_key = config.get("api_key") or os.environ.get(config.get("api_key_env", ""))
+        max_concurrency = int(config.get("max_concurrency", LLM_BACKEND_CONCURRENCY))
+        if not config.get("model"):
+            raise ValueError(f"LLM_BACKENDS: у бэкенда {name!r} не указана model")
+        if backend_type == "cerebras":
+            backends.append(CerebrasBackend(name, config["model"], api_key, max_concurrency))
+        elif backend_type == "openai":
+            if not config.get("base_url"):
+                raise ValueError(f"LLM_BACKENDS: у бэкенда {name!r} не указан base_url")
+            backends.append(OpenAICompatibleBackend(name, config["model"], config["base_url"], api_key, max_concurrency))
+        else:
+            raise ValueError(f"LLM_BACKENDS: неизвестный type {backend_type!r}")
+    return backends
+
+
+@dataclass
+class BackendStats:
+    """Скользящие (EWMA) задержка и доля ошибок бэкенда + текущая нагрузка"""
+    latency: Optional[float] = None  # секунды; None — ещё не было успешных ответов
+    error_rate: float = 0.0
+    error_rate_at: float = 0.0  # monotonic-время, к которому относится error_rate
+    in_flight: int = 0
+    calls: int = 0
+    errors: int = 0
+
+
+class LLMRouter:
+    """
+    Выбор бэкенда для каждого запроса.
+
+    Кандидаты — бэкенды со свободными слотами (in_flight < max_concurrency), лучший —
+    с наименьшей задержкой с поправкой на долю ошибок; ещё не опробованные идут первыми.
+    При ошибке запрос переходит к следующему кандидату, при занятости всех — ждёт слот.
+    """
+
+    EWMA_ALPHA = 0.2
+    # Доля ошибок затухает вдвое за столько секунд — отказавший бэкенд со временем снова пробуется
+    ERROR_HALF_LIFE = 60.0
+
+    def __init__(self, backends: list[LLMBackend]):
+        self.backends = backends
+        self.stats = {backend.name: BackendStats() for backend in backends}
+        self.slot_freed = asyncio.Condition()
+
+    def error_rate(self, backend: LLMBackend) -> float:
+        """Доля ошибок, затухшая с момента последнего вызова"""
+        stats = self.stats[backend.name]
+        return stats.error_rate * 0.5 ** ((time.monotonic() - stats.error_rate_at) / self.ERROR_HALF_LIFE)
+
+    def _score(self, backend: LLMBackend) -> float:
+        stats = self.stats[backend.name]
+        if stats.calls == 0:
+            return 0.0
+        # Бэкенд без единого успешного ответа считаем медленным, как таймаут
+        latency = stats.latency if stats.latency is not None else LLM_REQUEST_TIMEOUT
+        return latency / max(1.0 - self.error_rate(backend), 0.05)
+
+    def candidates(self, exclude: set[str]) -> list[LLMBackend]:
+        """Бэкенды со свободными слотами, лучшие первыми"""
+        free = [
+            backend for backend in self.backends
+            if backend.name not in exclude and self.stats[backend.name].in_flight < backend.max_concurrency
+        ]
+        return sorted(free, key=self._score)
+
+    def _record(self, backend: LLMBackend, latency: Optional[float]):
+        stats = self.stats[backend.name]
+        stats.calls += 1
+        failed = latency is None
+        error_rate = self.error_rate(backend)
+        stats.error_rate = error_rate + self.EWMA_ALPHA * (failed - error_rate)
+        stats.error_rate_at = time.monotonic()
+        if failed:
+            stats.errors += 1
+        else:
+            stats.latency = latency if stats.latency is None else stats.latency + self.EWMA_ALPHA * (latency - stats.latency)
+
+    async def complete(self, messages: list[dict], max_tokens: int, json_mode: bool) -> Completion:
+        """Запрос к лучшему доступному бэкенду; исключение — если отказали все"""
+        if not self.backends:
+            raise RuntimeError("Не настроен ни один LLM-бэкенд")
+
+        tried: set[str] = set()
+        last_error: Optional[Exception] = None
+        while len(tried) < len(self.backends):
+            async with self.slot_freed:
+                await self.slot_freed.wait_for(lambda: self.candidates(tried))
+                backend = self.candidates(tried)[0]
+                self.stats[backend.name].in_flight += 1
+
+            started = time.monotonic()
+            try:
+                result = await backend.complete(messages, max_tokens, json_mode)
+            except Exception as e:
+                logger.warning("LLM backend %s failed: %s", backend.name, e)
+                self._record(backend, None)
+                tried.add(backend.name)
+                last_error = e
+            else:
+                result.backend = backend.name
+                result.latency = time.monotonic() - started
+                self._record(backend, result.latency)
+                return result
+            finally:
+                self.stats[backend.name].in_flight -= 1
+                async with self.slot_freed:
+                    self.slot_freed.notify_all()
+        raise last_error
+
+# ============== LLM-КЛИЕНТ ==============
 
 class LLMClient:
-    """Клиент для работы с Cerebras LLM"""
+    """Промпты генерации поверх маршрутизатора LLM-бэкендов; каждый вызов учитывается в UsageLedger"""
     
-    def __init__(self):
-        self.client = Cerebras(api_key=CEREBRAS_API_KEY)
+    def __init__(self, llm_router: LLMRouter, usage: "UsageLedger"):
+        self.router = llm_router
+        self.usage = usage
     
-    async def generate_ideas(self, session: UserSession) -> str:
-        """Генерация идей на основе данных сессии"""
+    async def generate_ideas(self, session: UserSession, user_id: int = 0, purpose: str = "report") -> Completion:
+        """Генерация идей на основе данных сессии (user_id 0 — пакетная генерация; purpose — для учёта токенов)"""
         
         format_instruction = ""
         if session.report_format == "short":
@@ -330,27 +852,86 @@ class LLMClient:
 
 Дай конкретные, реалистичные идеи с учётом указанного бюджета и рынка."""
 
-        try:
-            # Запускаем синхронный вызов в executor
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None,
-                lambda: self.client.chat.completions.create(
-                    messages=[
-                        {"role": "system", "content": SYSTEM_PROMPT},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    model=CEREBRAS_MODEL,
-                    max_tokens=4000,
-                    temperature=0.7,
+        if OUTPUT_MODE == "json":
+            return await self._complete_report_json(user_prompt, session, user_id, purpose)
+        return await self._complete(SYSTEM_PROMPT, user_prompt, 4000, session, user_id, purpose)
+
+    async def _complete_report_json(
+        self, user_prompt: str, session: UserSession, user_id: int, purpose: str
+    ) -> Completion:
+        """
+        JSON-отчёт, проверенный по схеме и числу идей.
+
+        Ответ не по схеме переспрашивается один раз с указанием ошибки; если и второй не подошёл —
+        ошибка генерации (сырой JSON пользователю не уходит). Токены обеих попыток суммируются.
+        """
+        spent = Completion("")
+        prompt = user_prompt
+        for attempt in range(2):
+            completion = await self._complete(JSON_SYSTEM_PROMPT, prompt, 4000, session, user_id, purpose, json_mode=True)
+            spent.prompt_tokens += completion.prompt_tokens
+            spent.completion_tokens += completion.completion_tokens
+            spent.latency += completion.latency
+            if completion.text.startswith(LLM_ERROR_PREFIX):
+                return replace(spent, text=completion.text, backend=completion.backend)
+            try:
+                parse_report_json(completion.text, session.ideas_count)
+            except ValueError as e:
+                logger.warning("JSON report rejected (attempt %s): %s", attempt + 1, e)
+                error = e
+                prompt = (
+                    f"{user_prompt}\n\nПредыдущий ответ отклонён: {e}. "
+                    "Верни ТОЛЬКО JSON-объект строго по схеме."
                 )
+                continue
+            return replace(spent, text=completion.text, backend=completion.backend)
+        return replace(
+            spent,
+            text=f"{LLM_ERROR_PREFIX}: модель вернула отчёт не по схеме ({error})\n\nПопробуйте ещё раз."
+        )
+
+    async def regenerate_section(self, session: UserSession, context: str, instruction: str,
+                                 user_id: int = 0) -> Completion:
+        """Перегенерация одной секции отчёта: короткий запрос с кратким контекстом"""
+        user_prompt = f"""Входные данные:
+- Ниша: {session.niche_display}
+- Бюджет: {session.budget_display}
+- Целевой рынок: {session.market_display}
+
+Текущий отчёт (кратко):
+{context}
+
+{instruction}"""
+
+        return await self._complete(SECTION_SYSTEM_PROMPT, user_prompt, 1200, session, user_id, "section", json_mode=True)
+
+    async def _complete(
+        self, system_prompt: str, user_prompt: str, max_tokens: int,
+        session: UserSession, user_id: int, purpose: str, json_mode: bool = False
+    ) -> Completion:
+        """Один запрос к модели; при ошибке текст ответа начинается с LLM_ERROR_PREFIX"""
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        started = time.monotonic()
+        try:
+            completion = await self.router.complete(messages, max_tokens, json_mode)
+            self.usage.record(user_id, purpose, session, completion)
+            log_sampled(
+                "LLM %s via %s: %.2fs, %s+%s tokens", purpose, completion.backend, completion.latency,
+                completion.prompt_tokens, completion.completion_tokens
             )
-            
-            return response.choices[0].message.content
-            
+            return completion
+
+        except asyncio.CancelledError:
+            # Прерванный вызов тоже учитывается: токенов не известно, но время и число вызовов — да
+            self.usage.record(user_id, purpose, session, Completion("", latency=time.monotonic() - started), "cancelled")
+            raise
         except Exception as e:
-            logger.error(f"LLM Error: {e}")
-            return f"❌ Произошла ошибка при генерации: {str(e)}\n\nПопробуйте ещё раз или обратитесь к разработчику."
+            logger.error("LLM Error: %s", e)
+            self.usage.record(user_id, purpose, session, Completion("", latency=time.monotonic() - started), "error")
+            return Completion(f"{LLM_ERROR_PREFIX}: {str(e)}\n\nПопробуйте ещё раз или обратитесь к разработчику.")
 
 
 # ============== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==============
@@ -550,136 +1131,2903 @@ def split_long_message(text: str, max_length: int = 4000) -> list[str]:
         
     if text:
         parts.append(text)
-        
+
     return parts
 
-# ============== ИНИЦИАЛИЗАЦИЯ ==============
+# ============== СТРУКТУРИРОВАННЫЙ ОТЧЁТ (JSON) ==============
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-router = Router()
-dp.include_router(router)
+@dataclass(frozen=True)
+class ReportIdea:
+    """Идея из JSON-отчёта"""
+    title: str
+    value: str
+    audience: str
+    features: tuple[str, ...]
 
-llm_client = LLMClient()
 
-# Хранение сессий пользователей (в памяти)
-user_sessions: dict[int, UserSession] = {}
+@dataclass(frozen=True)
+class Estimate:
+    """Оценка для MVP и полной версии"""
+    mvp: str
+    full: str
 
-def get_session(user_id: int) -> UserSession:
-    """Получить или создать сессию пользователя"""
-    if user_id not in user_sessions:
-        user_sessions[user_id] = UserSession()
-    return user_sessions[user_id]
 
-# ============== ОБРАБОТЧИКИ ==============
+@dataclass(frozen=True)
+class Report:
+    """JSON-отчёт, проверенный по схеме"""
+    analysis: str
+    ideas: tuple[ReportIdea, ...]
+    timeline: Estimate
+    cost: Estimate
+    monetization: tuple[str, ...]
+    risks: tuple[str, ...]
 
-@router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
-    """Команда /start"""
-    await state.clear()
-    
-    welcome_text = """👋 <b>Привет! Я AI-генератор идей для digital-продуктов.</b>
 
-Я помогу тебе:
-• Найти перспективную идею для приложения
-• Определить ключевые фичи
-• Оценить сроки и стоимость разработки
-• Продумать монетизацию
+def _require_str(data: dict, key: str, where: str) -> str:
+    value = data.get(key)
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"{where}.{key}: ожидается непустая строка")
+    return value.strip()
 
-Просто укажи нишу, бюджет и целевой рынок — и получи детальный отчёт с 3-5 идеями!
+def _require_str_list(data: dict, key: str, where: str) -> tuple[str, ...]:
+    value = data.get(key)
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise ValueError(f"{where}.{key}: ожидается непустой список строк")
+    items = tuple(v.strip() for v in value if v.strip())
+    if not items:
+        # [""] и ["  "] — тоже пустой список
+        raise ValueError(f"{where}.{key}: ожидается непустой список строк")
+    return items
 
-👇 Выбери действие:"""
-    
-    await message.answer(
-        welcome_text, 
-        reply_markup=get_main_menu_keyboard(),
-        parse_mode=ParseMode.HTML
+def _require_estimate(data: dict, key: str) -> Estimate:
+    value = data.get(key)
+    if not isinstance(value, dict):
+        raise ValueError(f"report.{key}: ожидается объект с mvp и full")
+    return Estimate(_require_str(value, "mvp", key), _require_str(value, "full", key))
+
+def _require_idea(data, where: str) -> ReportIdea:
+    if not isinstance(data, dict):
+        raise ValueError(f"{where}: ожидается объект")
+    return ReportIdea(
+        _require_str(data, "title", where),
+        _require_str(data, "value", where),
+        _require_str(data, "audience", where),
+        _require_str_list(data, "features", where),
     )
 
-@router.message(Command("help"))
-async def cmd_help(message: Message):
-    """Команда /help"""
-    help_text = """📖 **Как пользоваться ботом:**
+def _load_json_object(text: str) -> dict:
+    text = text.strip()
+    if text.startswith("```"):
+        text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text)
+    data = json.loads(text)  # json.JSONDecodeError — подкласс ValueError
+    if not isinstance(data, dict):
+        raise ValueError("report: ожидается объект")
+    return data
 
-1️⃣ Нажми "🎯 Сгенерировать идеи"
-2️⃣ Выбери или введи нишу
-3️⃣ Укажи бюджет на разработку
-4️⃣ Выбери целевой рынок
-5️⃣ Подтверди и получи отчёт!
+def parse_report_json(text: str, ideas_count: Optional[int] = None) -> Report:
+    """Разобрать и проверить JSON-ответ модели; ValueError, если он не по схеме или идей не ideas_count"""
+    data = _load_json_object(text)
 
-**Команды:**
-/start — Главное меню
-/help — Эта справка
-/generate — Быстрый старт генерации
+    raw_ideas = data.get("ideas")
+    if not isinstance(raw_ideas, list) or not raw_ideas:
+        raise ValueError("report.ideas: ожидается непустой список")
+    if ideas_count is not None and len(raw_ideas) != ideas_count:
+        raise ValueError(f"report.ideas: ожидается идей — {ideas_count}, получено — {len(raw_ideas)}")
+    ideas = [_require_idea(idea, f"ideas[{i}]") for i, idea in enumerate(raw_ideas)]
 
-**Настройки:**
-• Количество идей: 3-5
-• Формат: подробный или краткий
+    return Report(
+        analysis=_require_str(data, "analysis", "report"),
+        ideas=tuple(ideas),
+        timeline=_require_estimate(data, "timeline"),
+        cost=_require_estimate(data, "cost"),
+        monetization=_require_str_list(data, "monetization", "report"),
+        risks=_require_str_list(data, "risks", "report"),
+    )
 
-Если есть вопросы — пиши разработчику!"""
-    
-    await message.answer(help_text, parse_mode=ParseMode.MARKDOWN)
+# Шаблоны секций компилируются один раз при импорте
+ANALYSIS_TEMPLATE = Template("📊 <b>Краткий анализ ниши</b>\n$analysis")
+IDEA_TEMPLATE = Template(
+    "💡 <b>Идея #$number: $title</b>\n\n"
+    "$value\n"
+    "👥 <b>Аудитория:</b> $audience\n\n"
+    "🔧 <b>Фичи:</b>\n$features"
+)
+ESTIMATES_TEMPLATE = Template(
+    "⏱ <b>Сроки разработки</b>\n"
+    "• MVP: $timeline_mvp\n"
+    "• Полная версия: $timeline_full\n\n"
+    "💰 <b>Оценка стоимости</b>\n"
+    "• MVP: $cost_mvp\n"
+    "• Полная версия: $cost_full"
+)
+MONETIZATION_TEMPLATE = Template("📈 <b>План монетизации</b>\n$items")
+RISKS_TEMPLATE = Template("⚠️ <b>Риски и рекомендации</b>\n$items")
 
-@router.message(Command("generate"))
-async def cmd_generate(message: Message, state: FSMContext):
-    """Быстрый старт генерации"""
-    await state.set_state(IdeaGeneration.waiting_niche)
-    
-    await message.answer(
-        "🎯 **Шаг 1/3: Выбери нишу**\n\nВыбери из списка или введи свою:",
-        reply_markup=get_niche_keyboard(),
-        parse_mode=ParseMode.MARKDOWN
+LARGE_NUMBER_RE = re.compile(r"\b\d{5,}\b")
+
+def _escape(text: str) -> str:
+    """Экранирование HTML и форматирование чисел: 10000 → 10 000"""
+    return LARGE_NUMBER_RE.sub(lambda m: f"{int(m.group(0)):,}".replace(",", " "), html.escape(text))
+
+def _bullets(items: tuple[str, ...]) -> str:
+    return "\n".join(f"• {_escape(item)}" for item in items)
+
+@lru_cache(maxsize=1024)
+def render_idea(number: int, idea: ReportIdea) -> str:
+    """HTML секции одной идеи"""
+    return IDEA_TEMPLATE.substitute(
+        number=number,
+        title=_escape(idea.title),
+        value=_escape(idea.value),
+        audience=_escape(idea.audience),
+        features=_bullets(idea.features),
     )
 
-# ============== CALLBACK HANDLERS ==============
+def render_report_sections(report: Report) -> list[str]:
+    """HTML отчёта по секциям (каждая секция — отдельная строка)"""
+    sections = [ANALYSIS_TEMPLATE.substitute(analysis=_escape(report.analysis))]
+    sections += [render_idea(i, idea) for i, idea in enumerate(report.ideas, 1)]
+    sections.append(ESTIMATES_TEMPLATE.substitute(
+        timeline_mvp=_escape(report.timeline.mvp),
+        timeline_full=_escape(report.timeline.full),
+        cost_mvp=_escape(report.cost.mvp),
+        cost_full=_escape(report.cost.full),
+    ))
+    sections.append(MONETIZATION_TEMPLATE.substitute(items=_bullets(report.monetization)))
+    sections.append(RISKS_TEMPLATE.substitute(items=_bullets(report.risks)))
+    return sections
 
-@router.callback_query(F.data == "main_menu")
-async def cb_main_menu(callback: CallbackQuery, state: FSMContext):
-    """Возврат в главное меню"""
-    await state.clear()
-    
-    # Проверяем, есть ли сообщение после генерации (с клавиатурой after_generation)
-    # Если да - отправляем новое сообщение вместо редактирования, чтобы сохранить результат
+def pack_sections(sections: list[str], max_length: int = 4000) -> list[str]:
+    """Собрать секции в сообщения, разрывая только между секциями"""
+    parts, current = [], ""
+    for section in sections:
+        candidate = f"{current}\n\n{section}" if current else section
+        if len(candidate) <= max_length:
+            current = candidate
+            continue
+        if current:
+            parts.append(current)
+        if len(section) > max_length:
+            # Секция сама не влезает в сообщение — режем её обычным способом
+            *head, current = split_long_message(section, max_length)
+            parts.extend(head)
+        else:
+            current = section
+    if current:
+        parts.append(current)
+    return parts
+
+def try_parse_report(result: str) -> Optional[Report]:
+    """JSON-отчёт или None, если ответ в свободной форме"""
+    if not result.lstrip().startswith(("{", "```")):
+        return None
     try:
-        if callback.message.reply_markup and callback.message.reply_markup.inline_keyboard:
-            # Проверяем, есть ли кнопка "Сгенерировать ещё" (признак сообщения после генерации)
-            buttons_text = [btn.text for row in callback.message.reply_markup.inline_keyboard for btn in row]
-            if "🔄 Сгенерировать ещё" in buttons_text:
-                # Это сообщение после генерации - отправляем новое
-                await callback.message.answer(
-                    "🏠 **Главное меню**\n\nВыбери действие:",
-                    reply_markup=get_main_menu_keyboard(),
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                await callback.answer()  # Убираем "часики" на кнопке
-                return
-    except:
-        pass
-    
-    # Обычное редактирование для других случаев
-    await callback.message.edit_text(
-        "🏠 **Главное меню**\n\nВыбери действие:",
-        reply_markup=get_main_menu_keyboard(),
-        parse_mode=ParseMode.MARKDOWN
-    )
+        return parse_report_json(result)
+    except ValueError:
+        return None
 
-@router.callback_query(F.data == "generate")
-async def cb_generate(callback: CallbackQuery, state: FSMContext):
-    """Начало генерации"""
-    await state.set_state(IdeaGeneration.waiting_niche)
-    
-    # Проверяем, есть ли сообщение после генерации
+def render_llm_result(result: str) -> list[str]:
+    """Ответ LLM → части сообщения: JSON-отчёт по шаблонам, иначе Markdown-обработка"""
+    if result.lstrip().startswith(("{", "```")):
+        try:
+            return pack_sections(render_report_sections(parse_report_json(result)))
+        except ValueError as e:
+            logger.warning("JSON report rejected, falling back to Markdown processing: %s", e)
+    return split_long_message(process_ai_response(result))
+
+# ----- Частичная перегенерация -----
+
+PARTIAL_INSTRUCTIONS = {
+    "idea": (
+        "Замени идею #{index} на новую, непохожую на остальные идеи отчёта. "
+        'Верни ТОЛЬКО JSON-объект одной идеи: {{"title": "...", "value": "...", "audience": "...", "features": ["..."]}}'
+    ),
+    "monetization": (
+        "Предложи другой план монетизации (минимум 3 конкретных варианта с примерами цен), отличный от текущего. "
+        'Верни ТОЛЬКО JSON: {{"monetization": ["..."]}}'
+    ),
+}
+
+def compact_report_context(report: Report) -> str:
+    """Краткое содержание отчёта — контекст для перегенерации одной секции"""
+    lines = [f"Анализ: {report.analysis[:300]}"]
+    lines += [f"Идея #{i}: {idea.title} — {idea.value}" for i, idea in enumerate(report.ideas, 1)]
+    lines.append(f"Сроки: MVP {report.timeline.mvp}, полная версия {report.timeline.full}")
+    lines.append(f"Стоимость: MVP {report.cost.mvp}, полная версия {report.cost.full}")
+    lines.append("Монетизация: " + "; ".join(report.monetization))
+    return "\n".join(lines)
+
+def parse_report_section(section: str, text: str):
+    """Новая секция из ответа модели: ReportIdea или список вариантов монетизации"""
+    data = _load_json_object(text)
+    if section == "idea":
+        # Модель иногда оборачивает идею в {"idea": {...}}
+        return _require_idea(data.get("idea", data), "idea")
+    return _require_str_list(data, "monetization", "report")
+
+def splice_report(report: Report, section: str, index: int, value) -> Report:
+    """Отчёт с заменённой секцией"""
+    if section == "idea":
+        ideas = list(report.ideas)
+        ideas[index - 1] = value
+        return replace(report, ideas=tuple(ideas))
+    return replace(report, monetization=value)
+
+def render_partial_result(payload: dict, result: str) -> list[str]:
+    """Сообщение с новой секцией"""
     try:
-        if callback.message.reply_markup and callback.message.reply_markup.inline_keyboard:
-            buttons_text = [btn.text for row in callback.message.reply_markup.inline_keyboard for btn in row]
-            if "🔄 Сгенерировать ещё" in buttons_text:
-                # Это сообщение после генерации - отправляем новое
-                await callback.message.answer(
-                    "🎯 **Шаг 1/3: Выбери нишу**\n\nВыбери из списка или введи свою:",
-                    reply_markup=get_niche_keyboard(),
-                    parse_mode=ParseMode.MARKDOWN
-                )
+        value = parse_report_section(payload["section"], result)
+    except ValueError as e:
+        logger.warning("Partial regeneration rejected: %s", e)
+        return ["❌ Не удалось перегенерировать эту часть отчёта. Попробуйте ещё раз."]
+
+    if payload["section"] == "idea":
+        sections = [f"🔁 <b>Идея #{payload['index']} заменена</b>", render_idea(payload["index"], value)]
+    else:
+        sections = ["🔁 <b>Новый план монетизации</b>", MONETIZATION_TEMPLATE.substitute(items=_bullets(value))]
+    return pack_sections(sections)
+
+# ============== КОМПАКТНАЯ ДОСТАВКА ==============
+
+TELEGRAM_TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+# Заголовок Markdown-отчёта после process_ai_response: строка целиком жирная (подписи вида «Фичи:» — нет)
+SECTION_HEADING_RE = re.compile(r"^(?:[^\w\s<•-]{1,3}\s*)?<b>[^<\n]*[^<\n:]</b>\s*$", re.M)
+SHORTENED_NOTE = "✂️ <i>Отчёт сокращён, чтобы поместиться в одно сообщение. Полная версия — в /history</i>"
+
+REPORT_DOCUMENT_TEMPLATE = Template("""<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>$title</title>
+<style>
+body { max-width: 760px; margin: 2em auto; padding: 0 1em; font: 16px/1.5 -apple-system, "Segoe UI", sans-serif; }
+section { white-space: pre-wrap; margin-bottom: 1.5em; }
+blockquote { border-left: 3px solid #ccc; margin: 0; padding-left: 1em; }
+</style>
+</head>
+<body>
+<h1>$title</h1>
+$sections
+</body>
+</html>
+""")
+
+def strip_html(text: str) -> str:
+    """Текст HTML-сообщения без разметки — так, как его видит пользователь"""
+    return html.unescape(HTML_TAG_RE.sub("", text))
+
+def visible_length(text: str) -> int:
+    """Длина HTML-сообщения так, как её считает Telegram (без тегов и сущностей)"""
+    return len(strip_html(text))
+
+def collapse_section(section: str) -> str:
+    """Заголовок секции виден, остальное — в раскрывающейся цитате"""
+    heading, _, body = section.partition("\n")
+    body = body.strip()
+    return f"{heading}\n<blockquote expandable>{body}</blockquote>" if body else heading
+
+def split_markdown_sections(parts: list[str]) -> list[str]:
+    """Markdown-отчёт по секциям: каждая начинается со своего заголовка"""
+    text = "\n".join(part.strip() for part in parts)
+    starts = [match.start() for match in SECTION_HEADING_RE.finditer(text)]
+    if not starts or starts[0] > 0:
+        # Текст до первого заголовка — под общим заголовком
+        text = "📄 <b>Отчёт</b>\n" + text
+        starts = [0] + [start + len("📄 <b>Отчёт</b>\n") for start in starts]
+    return [text[start:end].strip() for start, end in zip(starts, starts[1:] + [len(text)])]
+
+def shorten_sections(sections: list[str], limit: int, note: str = SHORTENED_NOTE) -> Optional[str]:
+    """Все заголовки и начало каждой секции простым текстом; место делится между секциями поровну"""
+    headings, bodies = [], []
+    for section in sections:
+        heading, _, body = section.partition("\n")
+        headings.append(heading)
+        bodies.append(" ".join(strip_html(body).split()))
+
+    # Всё, кроме тел секций: заголовки, переводы строк между ними и пометка о сокращении
+    overhead = sum(visible_length(heading) + 3 for heading in headings) + visible_length(note)
+    budget = limit - overhead
+    if budget < len(sections) * 40:
+        return None
+
+    # Короткие секции берут сколько нужно, их остаток делят длинные
+    allowed = [0] * len(bodies)
+    for left, i in enumerate(sorted(range(len(bodies)), key=lambda i: len(bodies[i]))):
+        allowed[i] = min(len(bodies[i]), budget // (len(bodies) - left))
+        budget -= allowed[i]
+
+    shortened = []
+    for heading, body, size in zip(headings, bodies, allowed):
+        if len(body) > size:
+            body = body[:size - 1].rstrip() + "…"
+        shortened.append(collapse_section(f"{heading}\n{html.escape(body)}"))
+    return "\n\n".join(shortened + [note])
+
+def render_compact_message(parts: list[str], report: Optional[Report],
+                           shortened_note: str = SHORTENED_NOTE) -> Optional[str]:
+    """Весь отчёт одним сообщением; None — не помещается в лимит Telegram даже сокращённым"""
+    if report:
+        sections = render_report_sections(report)
+        # Полный отчёт; если не помещается — без анализа ниши и рисков
+        variants = [sections, sections[1:-1]]
+    else:
+        sections = split_markdown_sections(parts)
+        variants = [sections]
+    for variant in variants:
+        text = "\n\n".join(collapse_section(section) for section in variant)
+        if visible_length(text) <= TELEGRAM_TEXT_LIMIT:
+            return text
+    # Длинный отчёт: все секции, но каждая укорочена
+    return shorten_sections(sections, TELEGRAM_TEXT_LIMIT, shortened_note)
+
+def report_title(session: UserSession) -> str:
+    return f"Идеи: {session.niche_display} · {session.budget_display} · {session.market_display}"
+
+def render_report_document(session: UserSession, parts: list[str]) -> bytes:
+    """Отчёт отдельной HTML-страницей (части уже в HTML-подмножестве Telegram)"""
+    return REPORT_DOCUMENT_TEMPLATE.substitute(
+        title=html.escape(report_title(session)),
+        sections="\n".join(f"<section>{part}</section>" for part in parts),
+    ).encode("utf-8")
+
+def render_report_summary(session: UserSession, report: Optional[Report]) -> str:
+    """Короткая подпись к HTML-файлу"""
+    summary = (
+        f"📄 <b>Отчёт готов</b>\n"
+        f"🎯 {html.escape(session.niche_display or '')}\n"
+        f"💰 {html.escape(session.budget_display or '')}\n"
+        f"🌍 {html.escape(session.market_display or '')}"
+    )
+    if report:
+        titles = "\n".join(f"{i}. {_escape(idea.title)}" for i, idea in enumerate(report.ideas, 1))
+        with_titles = f"{summary}\n\n💡 <b>Идеи:</b>\n{titles}"
+        if visible_length(with_titles) <= CAPTION_LIMIT:
+            return with_titles
+    return summary
+
+# ============== ХРАНИЛИЩА SQLITE ==============
+
+class SQLiteStore:
+    """
+    Хранилище в файле SQLite (общем для бота, воркеров и пакетной генерации).
+
+    Соединение в WAL-режиме с коротким busy timeout. Из event loop методы хранилища
+    вызываются через `await store.run(store.method, ...)` — в собственном потоке хранилища:
+    пока другой процесс держит блокировку записи, ждёт этот поток, а не обработка апдейтов.
+    Занятая база повторяется с паузой до SQLITE_LOCK_RETRIES раз, поэтому каждый метод
+    должен быть атомарным: одна инструкция или своя транзакция.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Автокоммит: транзакции открываем явно там, где нужна атомарность
+        self.conn = sqlite3.connect(
+            path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Один поток — запросы к соединению никогда не идут параллельно
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{os.path.basename(path)}")
+
+    def _with_retry(self, func: Callable, *args):
+        for attempt in range(SQLITE_LOCK_RETRIES + 1):
+            try:
+                return func(*args)
+            except sqlite3.OperationalError as e:
+                busy = getattr(e, "sqlite_errorcode", None) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+                if not busy or attempt == SQLITE_LOCK_RETRIES:
+                    raise
+                time.sleep(0.05 * 2 ** attempt)
+
+    async def run(self, func: Callable, *args):
+        """func(*args) в потоке хранилища (с повтором, если база занята другим процессом)"""
+        # Контекст копируем, чтобы correlation_id апдейта дошёл и до записи в базу
+        context = copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, context.run, self._with_retry, func, *args
+        )
+
+# ============== ОЧЕРЕДЬ ГЕНЕРАЦИЙ ==============
+
+@dataclass
+class GenerationJob:
+    """Задача генерации в очереди"""
+    job_id: int
+    user_id: int
+    chat_id: int
+    status_message_id: int
+    kind: str  # confirm / regenerate / cached / partial / speculative
+    session: UserSession
+    status: str = "queued"  # queued / running / done / failed
+    attempts: int = 0
+    parts: list[str] = field(default_factory=list)
+    delivered_parts: int = 0
+    created_at: float = 0.0
+    result: str = ""  # сырой ответ LLM
+    payload: dict = field(default_factory=dict)  # параметры частичной перегенерации
+    correlation_id: str = ""  # из апдейта, запустившего генерацию
+
+
+class JobQueue(SQLiteStore):
+    """
+    Персистентная очередь генераций в SQLite.
+
+    Бот ставит задачу и сразу возвращается, LLM-воркеры (в этом же процессе
+    или отдельные `python bot.py worker`) забирают её под аренду, вызывают LLM
+    и записывают готовые части отчёта. Задача с истёкшей арендой (воркер упал)
+    выдаётся снова — это at-least-once, а счётчик delivered_parts делает
+    доставку идемпотентной. Доставленная задача удаляется из очереди.
+    """
+
+    COLUMNS = (
+        "job_id, user_id, chat_id, status_message_id, kind, session, "
+        "status, attempts, parts, delivered_parts, created_at, result, payload, correlation_id"
+    )
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS generation_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                status_message_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                session TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker_id TEXT,
+                lease_until REAL,
+                parts TEXT,
+                delivered_parts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                result TEXT,
+                payload TEXT,
+                correlation_id TEXT,
+                completion_tokens INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(generation_jobs)")}
+        for column in ("result", "payload", "correlation_id"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE generation_jobs ADD COLUMN {column} TEXT")
+        if "completion_tokens" not in columns:
+            self.conn.execute("ALTER TABLE generation_jobs ADD COLUMN completion_tokens INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS generation_jobs_status ON generation_jobs (status, job_id)"
+        )
+        # Счётчики, общие для бота и всех процессов воркеров
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._migrate_journal()
+
+    def _migrate_journal(self):
+        """Перенести недоставленные задачи из старого журнала generation_journal"""
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'generation_journal'"
+        ).fetchone()
+        if not exists:
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.execute(
+            "INSERT INTO generation_jobs (user_id, chat_id, status_message_id, kind, session, created_at) "
+            "SELECT user_id, chat_id, status_message_id, kind, session, created_at FROM generation_journal"
+        )
+        self.conn.execute("DROP TABLE generation_journal")
+        self.conn.execute("COMMIT")
+
+    @staticmethod
+    def _row_to_job(row) -> GenerationJob:
+        (job_id, user_id, chat_id, status_message_id, kind, session, status, attempts,
+         parts, delivered_parts, created_at, result, payload, job_correlation_id) = row
+        return GenerationJob(
+            job_id, user_id, chat_id, status_message_id, kind,
+            UserSession(**json.loads(session)),
+            status, attempts, json.loads(parts) if parts else [], delivered_parts, created_at, result or "",
+            json.loads(payload) if payload else {}, job_correlation_id or f"job-{job_id}"
+        )
+
+    def enqueue(self, user_id: int, chat_id: int, status_message_id: int, kind: str, session: UserSession,
+                payload: Optional[dict] = None) -> GenerationJob:
+        """Поставить генерацию в очередь (без ожидания LLM); correlation_id берётся из текущего контекста"""
+        created_at = time.time()
+        # Вне апдейта correlation_id нет — тогда задача получит job-<id> при чтении
+        job_correlation_id = correlation_id.get() if correlation_id.get() != "-" else None
+        cursor = self.conn.execute(
+            "INSERT INTO generation_jobs (user_id, chat_id, status_message_id, kind, session, created_at, payload, "
+            "correlation_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                user_id, chat_id, status_message_id, kind, json.dumps(asdict(session), ensure_ascii=False), created_at,
+                json.dumps(payload, ensure_ascii=False) if payload else None, job_correlation_id
+            )
+        )
+        logger.info("Job %s enqueued (%s) for user %s", cursor.lastrowid, kind, user_id)
+        return GenerationJob(
+            cursor.lastrowid, user_id, chat_id, status_message_id, kind, session,
+            created_at=created_at, payload=payload or {},
+            correlation_id=job_correlation_id or f"job-{cursor.lastrowid}"
+        )
+
+    def enqueue_done(self, user_id: int, chat_id: int, status_message_id: int, kind: str, session: UserSession,
+                     result: str, parts: list[str]) -> GenerationJob:
+        """Поставить уже готовый отчёт (из кэша) сразу на доставку, минуя воркеры"""
+        created_at = time.time()
+        job_correlation_id = correlation_id.get() if correlation_id.get() != "-" else None
+        cursor = self.conn.execute(
+            "INSERT INTO generation_jobs (user_id, chat_id, status_message_id, kind, session, created_at, "
+            "correlation_id, status, result, parts) VALUES (?, ?, ?, ?, ?, ?, ?, 'done', ?, ?)",
+            (
+                user_id, chat_id, status_message_id, kind, json.dumps(asdict(session), ensure_ascii=False), created_at,
+                job_correlation_id, result, json.dumps(parts, ensure_ascii=False)
+            )
+        )
+        logger.info("Job %s enqueued (%s, ready) for user %s", cursor.lastrowid, kind, user_id)
+        return GenerationJob(
+            cursor.lastrowid, user_id, chat_id, status_message_id, kind, session, status="done",
+            parts=parts, created_at=created_at, result=result,
+            correlation_id=job_correlation_id or f"job-{cursor.lastrowid}"
+        )
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[GenerationJob]:
+        """Забрать следующую задачу под аренду; исчерпавшие попытки помечаются failed"""
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                row = self.conn.execute(
+                    f"SELECT {self.COLUMNS} FROM generation_jobs "
+                    "WHERE status = 'queued' OR (status = 'running' AND lease_until < ?) "
+                    "ORDER BY kind = 'speculative', job_id LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    self.conn.execute("COMMIT")
+                    return None
+
+                job = self._row_to_job(row)
+                if job.attempts >= MAX_JOB_ATTEMPTS:
+                    logger.warning("Job %s failed after %s attempts", job.job_id, job.attempts)
+                    self.conn.execute(
+                        "UPDATE generation_jobs SET status = 'failed', lease_until = NULL WHERE job_id = ?",
+                        (job.job_id,)
+                    )
+                    continue
+
+                self.conn.execute(
+                    "UPDATE generation_jobs SET status = 'running', attempts = attempts + 1, "
+                    "worker_id = ?, lease_until = ? WHERE job_id = ?",
+                    (worker_id, now + lease_seconds, job.job_id)
+                )
+                self.conn.execute("COMMIT")
+                job.status = "running"
+                job.attempts += 1
+                return job
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def complete(self, job_id: int, result: str, parts: list[str], completion_tokens: int = 0) -> bool:
+        """Записать готовый отчёт; побеждает первый завершивший воркер"""
+        cursor = self.conn.execute(
+            "UPDATE generation_jobs SET status = 'done', result = ?, parts = ?, completion_tokens = ?, "
+            "lease_until = NULL WHERE job_id = ? AND status IN ('queued', 'running')",
+            (result, json.dumps(parts, ensure_ascii=False), completion_tokens, job_id)
+        )
+        return cursor.rowcount > 0
+
+    def release(self, job_id: int, worker_id: str):
+        """Вернуть прерванную задачу в очередь, не засчитывая попытку"""
+        self.conn.execute(
+            "UPDATE generation_jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), "
+            "worker_id = NULL, lease_until = NULL "
+            "WHERE job_id = ? AND status = 'running' AND worker_id = ?",
+            (job_id, worker_id)
+        )
+
+    def requeue(self, job_id: int, worker_id: str):
+        """Вернуть задачу в очередь после ошибки воркера; попытка засчитана, после MAX_JOB_ATTEMPTS — failed"""
+        self.conn.execute(
+            "UPDATE generation_jobs SET status = 'queued', worker_id = NULL, lease_until = NULL "
+            "WHERE job_id = ? AND status = 'running' AND worker_id = ?",
+            (job_id, worker_id)
+        )
+
+    def ready_for_delivery(self, limit: int = 20) -> list[GenerationJob]:
+        """Завершённые задачи, ожидающие отправки пользователю"""
+        rows = self.conn.execute(
+            f"SELECT {self.COLUMNS} FROM generation_jobs "
+            "WHERE status IN ('done', 'failed') AND kind != 'speculative' ORDER BY job_id LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def mark_part_delivered(self, job_id: int, delivered_parts: int):
+        """Запомнить, сколько частей отчёта уже отправлено"""
+        self.conn.execute(
+            "UPDATE generation_jobs SET delivered_parts = ? WHERE job_id = ?",
+            (delivered_parts, job_id)
+        )
+
+    def remove(self, job_id: int):
+        """Удалить доставленную задачу"""
+        self.conn.execute("DELETE FROM generation_jobs WHERE job_id = ?", (job_id,))
+
+    def unstarted_deliveries(self, created_before: float) -> list[GenerationJob]:
+        """Ещё не готовые задачи, поставленные до указанного момента, из которых пользователь ничего не получил"""
+        rows = self.conn.execute(
+            f"SELECT {self.COLUMNS} FROM generation_jobs "
+            "WHERE created_at < ? AND kind != 'speculative' AND status IN ('queued', 'running') AND delivered_parts = 0 "
+            "ORDER BY job_id",
+            (created_before,)
+        ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def cancel_for_message(self, user_id: int, chat_id: int, status_message_id: int) -> list[tuple[int, str]]:
+        """Отменить задачи пользователя с этим статус-сообщением; [(job_id, статус до отмены)]"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute(
+                "SELECT job_id, status FROM generation_jobs "
+                "WHERE user_id = ? AND chat_id = ? AND status_message_id = ? AND kind != 'speculative'",
+                (user_id, chat_id, status_message_id)
+            ).fetchall()
+            self.conn.executemany("DELETE FROM generation_jobs WHERE job_id = ?", [(job_id,) for job_id, _ in rows])
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def existing(self, job_ids: list[int]) -> set[int]:
+        """Какие из задач ещё в очереди (удалённые — отменены)"""
+        placeholders = ", ".join("?" * len(job_ids))
+        rows = self.conn.execute(
+            f"SELECT job_id FROM generation_jobs WHERE job_id IN ({placeholders})", job_ids
+        ).fetchall()
+        return {job_id for (job_id,) in rows}
+
+    def exists(self, job_id: int) -> bool:
+        """Задача не отменена и ещё не доставлена"""
+        return self.conn.execute("SELECT 1 FROM generation_jobs WHERE job_id = ?", (job_id,)).fetchone() is not None
+
+    def incr(self, name: str, value: int = 1):
+        """Увеличить общий счётчик"""
+        self.conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (name, value)
+        )
+
+    def counters(self) -> dict[str, int]:
+        """Все общие счётчики"""
+        return dict(self.conn.execute("SELECT name, value FROM counters ORDER BY name").fetchall())
+
+    def count_speculative(self) -> int:
+        """Спекулятивные задачи, которые ещё ждут воркера или выполняются"""
+        (count,) = self.conn.execute(
+            "SELECT COUNT(*) FROM generation_jobs WHERE kind = 'speculative' AND status IN ('queued', 'running')"
+        ).fetchone()
+        return count
+
+    def promote(self, job_id: int) -> bool:
+        """Подтверждённая спекулятивная задача становится обычной и будет доставлена"""
+        cursor = self.conn.execute(
+            "UPDATE generation_jobs SET kind = 'confirm' WHERE job_id = ? AND kind = 'speculative'", (job_id,)
+        )
+        return cursor.rowcount > 0
+
+    def discard(self, job_id: int) -> Optional[tuple[str, int]]:
+        """Удалить спекулятивную задачу; (статус, completion-токены готового ответа) или None"""
+        return self.conn.execute(
+            "DELETE FROM generation_jobs WHERE job_id = ? AND kind = 'speculative' RETURNING status, completion_tokens",
+            (job_id,)
+        ).fetchone()
+
+    def drop_speculative(self) -> int:
+        """Удалить все спекулятивные задачи (после рестарта их некому подтвердить)"""
+        return self.conn.execute("DELETE FROM generation_jobs WHERE kind = 'speculative'").rowcount
+
+    def stats(self) -> dict[str, int]:
+        """Количество задач по статусам"""
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM generation_jobs GROUP BY status").fetchall())
+
+# ============== ИСТОРИЯ ОТЧЁТОВ ==============
+
+@dataclass
+class ReportSummary:
+    """Строка списка истории (без тела отчёта)"""
+    seq: int
+    created_at: float
+    niche_display: str
+    budget_display: str
+    market_display: str
+
+
+class ReportHistory(SQLiteStore):
+    """
+    История отчётов пользователя в SQLite.
+
+    Сырой ответ LLM и готовый HTML хранятся сжатыми (zlib). У каждого
+    пользователя своя нумерация seq, а листание идёт по индексу (user_id, seq)
+    от границы страницы, без OFFSET — стоимость страницы не зависит от
+    количества отчётов. Старые отчёты вытесняются по квотам и возрасту.
+    """
+
+    # Устаревшие отчёты удаляются при запуске и раз в столько новых отчётов
+    PRUNE_EVERY = 100
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.added = 0
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS reports (
+                user_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                job_id INTEGER UNIQUE,
+                created_at REAL NOT NULL,
+                niche_display TEXT NOT NULL,
+                budget_display TEXT NOT NULL,
+                market_display TEXT NOT NULL,
+                session TEXT NOT NULL,
+                raw BLOB NOT NULL,
+                html BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (user_id, seq)
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS reports_created_at ON reports (created_at)")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(reports)")}
+        if "search_text" not in columns:
+            # Слова для инлайн-поиска по своей истории; у старых отчётов — только ниша и рынок
+            self.conn.execute("ALTER TABLE reports ADD COLUMN search_text TEXT NOT NULL DEFAULT ''")
+            self.conn.create_function("normalize_custom_text", 1, normalize_custom_text, deterministic=True)
+            self.conn.execute("UPDATE reports SET search_text = normalize_custom_text(niche_display || ' ' || market_display)")
+        self.prune_expired()
+
+    @staticmethod
+    def _search_text(session: UserSession, raw: str) -> str:
+        return normalize_custom_text(
+            " ".join([session.niche_display or "", session.market_display or "", *report_idea_titles(raw)])
+        )
+
+    def add(self, user_id: int, job_id: Optional[int], session: UserSession, raw: str, html_text: str) -> int:
+        """Сохранить отчёт и вернуть его seq; повторная запись той же задачи не создаёт копию"""
+        raw_blob = zlib.compress(raw.encode("utf-8"))
+        html_blob = zlib.compress(html_text.encode("utf-8"))
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            (last_seq,) = self.conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM reports WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO reports (user_id, seq, job_id, created_at, niche_display, budget_display, "
+                "market_display, session, raw, html, size, search_text) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    user_id, last_seq + 1, job_id, time.time(),
+                    session.niche_display or "", session.budget_display or "", session.market_display or "",
+                    json.dumps(asdict(session), ensure_ascii=False),
+                    raw_blob, html_blob, len(raw_blob) + len(html_blob), self._search_text(session, raw)
+                )
+            )
+            if cursor.rowcount:
+                seq = last_seq + 1
+                self._enforce_quota(user_id)
+                self.added += 1
+                if self.added % self.PRUNE_EVERY == 0:
+                    self.prune_expired()
+            else:
+                (seq,) = self.conn.execute("SELECT seq FROM reports WHERE job_id = ?", (job_id,)).fetchone()
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return seq
+
+    def _enforce_quota(self, user_id: int):
+        """
+        Удалить самые старые отчёты пользователя сверх квот.
+
+        Удаляется всё не новее первого отчёта сверх квоты — нумерация остаётся непрерывной.
+        Граница по числу находится по индексу (user_id, seq) без чтения остальных строк, а
+        нарастающий размер считается уже только по не более чем HISTORY_MAX_REPORTS отчётам.
+        """
+        self.conn.execute(
+            "DELETE FROM reports WHERE user_id = ? AND seq <= "
+            "(SELECT seq FROM reports WHERE user_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+            (user_id, user_id, HISTORY_MAX_REPORTS)
+        )
+        self.conn.execute(
+            "DELETE FROM reports WHERE user_id = ? AND seq <= ("
+            "SELECT MAX(seq) FROM (SELECT seq, SUM(size) OVER (ORDER BY seq DESC) AS total "
+            "FROM reports WHERE user_id = ?) WHERE total > ?)",
+            (user_id, user_id, HISTORY_MAX_BYTES)
+        )
+
+    def prune_expired(self) -> int:
+        """Удалить отчёты старше HISTORY_MAX_AGE_DAYS"""
+        cutoff = time.time() - HISTORY_MAX_AGE_DAYS * 86400
+        cursor = self.conn.execute("DELETE FROM reports WHERE created_at < ?", (cutoff,))
+        return cursor.rowcount
+
+    def page(self, user_id: int, before: Optional[int] = None, after: Optional[int] = None,
+             limit: int = 5) -> tuple[list[ReportSummary], bool, bool]:
+        """
+        Страница истории, от новых к старым.
+
+        before — показать отчёты старше seq, after — новее seq.
+        Возвращает (отчёты, есть ли более новые, есть ли более старые).
+        """
+        columns = "seq, created_at, niche_display, budget_display, market_display"
+        if after is not None:
+            rows = self.conn.execute(
+                f"SELECT {columns} FROM reports WHERE user_id = ? AND seq > ? ORDER BY seq ASC LIMIT ?",
+                (user_id, after, limit + 1)
+            ).fetchall()
+            has_newer = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_older = True
+        else:
+            rows = self.conn.execute(
+                f"SELECT {columns} FROM reports WHERE user_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (user_id, before if before is not None else 2 ** 62, limit + 1)
+            ).fetchall()
+            has_older = len(rows) > limit
+            rows = rows[:limit]
+            has_newer = before is not None
+
+        if not rows:
+            return [], False, False
+        return [ReportSummary(*row) for row in rows], has_newer, has_older
+
+    def get_entry(self, user_id: int, seq: int) -> Optional[tuple[UserSession, str]]:
+        """Сессия и сырой ответ LLM отчёта"""
+        row = self.conn.execute(
+            "SELECT session, raw FROM reports WHERE user_id = ? AND seq = ?", (user_id, seq)
+        ).fetchone()
+        if row is None:
+            return None
+        return UserSession(**json.loads(row[0])), zlib.decompress(row[1]).decode("utf-8")
+
+    def update_report(self, user_id: int, seq: int, raw: str, html_text: str):
+        """Заменить тело отчёта (после частичной перегенерации); отчёт мог вырасти — квоты проверяются снова"""
+        raw_blob = zlib.compress(raw.encode("utf-8"))
+        html_blob = zlib.compress(html_text.encode("utf-8"))
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT session FROM reports WHERE user_id = ? AND seq = ?", (user_id, seq)
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE reports SET raw = ?, html = ?, size = ?, search_text = ? WHERE user_id = ? AND seq = ?",
+                    (
+                        raw_blob, html_blob, len(raw_blob) + len(html_blob),
+                        self._search_text(UserSession(**json.loads(row[0])), raw), user_id, seq
+                    )
+                )
+                self._enforce_quota(user_id)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def search(self, user_id: int, query: str, offset: int, limit: int) -> tuple[list["SearchHit"], bool]:
+        """Отчёты пользователя, где каждое слово запроса — префикс слова ниши, рынка или идеи; новые первыми"""
+        prefixes = normalize_custom_text(query).split()
+        # Просматриваются только отчёты одного пользователя — их не больше HISTORY_MAX_REPORTS
+        condition = "".join(" AND (' ' || search_text) LIKE ?" for _ in prefixes)
+        rows = self.conn.execute(
+            f"SELECT niche_display, market_display, session, raw, html FROM reports WHERE user_id = ?{condition} "
+            "ORDER BY seq DESC LIMIT ? OFFSET ?",
+            (user_id, *(f"% {prefix}%" for prefix in prefixes), limit + 1, offset)
+        ).fetchall()
+        hits = []
+        for niche_display, market_display, session, raw, html_text in rows[:limit]:
+            session = UserSession(**json.loads(session))
+            raw = zlib.decompress(raw).decode("utf-8")
+            hits.append(SearchHit(
+                niche_display, session.budget or "", market_display, session.ideas_count,
+                report_idea_titles(raw), raw, [zlib.decompress(html_text).decode("utf-8")]
+            ))
+        return hits, len(rows) > limit
+
+    def get_html(self, user_id: int, seq: int) -> Optional[tuple[ReportSummary, str]]:
+        """Готовый HTML отчёта"""
+        row = self.conn.execute(
+            "SELECT seq, created_at, niche_display, budget_display, market_display, html "
+            "FROM reports WHERE user_id = ? AND seq = ?",
+            (user_id, seq)
+        ).fetchone()
+        if row is None:
+            return None
+        return ReportSummary(*row[:5]), zlib.decompress(row[5]).decode("utf-8")
+
+# ============== КЭШ ОТЧЁТОВ ==============
+
+def normalize_custom_text(text: str) -> str:
+    """Нормализация свободного ввода: регистр, ё, эмодзи и пунктуация"""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w\s]|_", " ", text)
+    return " ".join(text.split())
+
+
+class MinHashIndex:
+    """
+    Индекс похожих строк: MinHash по символьным n-граммам + LSH по полосам.
+
+    LSH отбирает кандидатов за O(число полос), а окончательное решение
+    принимается по точному коэффициенту Жаккара n-грамм.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, ngram: int = 3):
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = num_perm // bands
+        rnd = random.Random(42)  # одинаковые хэши во всех процессах
+        self.perms = [(rnd.randrange(1, self._PRIME), rnd.randrange(0, self._PRIME)) for _ in range(num_perm)]
+        self.buckets: dict[tuple, set[str]] = {}
+        self.shingles: dict[str, frozenset[int]] = {}
+
+    def _shingles(self, text: str) -> frozenset[int]:
+        padded = f" {text} "
+        grams = {padded[i:i + self.ngram] for i in range(max(len(padded) - self.ngram + 1, 1))}
+        return frozenset(zlib.crc32(g.encode("utf-8")) for g in grams)
+
+    def _band_keys(self, shingles: frozenset[int]) -> list[tuple]:
+        signature = [min((a * s + b) % self._PRIME for s in shingles) for a, b in self.perms]
+        return [(i, tuple(signature[i * self.rows:(i + 1) * self.rows])) for i in range(self.bands)]
+
+    def add(self, text: str):
+        """Добавить нормализованную строку"""
+        if text in self.shingles:
+            return
+        shingles = self._shingles(text)
+        self.shingles[text] = shingles
+        for key in self._band_keys(shingles):
+            self.buckets.setdefault(key, set()).add(text)
+
+    def remove(self, text: str):
+        """Убрать строку из индекса"""
+        shingles = self.shingles.pop(text, None)
+        if shingles is None:
+            return
+        for key in self._band_keys(shingles):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(text)
+                if not bucket:
+                    del self.buckets[key]
+
+    def candidates(self, text: str) -> list[tuple[str, float]]:
+        """Похожие строки индекса со сходством (Жаккар), самые похожие первыми"""
+        shingles = self._shingles(text)
+        found = {text} if text in self.shingles else set()
+        for key in self._band_keys(shingles):
+            found |= self.buckets.get(key, set())
+
+        scored = []
+        for candidate in found:
+            other = self.shingles[candidate]
+            scored.append((candidate, len(shingles & other) / len(shingles | other)))
+        return sorted(scored, key=lambda item: (-item[1], item[0]))
+
+    def query(self, text: str) -> tuple[Optional[str], float]:
+        """Самая похожая строка индекса и её сходство"""
+        if text in self.shingles:
+            return text, 1.0
+        ranked = self.candidates(text)
+        return ranked[0] if ranked else (None, 0.0)
+
+
+IDEA_TITLE_RE = re.compile(r"Идея\s*#?\d+\s*[:.—-]\s*(.+)")
+
+def report_idea_titles(result: str) -> list[str]:
+    """Названия идей: из JSON-отчёта или из заголовков «Идея #N: ...» свободного текста"""
+    report = try_parse_report(result)
+    if report:
+        return [idea.title for idea in report.ideas]
+    return [match.group(1).strip(" *_`") for match in IDEA_TITLE_RE.finditer(result)]
+
+
+class ReportSearchIndex:
+    """
+    Префиксный индекс слов для поиска отчётов: слово → ключи отчётов.
+
+    Слова хранятся ещё и отсортированным списком: все слова с префиксом «фит»
+    находятся бинарным поиском, без перебора словаря.
+    """
+
+    def __init__(self):
+        self.postings: dict[str, set[tuple]] = {}
+        self.words: list[str] = []
+        self.entries: dict[tuple, tuple[set[str], float]] = {}  # ключ → (слова, created_at)
+
+    def add(self, key: tuple, texts: list[str], created_at: float):
+        self.remove(key)
+        words = {word for text in texts for word in normalize_custom_text(text).split() if len(word) > 1}
+        self.entries[key] = (words, created_at)
+        for word in words:
+            if word not in self.postings:
+                self.postings[word] = set()
+                insort(self.words, word)
+            self.postings[word].add(key)
+
+    def remove(self, key: tuple):
+        words, _ = self.entries.pop(key, (set(), 0.0))
+        for word in words:
+            keys = self.postings[word]
+            keys.discard(key)
+            if not keys:
+                del self.postings[word]
+                del self.words[bisect_left(self.words, word)]
+
+    def _with_prefix(self, prefix: str) -> set[tuple]:
+        found: set[tuple] = set()
+        i = bisect_left(self.words, prefix)
+        while i < len(self.words) and self.words[i].startswith(prefix):
+            found |= self.postings[self.words[i]]
+            i += 1
+        return found
+
+    def search(self, query: str, created_after: float) -> list[tuple]:
+        """Ключи отчётов, где каждое слово запроса — префикс какого-то слова; новые первыми"""
+        prefixes = normalize_custom_text(query).split()
+        keys = set(self.entries) if not prefixes else None
+        for prefix in prefixes:
+            found = self._with_prefix(prefix)
+            keys = found if keys is None else keys & found
+            if not keys:
+                return []
+        for key in [key for key in keys if self.entries[key][1] <= created_after]:
+            # Отчёт устарел и удалён из кэша
+            self.remove(key)
+            keys.discard(key)
+        return sorted(keys, key=lambda k: self.entries[k][1], reverse=True)
+
+
+@dataclass
+class SearchHit:
+    """Отчёт из кэша для инлайн-ответа"""
+    niche_display: str
+    budget: str
+    market_display: str
+    ideas_count: int
+    titles: list[str]
+    result: str
+    parts: list[str]
+
+
+def session_keys(session: UserSession) -> tuple[str, str]:
+    """Ключи ниши и рынка: код пресета или custom:<нормализованный текст>"""
+    niche_key = session.niche if session.niche != "custom" else f"custom:{normalize_custom_text(session.niche_display or '')}"
+    market_key = session.market if session.market != "custom" else f"custom:{normalize_custom_text(session.market_display or '')}"
+    return niche_key, market_key
+
+
+@dataclass
+class CacheStats:
+    """Счётчики для подбора SIMILARITY_THRESHOLD"""
+    lookups: int = 0
+    exact_hits: int = 0
+    similar_hits: int = 0
+    misses: int = 0
+    preset_matches: int = 0
+    # Пользователь нажал «Сгенерировать ещё» сразу после похожего попадания — вероятно, ложное
+    similar_rejected: int = 0
+    # Распределение лучшего сходства по свободному вводу (корзины по 0.1)
+    score_histogram: dict[str, int] = field(default_factory=dict)
+
+    def record_score(self, score: float):
+        bucket = f"{min(int(score * 10), 9) / 10:.1f}"
+        self.score_histogram[bucket] = self.score_histogram.get(bucket, 0) + 1
+
+
+@dataclass
+class CachedReport:
+    """Готовый отчёт из кэша"""
+    result: str
+    parts: list[str]
+    # Попадание по похожести: исходный ввод чужой, пользователю его не показываем
+    similar: bool = False
+
+
+class ReportCache(SQLiteStore):
+    """
+    Общий кэш отчётов по параметрам генерации.
+
+    Предустановленные ниши/рынки сравниваются по коду, свободный ввод — по
+    нормализованному тексту с поиском похожих в MinHashIndex: запрос в пределах
+    SIMILARITY_THRESHOLD получает уже готовый отчёт.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS report_cache (
+                niche_key TEXT NOT NULL,
+                budget TEXT NOT NULL,
+                market_key TEXT NOT NULL,
+                ideas_count INTEGER NOT NULL,
+                report_format TEXT NOT NULL,
+                niche_display TEXT NOT NULL,
+                market_display TEXT NOT NULL,
+                result BLOB NOT NULL,
+                parts BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (niche_key, budget, market_key, ideas_count, report_format)
+            )"""
+        )
+        # Для очистки устаревших и проверки, остались ли ещё отчёты с этим рынком
+        self.conn.execute("CREATE INDEX IF NOT EXISTS report_cache_created_at ON report_cache (created_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS report_cache_market ON report_cache (market_key)")
+        self.stats = CacheStats()
+        # user_id → время последнего попадания по похожести (для similar_rejected)
+        self.recent_similar_hits: dict[int, float] = {}
+        self.niche_index = MinHashIndex()
+        self.market_index = MinHashIndex()
+        self.preset_niches = self._build_preset_index(NICHES)
+        self.preset_markets = self._build_preset_index(MARKETS)
+        # Индекс инлайн-поиска строится при первом запросе — воркерам и пакетной генерации он не нужен
+        self.search_index: Optional[ReportSearchIndex] = None
+        self.prune_expired()
+        for niche_key, market_key in self.conn.execute("SELECT niche_key, market_key FROM report_cache"):
+            self._index_key(self.niche_index, niche_key)
+            self._index_key(self.market_index, market_key)
+
+    @staticmethod
+    def _searchable(niche_key: str, market_key: str) -> bool:
+        """В общий поиск попадают только отчёты по предустановленным нише и рынку — свободный ввод приватен"""
+        return not niche_key.startswith("custom:") and not market_key.startswith("custom:")
+
+    def _build_search_index(self) -> ReportSearchIndex:
+        index = ReportSearchIndex()
+        rows = self.conn.execute(
+            "SELECT niche_key, budget, market_key, ideas_count, report_format, niche_display, market_display, "
+            "result, created_at FROM report_cache WHERE niche_key NOT LIKE 'custom:%' AND market_key NOT LIKE 'custom:%'"
+        )
+        for niche_key, budget, market_key, ideas_count, report_format, niche_display, market_display, result, created_at in rows:
+            index.add(
+                (niche_key, budget, market_key, ideas_count, report_format),
+                [niche_display, market_display, *report_idea_titles(zlib.decompress(result).decode("utf-8"))],
+                created_at
+            )
+        return index
+
+    @staticmethod
+    def _build_preset_index(presets: list[tuple[str, str]]) -> tuple[MinHashIndex, dict[str, tuple[str, str]]]:
+        index, by_text = MinHashIndex(), {}
+        for display, code in presets:
+            if code == "custom":
+                continue
+            text = normalize_custom_text(display)
+            index.add(text)
+            by_text[text] = (display, code)
+        return index, by_text
+
+    @staticmethod
+    def _index_key(index: MinHashIndex, key: str):
+        if key.startswith("custom:"):
+            index.add(key.removeprefix("custom:"))
+
+    def match_preset(self, text: str, kind: str) -> Optional[tuple[str, str]]:
+        """Предустановленная ниша/рынок (display, code), на которую похож ввод"""
+        index, by_text = self.preset_niches if kind == "niche" else self.preset_markets
+        best, score = index.query(normalize_custom_text(text))
+        if best is not None and score >= SIMILARITY_THRESHOLD:
+            self.stats.preset_matches += 1
+            return by_text[best]
+        return None
+
+    # Сколько похожих вариантов ниши и рынка перебирать при поиске отчёта
+    MAX_SIMILAR_CANDIDATES = 5
+
+    @classmethod
+    def _resolve(cls, code: Optional[str], display: Optional[str], index: MinHashIndex,
+                 stats: CacheStats) -> list[tuple[str, float]]:
+        """Ключи кэша для ниши/рынка со сходством, лучшие первыми (точный ввод — сходство 1.0)"""
+        if code != "custom":
+            return [(code or "", 1.0)]
+        text = normalize_custom_text(display or "")
+        ranked = index.candidates(text)
+        stats.record_score(ranked[0][1] if ranked else 0.0)
+        similar = [
+            (f"custom:{candidate}", score) for candidate, score in ranked[:cls.MAX_SIMILAR_CANDIDATES]
+            if score >= SIMILARITY_THRESHOLD
+        ]
+        return similar or [(f"custom:{text}", 1.0)]
+
+    def lookup(self, session: UserSession, record_stats: bool = True) -> Optional[CachedReport]:
+        """Найти готовый отчёт для параметров сессии"""
+        if REPORT_CACHE_TTL_HOURS <= 0:
+            return None
+        # Проверка без учёта в статистике (например, перед спекулятивной генерацией)
+        stats = self.stats if record_stats else CacheStats()
+        stats.lookups += 1
+        niches = self._resolve(session.niche, session.niche_display, self.niche_index, stats)
+        markets = self._resolve(session.market, session.market_display, self.market_index, stats)
+        # Самой похожей пары может не быть для этого бюджета/формата — проверяем все по убыванию сходства
+        pairs = sorted(
+            ((niche_key, market_key, niche_score * market_score)
+             for niche_key, niche_score in niches for market_key, market_score in markets),
+            key=lambda pair: -pair[2]
+        )
+        created_after = time.time() - REPORT_CACHE_TTL_HOURS * 3600
+        for niche_key, market_key, _ in pairs:
+            row = self.conn.execute(
+                "SELECT result, parts FROM report_cache "
+                "WHERE niche_key = ? AND budget = ? AND market_key = ? AND ideas_count = ? AND report_format = ? "
+                "AND created_at > ?",
+                (niche_key, session.budget, market_key, session.ideas_count, session.report_format, created_after)
+            ).fetchone()
+            if row is None:
+                continue
+            similar = (niche_key, market_key) != session_keys(session)
+            if similar:
+                stats.similar_hits += 1
+            else:
+                stats.exact_hits += 1
+            return CachedReport(
+                zlib.decompress(row[0]).decode("utf-8"),
+                json.loads(zlib.decompress(row[1])),
+                similar
+            )
+        stats.misses += 1
+        return None
+
+    def add(self, session: UserSession, result: str, parts: list[str]):
+        """Сохранить свежий отчёт"""
+        if REPORT_CACHE_TTL_HOURS <= 0:
+            return
+        niche_key, market_key = session_keys(session)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO report_cache (niche_key, budget, market_key, ideas_count, report_format, "
+            "niche_display, market_display, result, parts, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                niche_key, session.budget, market_key, session.ideas_count, session.report_format,
+                session.niche_display or "", session.market_display or "",
+                zlib.compress(result.encode("utf-8")),
+                zlib.compress(json.dumps(parts, ensure_ascii=False).encode("utf-8")),
+                time.time()
+            )
+        )
+        self._index_key(self.niche_index, niche_key)
+        self._index_key(self.market_index, market_key)
+        if self.search_index is not None and self._searchable(niche_key, market_key):
+            self.search_index.add(
+                (niche_key, session.budget, market_key, session.ideas_count, session.report_format),
+                [session.niche_display or "", session.market_display or "", *report_idea_titles(result)],
+                time.time()
+            )
+        self.prune_expired()
+
+    def note_similar_hit(self, user_id: int):
+        """Запомнить, что пользователь получил отчёт по похожему запросу"""
+        now = time.time()
+        self.recent_similar_hits = {
+            uid: ts for uid, ts in self.recent_similar_hits.items() if now - ts < SIMILAR_REJECT_WINDOW
+        }
+        self.recent_similar_hits[user_id] = now
+
+    def note_regenerate(self, user_id: int):
+        """Повторная генерация сразу после похожего попадания считается отказом от него"""
+        ts = self.recent_similar_hits.pop(user_id, None)
+        if ts is not None and time.time() - ts < SIMILAR_REJECT_WINDOW:
+            self.stats.similar_rejected += 1
+
+    def search(self, query: str, offset: int, limit: int) -> tuple[list[SearchHit], bool]:
+        """Страница готовых отчётов по предустановленным нишам и рынкам (без вызовов LLM); (отчёты, есть ли ещё)"""
+        if REPORT_CACHE_TTL_HOURS <= 0:
+            return [], False
+        if self.search_index is None:
+            self.search_index = self._build_search_index()
+        keys = self.search_index.search(query, time.time() - REPORT_CACHE_TTL_HOURS * 3600)
+        hits = []
+        for key in keys[offset:offset + limit]:
+            row = self.conn.execute(
+                "SELECT niche_display, market_display, result, parts FROM report_cache "
+                "WHERE niche_key = ? AND budget = ? AND market_key = ? AND ideas_count = ? AND report_format = ?",
+                key
+            ).fetchone()
+            if row is None:
+                continue
+            result = zlib.decompress(row[2]).decode("utf-8")
+            hits.append(SearchHit(
+                row[0], key[1], row[1], key[3], report_idea_titles(result), result, json.loads(zlib.decompress(row[3]))
+            ))
+        return hits, len(keys) > offset + limit
+
+    def prune_expired(self):
+        """Удалить устаревшие отчёты — из таблицы и из индексов в памяти"""
+        removed = self.conn.execute(
+            "DELETE FROM report_cache WHERE created_at < ? "
+            "RETURNING niche_key, budget, market_key, ideas_count, report_format",
+            (time.time() - max(REPORT_CACHE_TTL_HOURS, 0) * 3600,)
+        ).fetchall()
+        if self.search_index is not None:
+            for key in removed:
+                self.search_index.remove(key)
+        # Строку убираем из MinHash-индекса, только когда на неё не осталось ни одного отчёта
+        for column, position, index in (("niche_key", 0, self.niche_index), ("market_key", 2, self.market_index)):
+            for value in {key[position] for key in removed if key[position].startswith("custom:")}:
+                still_used = self.conn.execute(
+                    f"SELECT 1 FROM report_cache WHERE {column} = ? LIMIT 1", (value,)
+                ).fetchone()
+                if not still_used:
+                    index.remove(value.removeprefix("custom:"))
+
+# ============== УЧЁТ ТОКЕНОВ ==============
+
+@dataclass
+class UsageTotals:
+    """Сумма вызовов LLM в одном срезе"""
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency: float = 0.0  # суммарная, секунды
+
+    def merge(self, other: "UsageTotals"):
+        self.calls += other.calls
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.latency += other.latency
+
+
+class UsageLedger(SQLiteStore):
+    """
+    Учёт токенов и задержки каждого вызова LLM.
+
+    Вызовы суммируются в памяти по срезу (день, пользователь, назначение, ниша, бюджет,
+    рынок, ideas_count, report_format, статус) и раз в USAGE_FLUSH_INTERVAL прибавляются к
+    таблице DATA_DIR/usage.db — общей для бота, воркеров и пакетной генерации.
+    Статус: ok — ответ получен, error — все бэкенды отказали, cancelled — вызов прерван.
+    """
+
+    SLICE_COLUMNS = (
+        "day", "user_id", "purpose", "niche_key", "budget", "market_key", "ideas_count", "report_format", "status"
+    )
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(usage)")}
+        if columns and "status" not in columns:
+            # Статус входит в первичный ключ — таблицу со старым ключом пересобираем
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("ALTER TABLE usage RENAME TO usage_old")
+                self._create_table()
+                self.conn.execute(
+                    "INSERT INTO usage SELECT day, user_id, purpose, niche_key, budget, market_key, ideas_count, "
+                    "report_format, 'ok', calls, prompt_tokens, completion_tokens, latency FROM usage_old"
+                )
+                self.conn.execute("DROP TABLE usage_old")
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        self._create_table()
+        self.pending: dict[tuple, UsageTotals] = {}
+        # record() — из event loop, flush() — из потока хранилища
+        self.pending_lock = threading.Lock()
+
+    def _create_table(self):
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS usage (
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                purpose TEXT NOT NULL,
+                niche_key TEXT NOT NULL,
+                budget TEXT NOT NULL,
+                market_key TEXT NOT NULL,
+                ideas_count INTEGER NOT NULL,
+                report_format TEXT NOT NULL,
+                status TEXT NOT NULL,
+                calls INTEGER NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                latency REAL NOT NULL,
+                PRIMARY KEY (day, user_id, purpose, niche_key, budget, market_key, ideas_count, report_format, status)
+            )"""
+        )
+
+    def record(self, user_id: int, purpose: str, session: UserSession, completion: Completion, status: str = "ok"):
+        """
+        Учесть вызов (purpose: report — полный отчёт, section — частичная перегенерация,
+        speculative — спекулятивная генерация; status: ok, error, cancelled)
+        """
+        niche_key, market_key = session_keys(session)
+        key = (
+            time.strftime("%Y-%m-%d"), user_id, purpose, niche_key, session.budget or "",
+            market_key, session.ideas_count, session.report_format, status
+        )
+        with self.pending_lock:
+            self.pending.setdefault(key, UsageTotals()).merge(
+                UsageTotals(1, completion.prompt_tokens, completion.completion_tokens, completion.latency)
+            )
+
+    def flush(self):
+        """Прибавить накопленное к usage.db"""
+        with self.pending_lock:
+            if not self.pending:
+                return
+        # Накопленное забираем только после начала транзакции: если база занята (SQLITE_BUSY),
+        # счётчики остаются в pending и уходят при повторе _with_retry или следующем сбросе
+        self.conn.execute("BEGIN IMMEDIATE")
+        with self.pending_lock:
+            pending, self.pending = self.pending, {}
+        try:
+            self.conn.executemany(
+                f"INSERT INTO usage ({', '.join(self.SLICE_COLUMNS)}, calls, prompt_tokens, completion_tokens, latency) "
+                f"VALUES ({', '.join('?' * (len(self.SLICE_COLUMNS) + 4))}) "
+                f"ON CONFLICT ({', '.join(self.SLICE_COLUMNS)}) DO UPDATE SET "
+                "calls = calls + excluded.calls, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "latency = latency + excluded.latency",
+                [
+                    (*key, totals.calls, totals.prompt_tokens, totals.completion_tokens, totals.latency)
+                    for key, totals in pending.items()
+                ]
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            # Вернуть несохранённое — прибавится при следующем сбросе
+            with self.pending_lock:
+                for key, totals in pending.items():
+                    self.pending.setdefault(key, UsageTotals()).merge(totals)
+            raise
+
+    def top(self, group_by: tuple[str, ...], since_day: str, limit: int = 10) -> list[tuple]:
+        """Срезы с наибольшим расходом токенов: (*group_by, calls, tokens, avg_latency)"""
+        columns = ", ".join(group_by)
+        return self.conn.execute(
+            f"SELECT {columns}, SUM(calls), SUM(prompt_tokens + completion_tokens), SUM(latency) / SUM(calls) "
+            f"FROM usage WHERE day >= ? GROUP BY {columns} "
+            "ORDER BY SUM(prompt_tokens + completion_tokens) DESC LIMIT ?",
+            (since_day, limit)
+        ).fetchall()
+
+    def totals(self, since_day: str, purpose: Optional[str] = None) -> tuple[int, int, int]:
+        """(вызовов, prompt-токенов, completion-токенов) с since_day, при purpose — только этого назначения"""
+        return self.conn.execute(
+            "SELECT COALESCE(SUM(calls), 0), COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0) "
+            "FROM usage WHERE day >= ? AND (? IS NULL OR purpose = ?)",
+            (since_day, purpose, purpose)
+        ).fetchone()
+
+async def usage_flush_loop():
+    """Периодически сбрасывать учёт токенов на диск"""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        try:
+            await usage_ledger.run(usage_ledger.flush)
+        except sqlite3.Error as e:
+            logger.error("Usage flush failed: %s", e)
+
+# ============== РЕЕСТР ГЕНЕРАЦИЙ ==============
+
+class GenerationRegistry:
+    """
+    Вызовы LLM, выполняющиеся в этом процессе: job_id → (user_id, task).
+
+    Отменённая задача удаляется из очереди; её вызов прерывается сразу, если он
+    в этом процессе, или cancellation_watcher'ом процесса воркера.
+    """
+
+    def __init__(self):
+        self.tasks: dict[int, tuple[int, asyncio.Task]] = {}
+
+    def register(self, job: GenerationJob, task: asyncio.Task):
+        self.tasks[job.job_id] = (job.user_id, task)
+        task.add_done_callback(lambda _: self.tasks.pop(job.job_id, None))
+
+    def running_ids(self) -> list[int]:
+        return list(self.tasks)
+
+    def for_user(self, user_id: int) -> list[int]:
+        """Задачи пользователя, которые сейчас генерируются"""
+        return [job_id for job_id, (owner, _) in self.tasks.items() if owner == user_id]
+
+    def cancel(self, job_ids) -> int:
+        """Прервать вызовы LLM; возвращает, сколько было прервано"""
+        cancelled = 0
+        for job_id in job_ids:
+            entry = self.tasks.get(job_id)
+            if entry and entry[1].cancel():
+                cancelled += 1
+        return cancelled
+
+# ============== ЛИМИТЫ ЗАПРОСОВ ==============
+
+def parse_rate(value: str) -> Optional[tuple[float, float]]:
+    """«6/600» → (ёмкость, период в секундах); None — без лимита"""
+    if not value or value.strip() == "0":
+        return None
+    capacity, _, period = value.partition("/")
+    try:
+        rate = float(capacity), float(period or 1)
+    except ValueError:
+        raise ValueError(f"Некорректный лимит {value!r}: ожидается «N/секунд»")
+    return rate if rate[0] > 0 and rate[1] > 0 else None
+
+
+class TokenBuckets:
+    """
+    Token bucket на ключ: ёмкость N, пополнение N за период.
+
+    O(1) на проверку: хранится только (токены, время обновления). В памяти держится
+    не больше max_keys ключей — давно не активные вытесняются (их корзины и так полны).
+    """
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self.buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    def _load(self, key: str) -> Optional[tuple[float, float]]:
+        state = self.buckets.get(key)
+        if state is not None:
+            self.buckets.move_to_end(key)
+        return state
+
+    def _store(self, key: str, tokens: float, updated_at: float, full_at: float):
+        self.buckets[key] = (tokens, updated_at)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+
+    async def acquire(self, limits: list[tuple[str, tuple[float, float]]]) -> float:
+        """take() из event loop"""
+        return self.take(limits)
+
+    def take(self, limits: list[tuple[str, tuple[float, float]]]) -> float:
+        """
+        Взять по токену из каждой корзины — либо ни из одной.
+
+        Возвращает 0, если запрос разрешён, иначе через сколько секунд появится токен.
+        """
+        now = time.time()
+        available = {}
+        wait = 0.0
+        for key, (capacity, period) in limits:
+            tokens, updated_at = self._load(key) or (capacity, now)
+            tokens = min(capacity, tokens + (now - updated_at) * capacity / period)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) * period / capacity)
+            available[key] = (tokens, capacity, period)
+        if wait:
+            return wait
+        for key, (tokens, capacity, period) in available.items():
+            # full_at — когда корзина снова заполнится и её можно забыть
+            self._store(key, tokens - 1, now, now + (capacity - tokens + 1) * period / capacity)
+        return 0.0
+
+
+class SQLiteTokenBuckets(TokenBuckets, SQLiteStore):
+    """Те же корзины в SQLite — общие для процессов с одним DATA_DIR"""
+
+    def __init__(self, path: str, max_keys: int):
+        TokenBuckets.__init__(self, max_keys)
+        SQLiteStore.__init__(self, path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, full_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS buckets_full ON buckets (full_at)")
+        self.takes = 0
+
+    def _load(self, key: str) -> Optional[tuple[float, float]]:
+        return self.conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+
+    def _store(self, key: str, tokens: float, updated_at: float, full_at: float):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)",
+            (key, tokens, updated_at, full_at)
+        )
+
+    async def acquire(self, limits: list[tuple[str, tuple[float, float]]]) -> float:
+        return await self.run(self.take, limits)
+
+    def take(self, limits: list[tuple[str, tuple[float, float]]]) -> float:
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            wait = super().take(limits)
+            if (self.takes + 1) % max(self.max_keys, 1) == 0:
+                # Полные корзины ничем не отличаются от отсутствующих
+                self.conn.execute("DELETE FROM buckets WHERE full_at < ?", (time.time(),))
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.takes += 1
+        return wait
+
+
+def quota_action(event: Message | CallbackQuery) -> str:
+    """generation — действие запускает вызов LLM, navigation — всё остальное"""
+    if isinstance(event, CallbackQuery) and event.data:
+        if event.data in ("confirm_generate", "regenerate") or event.data.startswith("partial_"):
+            return "generation"
+    return "navigation"
+
+
+def format_retry(wait: float) -> str:
+    """«через 2 мин 10 с (в 14:05)»"""
+    seconds = int(wait) + 1
+    minutes, seconds = divmod(seconds, 60)
+    delay = f"{minutes} мин {seconds} с" if minutes else f"{seconds} с"
+    return f"через {delay} (в {time.strftime('%H:%M:%S', time.localtime(time.time() + wait))})"
+
+
+class QuotaMiddleware(BaseMiddleware):
+    """
+    Лимиты частоты запросов на обработчики роутера.
+
+    У каждого пользователя своя корзина на действие (генерации и навигация), генерации
+    дополнительно ограничены общей корзиной на всех. Спекулятивные генерации берут токен
+    из своей корзины через acquire(). Администраторы лимитов не имеют.
+    Об отказе пользователь узнаёт один раз за окно ожидания — на дальнейшие отказы
+    в этом окне бот ничего не отправляет (флуд не превращается в поток ответов).
+    """
+
+    def __init__(self, buckets: TokenBuckets):
+        self.buckets = buckets
+        self.limits = {
+            "generation": parse_rate(RATE_LIMIT_GENERATION),
+            "navigation": parse_rate(RATE_LIMIT_NAVIGATION),
+            "speculation": parse_rate(RATE_LIMIT_SPECULATION),
+        }
+        self.global_generation = parse_rate(RATE_LIMIT_GLOBAL_GENERATION)
+        self.rejected: dict[str, int] = {"generation": 0, "navigation": 0, "speculation": 0}
+        # user_id → до какого момента пользователь уже предупреждён (не больше max_keys записей)
+        self.notified_until: OrderedDict[int, float] = OrderedDict()
+
+    async def acquire(self, user_id: int, action: str) -> float:
+        """Взять токен на действие (generation, navigation, speculation): 0 — можно, иначе сколько секунд ждать"""
+        if user_id in ADMIN_IDS:
+            return 0.0
+        limits = []
+        if self.limits[action]:
+            limits.append((f"{action}:{user_id}", self.limits[action]))
+        if action == "generation" and self.global_generation:
+            limits.append(("generation:*", self.global_generation))
+        wait = await self.buckets.acquire(limits) if limits else 0.0
+        if wait:
+            self.rejected[action] += 1
+        return wait
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        action = quota_action(event)
+        wait = await self.acquire(user.id, action)
+        if not wait:
+            return await handler(event, data)
+
+        now = time.time()
+        if self.notified_until.get(user.id, 0.0) > now:
+            if isinstance(event, CallbackQuery):
+                # Без текста: только остановить «часики» на кнопке
+                await event.answer()
+            return None
+
+        logger.warning("Rate limit: user %s, %s, retry in %.0fs", user.id, action, wait)
+        self.notified_until[user.id] = now + wait
+        self.notified_until.move_to_end(user.id)
+        while len(self.notified_until) > self.buckets.max_keys:
+            self.notified_until.popitem(last=False)
+        text = f"⏳ Слишком много запросов. Попробуйте {format_retry(wait)}."
+        if isinstance(event, CallbackQuery):
+            await event.answer(text, show_alert=True)
+        else:
+            await event.answer(text)
+        return None
+
+# ============== ПОВТОРНЫЕ АПДЕЙТЫ ==============
+
+class ProcessedUpdates(SQLiteStore):
+    """
+    Ограниченное множество обработанных update_id и id callback-запросов в SQLite.
+
+    После падения между обработкой и подтверждением Telegram доставит апдейт снова
+    (polling с начальным offset, повтор webhook) — повтор нельзя пускать в обработчики,
+    иначе «✅ Сгенерировать» оплатит вызов LLM второй раз.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        super().__init__(path)
+        self.max_size = max_size
+        self.conn.execute("CREATE TABLE IF NOT EXISTS processed_updates (key TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+        self.added = 0
+
+    def add_all(self, keys: list[str]) -> bool:
+        """Запомнить ключи одной транзакцией; False — хотя бы один уже был"""
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            fresh = [
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO processed_updates (key, seen_at) VALUES (?, ?)", (key, now)
+                ).rowcount > 0
+                for key in keys
+            ]
+            if (self.added + 1) % 100 == 0:
+                # rowid растёт с каждой вставкой — храним только последние max_size
+                self.conn.execute(
+                    "DELETE FROM processed_updates WHERE rowid <= (SELECT MAX(rowid) FROM processed_updates) - ?",
+                    (self.max_size,)
+                )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.added += 1
+        return all(fresh)
+
+
+class CorrelationIdMiddleware(BaseMiddleware):
+    """correlation_id апдейта: его унаследуют задачи генерации, поставленные обработчиком"""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any]
+    ) -> Any:
+        token = correlation_id.set(f"u{event.update_id}")
+        try:
+            return await handler(event, data)
+        finally:
+            correlation_id.reset(token)
+
+
+class DeduplicateUpdatesMiddleware(BaseMiddleware):
+    """
+    Отсеивает повторно доставленные апдейты до обработчиков.
+
+    Апдейт помечается обработанным до вызова обработчика: если процесс упадёт посреди
+    обработки, действие потеряется (пользователь нажмёт ещё раз), но не выполнится дважды.
+    """
+
+    def __init__(self, processed: ProcessedUpdates):
+        self.processed = processed
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any]
+    ) -> Any:
+        keys = [f"update:{event.update_id}"]
+        if event.callback_query:
+            # Один и тот же callback может прийти в апдейтах с разными id (повтор webhook)
+            keys.append(f"callback:{event.callback_query.id}")
+        if not await self.processed.run(self.processed.add_all, keys):
+            logger.warning("Dropping duplicate update %s", event.update_id)
+            await job_queue.run(job_queue.incr, "duplicate_updates")
+            if event.callback_query:
+                # Иначе кнопка «крутится» у пользователя до таймаута Telegram
+                with suppress(TelegramAPIError):
+                    await data["bot"].answer_callback_query(event.callback_query.id)
+            return None
+        return await handler(event, data)
+
+# ============== ИНИЦИАЛИЗАЦИЯ ==============
+
+storage = MemoryStorage()
+dp = Dispatcher(storage=storage)
+router = Router()
+dp.include_router(router)
+
+rate_buckets = (
+    SQLiteTokenBuckets(os.path.join(DATA_DIR, "ratelimit.db"), RATE_LIMIT_MAX_KEYS)
+    if RATE_LIMIT_SHARED else TokenBuckets(RATE_LIMIT_MAX_KEYS)
+)
+quota = QuotaMiddleware(rate_buckets)
+router.message.middleware(quota)
+router.callback_query.middleware(quota)
+
+# Хранение сессий пользователей (в памяти)
+user_sessions: dict[int, UserSession] = {}
+
+def get_session(user_id: int) -> UserSession:
+    """Получить или создать сессию пользователя"""
+    if user_id not in user_sessions:
+        user_sessions[user_id] = UserSession()
+    return user_sessions[user_id]
+
+job_queue = JobQueue(os.path.join(DATA_DIR, "generations.db"))
+processed_updates = ProcessedUpdates(os.path.join(DATA_DIR, "updates.db"), UPDATE_DEDUP_SIZE)
+dp.update.outer_middleware(CorrelationIdMiddleware())
+dp.update.outer_middleware(DeduplicateUpdatesMiddleware(processed_updates))
+report_history = ReportHistory(os.path.join(DATA_DIR, "history.db"))
+report_cache = ReportCache(os.path.join(DATA_DIR, "cache.db"))
+usage_ledger = UsageLedger(os.path.join(DATA_DIR, "usage.db"))
+
+llm_router = LLMRouter(load_backends())
+llm_client = LLMClient(llm_router, usage_ledger)
+
+# LLM-воркеры и фоновые задачи, запущенные в этом процессе
+worker_tasks: set[asyncio.Task] = set()
+background_tasks: set[asyncio.Task] = set()
+# Выставляется при остановке: воркеры перестают брать новые задачи
+draining = False
+# Выполняющиеся здесь вызовы LLM по задачам (для отмены)
+generation_registry = GenerationRegistry()
+# Будят воркеры / доставку раньше очередного опроса очереди
+queue_wakeup = asyncio.Event()
+delivery_wakeup = asyncio.Event()
+
+# ============== ПОСТОБРАБОТКА И ЗАДЕРЖКА EVENT LOOP ==============
+
+postprocess_pool: Optional[ProcessPoolExecutor] = None
+
+def _warm_up() -> None:
+    """Пустая задача, чтобы пул создал процессы сразу"""
+
+def _with_correlation(job_correlation_id: str, func, text: str, *args):
+    """Выполнить func в процессе пула с correlation_id вызывающей генерации"""
+    correlation_id.set(job_correlation_id)
+    return func(text, *args)
+
+async def start_postprocess_pool():
+    """
+    Создать пул постобработки.
+
+    Процессы создаются fork'ом сразу при запуске, до любых потоков процесса: сторожа
+    event loop, потоков хранилищ и QueueListener логов, — иначе дочерний процесс может
+    унаследовать блокировку, захваченную чужим потоком. Поэтому фоновый вывод логов
+    (setup_logging(background=True)) включается только после этой функции, а процессы
+    пула наследуют прямой вывод в stdout.
+    """
+    global postprocess_pool
+    if POSTPROCESS_WORKERS <= 0 or postprocess_pool is not None:
+        return
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    postprocess_pool = ProcessPoolExecutor(max_workers=POSTPROCESS_WORKERS, mp_context=context)
+    await asyncio.get_running_loop().run_in_executor(postprocess_pool, _warm_up)
+    logger.info("Post-processing pool started: %s processes", POSTPROCESS_WORKERS)
+
+def stop_postprocess_pool():
+    global postprocess_pool
+    if postprocess_pool is not None:
+        postprocess_pool.shutdown(wait=False, cancel_futures=True)
+        postprocess_pool = None
+
+async def postprocess(func, text: str, *args):
+    """func(text, *args) в пуле процессов для больших ответов, для маленьких — прямо здесь"""
+    if postprocess_pool is None or len(text) < POSTPROCESS_INLINE_LIMIT:
+        return func(text, *args)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            postprocess_pool, _with_correlation, correlation_id.get(), func, text, *args
+        )
+    except BrokenProcessPool:
+        # Процесс пула убит (OOM и т.п.) — дальше обрабатываем в event loop
+        logger.error("Post-processing pool is broken, falling back to inline processing")
+        stop_postprocess_pool()
+        return func(text, *args)
+
+
+class LoopLagMonitor:
+    """
+    Сторож event loop.
+
+    Корутина каждые LOOP_LAG_INTERVAL засыпает и меряет, насколько позже проснулась, —
+    это задержка планирования, которую видят все обработчики. Отдельный поток замечает,
+    что корутина не просыпается дольше LOOP_LAG_THRESHOLD, и логирует текущий стек
+    потока event loop — код, который его заблокировал.
+    """
+
+    def __init__(self, interval: float, threshold: float, max_samples: int = 4096):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples: deque[float] = deque(maxlen=max_samples)
+        self.heartbeat = time.monotonic()
+        self.reported_heartbeat = 0.0
+        self.blocked_count = 0
+        self.loop_thread_id: Optional[int] = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True).start()
+        return asyncio.create_task(self._measure())
+
+    def stop(self):
+        self.stopped.set()
+
+    async def _measure(self):
+        try:
+            while True:
+                self.heartbeat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                self.samples.append(max(time.monotonic() - self.heartbeat - self.interval, 0.0))
+        finally:
+            self.stop()
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            blocked_for = time.monotonic() - heartbeat - self.interval
+            if blocked_for < self.threshold or heartbeat == self.reported_heartbeat:
+                continue
+            # Одна запись на одну блокировку
+            self.reported_heartbeat = heartbeat
+            self.blocked_count += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(стек недоступен)"
+            logger.warning("Event loop blocked for %.2fs, current stack:\n%s", blocked_for, stack)
+
+    def percentiles(self) -> dict[str, float]:
+        """p50/p95/p99/max задержки планирования по последним замерам, секунды"""
+        samples = sorted(self.samples)
+        if not samples:
+            return {}
+
+        def quantile(q: float) -> float:
+            return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+        return {"p50": quantile(0.5), "p95": quantile(0.95), "p99": quantile(0.99), "max": samples[-1]}
+
+loop_lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_THRESHOLD)
+
+# ============== ПРОФИЛИРОВАНИЕ ==============
+
+# Одновременно идёт не больше одного снятия профиля
+profiling_lock = asyncio.Lock()
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+async def sample_event_loop(seconds: float, interval: float) -> str:
+    """
+    Сэмплирующий профиль потока event loop.
+
+    Отдельный поток раз в interval снимает стек потока loop'а — накладные расходы
+    не зависят от нагрузки, поэтому профиль можно снимать на работающем боте.
+    """
+    loop_thread_id = threading.get_ident()
+    stop = threading.Event()
+    own: Counter[str] = Counter()
+    total: Counter[str] = Counter()
+    folded: Counter[str] = Counter()
+    samples = 0
+
+    def sampler():
+        nonlocal samples
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if not stack:
+                continue
+            samples += 1
+            own[stack[0]] += 1
+            total.update(set(stack))
+            folded[";".join(reversed(stack))] += 1
+
+    thread = threading.Thread(target=sampler, name="profile-sampler", daemon=True)
+    thread.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        await asyncio.to_thread(thread.join)
+
+    def table(counter: Counter[str], limit: int) -> str:
+        return "\n".join(
+            f"{count:8d} {count / samples:7.1%}  {name}" for name, count in counter.most_common(limit)
+        )
+
+    if not samples:
+        return "Нет сэмплов\n"
+    return (
+        f"Сэмплирующий профиль event loop: {seconds:.0f} с, {samples} сэмплов по {interval * 1000:.0f} мс\n"
+        f"(select/epoll наверху стека — loop простаивает)\n\n"
+        f"== Собственное время (функция наверху стека) ==\n{table(own, 40)}\n\n"
+        f"== Общее время (функция где-то в стеке) ==\n{table(total, 40)}\n\n"
+        f"== Свёрнутые стеки (формат flamegraph.pl / speedscope) ==\n"
+        + "\n".join(f"{stack} {count}" for stack, count in folded.most_common())
+        + "\n"
+    )
+
+async def cprofile_event_loop(seconds: float) -> str:
+    """Детерминированный профиль (cProfile) всего, что выполняется в потоке event loop"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    out = io.StringIO()
+    out.write(f"cProfile event loop: {seconds:.0f} с\n\n== По суммарному времени ==\n")
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(50)
+    out.write("\n== По собственному времени ==\n")
+    pstats.Stats(profiler, stream=out).sort_stats("tottime").print_stats(30)
+    return out.getvalue()
+
+async def trace_allocations(seconds: float) -> str:
+    """
+    Топ выделений памяти за seconds (tracemalloc) и самые многочисленные типы объектов.
+
+    tracemalloc замедляет выделения, поэтому включается только на время снятия. Снимок,
+    его статистика и перепись объектов gc — секунды на большой куче, поэтому идут в потоке,
+    а не в event loop.
+    """
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start(5)
+    try:
+        await asyncio.sleep(seconds)
+        snapshot = await asyncio.to_thread(tracemalloc.take_snapshot)
+        traced, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+
+    out = io.StringIO()
+    out.write(f"tracemalloc: {seconds:.0f} с, живых выделений {traced / 1024:.0f} КБ, пик {peak / 1024:.0f} КБ\n\n")
+    out.write(await asyncio.to_thread(format_allocations, snapshot))
+    out.write(await asyncio.to_thread(gc_census))
+    out.write(f"\nСессий пользователей: {len(user_sessions)}, в FSM-хранилище: {len(storage.storage)}\n")
+    return out.getvalue()
+
+def format_allocations(snapshot: tracemalloc.Snapshot) -> str:
+    """Топ мест и стеков выделения из снимка tracemalloc"""
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    out = io.StringIO()
+    out.write("== Топ мест выделения (живые объекты) ==\n")
+    for stat in snapshot.statistics("lineno")[:30]:
+        out.write(f"{stat}\n")
+    out.write("\n== Топ стеков выделения ==\n")
+    for stat in snapshot.statistics("traceback")[:10]:
+        out.write(f"\n{stat.size / 1024:.1f} КБ в {stat.count} блоках\n")
+        out.write("\n".join(stat.traceback.format()) + "\n")
+    return out.getvalue()
+
+def gc_census() -> str:
+    """Кто преобладает в куче: сессии, строки, клавиатуры..."""
+    types = Counter(type(obj).__name__ for obj in gc.get_objects())
+    out = io.StringIO()
+    out.write("\n== Объекты, отслеживаемые gc, по типам ==\n")
+    for name, count in types.most_common(30):
+        out.write(f"{count:10d}  {name}\n")
+    return out.getvalue()
+
+# ============== LLM-ВОРКЕРЫ ==============
+
+async def wait_wakeup(event: asyncio.Event, timeout: float):
+    """Дождаться события или таймаута опроса"""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
+async def llm_worker(worker_id: str):
+    """Забирает задачи из очереди, вызывает LLM и сохраняет обработанный отчёт"""
+    while not draining:
+        try:
+            job = await job_queue.run(job_queue.claim, worker_id, JOB_LEASE_SECONDS)
+        except sqlite3.Error as e:
+            logger.error("Worker %s cannot claim a job: %s", worker_id, e)
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        if job is None:
+            await wait_wakeup(queue_wakeup, JOB_POLL_INTERVAL)
+            continue
+
+        # correlation_id задачи — только на время задачи, иначе им помечались бы опрос очереди и следующие задачи
+        token = correlation_id.set(job.correlation_id)
+        try:
+            await process_job(worker_id, job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Ошибка одной задачи не должна останавливать воркер
+            logger.exception("Worker %s failed on job %s", worker_id, job.job_id)
+            try:
+                await job_queue.run(job_queue.requeue, job.job_id, worker_id)
+            except sqlite3.Error as e:
+                # Задача вернётся в очередь по истечении аренды
+                logger.error("Job %s not requeued: %s", job.job_id, e)
+        finally:
+            correlation_id.reset(token)
+
+async def process_job(worker_id: str, job: GenerationJob):
+    """Выполнить одну задачу воркера (correlation_id задачи уже установлен): вызов LLM, постобработка, запись"""
+    logger.info("Worker %s took job %s (attempt %s)", worker_id, job.job_id, job.attempts)
+    if job.kind == "partial":
+        call = asyncio.create_task(llm_client.regenerate_section(
+            job.session,
+            job.payload["context"],
+            PARTIAL_INSTRUCTIONS[job.payload["section"]].format(index=job.payload["index"]),
+            job.user_id
+        ))
+    else:
+        # Токены спекуляций учитываются отдельно: часть из них уходит впустую
+        purpose = "speculative" if job.kind == "speculative" else "report"
+        call = asyncio.create_task(llm_client.generate_ideas(job.session, job.user_id, purpose))
+    generation_registry.register(job, call)
+
+    try:
+        completion = await call
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            # Остановка процесса — задачу продолжит другой воркер или следующий процесс
+            await job_queue.run(job_queue.release, job.job_id, worker_id)
+            raise
+        # Пользователь отменил генерацию (или спекуляцию отбросили) — HTTP-запрос к модели уже оборван
+        logger.info("Worker %s aborted cancelled job %s", worker_id, job.job_id)
+        if job.kind == "speculative":
+            # Не отмена пользователя; токены оборванного ответа неизвестны — считаем сами вызовы
+            await job_queue.run(job_queue.incr, "speculative_aborted")
+        else:
+            await job_queue.run(job_queue.incr, "cancel_aborted")
+        return
+
+    result = completion.text
+    started = time.monotonic()
+    if job.kind == "partial":
+        parts = render_partial_result(job.payload, result)
+    else:
+        parts = await postprocess(render_llm_result, result)
+    log_sampled("Job %s post-processed: %s chars -> %s parts in %.3fs",
+                job.job_id, len(result), len(parts), time.monotonic() - started)
+    if await job_queue.run(job_queue.complete, job.job_id, result, parts, completion.completion_tokens):
+        delivery_wakeup.set()
+    elif job.kind == "speculative":
+        # Спекуляцию отбросили, пока шла генерация, — токены потрачены впустую
+        await job_queue.run(job_queue.incr, "speculative_wasted_tokens", completion.completion_tokens)
+
+async def cancellation_watcher():
+    """Прерывать вызовы LLM, чьи задачи отменены (удалены из очереди) другим процессом"""
+    while True:
+        await asyncio.sleep(CANCEL_POLL_INTERVAL)
+        running = generation_registry.running_ids()
+        if running:
+            generation_registry.cancel(set(running) - await job_queue.run(job_queue.existing, running))
+
+def start_workers(count: int):
+    """Запустить count LLM-воркеров в текущем event loop"""
+    if count <= 0:
+        return
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    for i in range(count):
+        task = asyncio.create_task(llm_worker(f"{prefix}:{i}"))
+        worker_tasks.add(task)
+        task.add_done_callback(worker_tasks.discard)
+    background_tasks.add(asyncio.create_task(cancellation_watcher()))
+    background_tasks.add(asyncio.create_task(usage_flush_loop()))
+
+async def drain_workers():
+    """Остановить воркеры, дав текущим генерациям не больше DRAIN_TIMEOUT"""
+    global draining
+    draining = True
+    queue_wakeup.set()
+
+    if not worker_tasks:
+        return
+
+    try:
+        logger.info("Draining %s LLM workers (timeout %ss)", len(worker_tasks), DRAIN_TIMEOUT)
+        done, pending = await asyncio.wait(set(worker_tasks), timeout=DRAIN_TIMEOUT)
+        for task in pending:
+            # Незавершённая задача вернётся в очередь
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        logger.info("Drain finished: %s workers stopped, %s interrupted", len(done), len(pending))
+    finally:
+        await usage_ledger.run(usage_ledger.flush)
+
+async def run_worker(concurrency: int):
+    """Отдельный процесс LLM-воркеров (`python bot.py worker`)"""
+    if not llm_router.backends:
+        raise ValueError("Не настроен ни один LLM-бэкенд: укажите CEREBRAS_API_KEY или LLM_BACKENDS!")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    logger.info("Starting %s LLM workers...", concurrency)
+    await start_postprocess_pool()
+    setup_logging(background=True)
+    monitor = loop_lag_monitor.start()
+    start_workers(concurrency)
+    await stop.wait()
+    await drain_workers()
+    monitor.cancel()
+    stop_postprocess_pool()
+
+# ============== СПЕКУЛЯТИВНАЯ ГЕНЕРАЦИЯ ==============
+
+@dataclass
+class SpeculationStats:
+    """Счётчики спекулятивной генерации"""
+    started: int = 0
+    attached: int = 0  # пользователь подтвердил — генерация пригодилась
+    discarded: int = 0  # «Назад», «Отмена», смена параметров или истёк SPECULATIVE_TTL
+    skipped: int = 0  # не запущена из-за SPECULATIVE_MAX_CONCURRENT
+    rate_limited: int = 0  # не запущена: у пользователя кончились токены RATE_LIMIT_SPECULATION
+    wasted_generations: int = 0  # отброшенные задачи, которые LLM уже начал или закончил
+    # Токены отброшенных ответов — в общем счётчике speculative_wasted_tokens очереди: генерация,
+    # отброшенная на ходу, досчитывается воркером (возможно, в другом процессе), когда завершится.
+    # Если воркер успел оборвать вызов, токены неизвестны — такие вызовы в счётчике speculative_aborted
+
+
+@dataclass
+class Speculation:
+    """Генерация, запущенная до подтверждения"""
+    job_id: int
+    session: UserSession
+    started_at: float
+
+
+speculation_stats = SpeculationStats()
+# user_id → спекулятивная задача (только в процессе бота)
+speculations: dict[int, Speculation] = {}
+
+async def start_speculation(user_id: int, chat_id: int, message_id: int, session: UserSession):
+    """Начать генерацию, как только известны все параметры (до «✅ Сгенерировать»)"""
+    if not SPECULATIVE_GENERATION:
+        return
+    await discard_speculation(user_id)
+    if await report_cache.run(report_cache.lookup, session, False):
+        # Подтверждение и так будет мгновенным
+        return
+    if await job_queue.run(job_queue.count_speculative) >= SPECULATIVE_MAX_CONCURRENT:
+        speculation_stats.skipped += 1
+        return
+    # Выбор рынка — навигация, но спекуляция — настоящий вызов LLM: без токена просто не начинаем
+    if await quota.acquire(user_id, "speculation"):
+        speculation_stats.rate_limited += 1
+        return
+
+    job = await job_queue.run(job_queue.enqueue, user_id, chat_id, message_id, "speculative", replace(session))
+    speculations[user_id] = Speculation(job.job_id, job.session, time.time())
+    speculation_stats.started += 1
+    queue_wakeup.set()
+
+async def discard_speculation(user_id: int):
+    """Отменить спекулятивную генерацию пользователя, если она есть"""
+    speculation = speculations.pop(user_id, None)
+    if speculation is None:
+        return
+    speculation_stats.discarded += 1
+    discarded = await job_queue.run(job_queue.discard, speculation.job_id)
+    if discarded is None:
+        return
+    status, completion_tokens = discarded
+    if status in ("running", "done"):
+        speculation_stats.wasted_generations += 1
+    if status == "done":
+        await job_queue.run(job_queue.incr, "speculative_wasted_tokens", completion_tokens)
+
+async def attach_speculation(user_id: int, session: UserSession) -> bool:
+    """Превратить спекулятивную генерацию в обычную; False — её нет или параметры изменились"""
+    speculation = speculations.get(user_id)
+    if speculation is None:
+        return False
+    if speculation.session != session:
+        await discard_speculation(user_id)
+        return False
+
+    speculations.pop(user_id)
+    if not await job_queue.run(job_queue.promote, speculation.job_id):
+        return False
+    speculation_stats.attached += 1
+    return True
+
+async def expire_speculations():
+    """Отбросить спекуляции, которые так и не подтвердили"""
+    now = time.time()
+    for user_id, speculation in list(speculations.items()):
+        if now - speculation.started_at > SPECULATIVE_TTL:
+            await discard_speculation(user_id)
+
+
+class SpeculationMiddleware(BaseMiddleware):
+    """
+    Отбрасывает спекуляцию, как только после обработчика пользователь больше не на шаге
+    подтверждения (меню, «Назад», «Отмена», настройки, /start...) или параметры сессии
+    уже не те, с которыми она запущена.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: dict[str, Any]
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            user = data.get("event_from_user")
+            speculation = speculations.get(user.id) if user else None
+            if speculation is not None:
+                state = await data["state"].get_state() if data.get("state") else None
+                if state != IdeaGeneration.confirming.state or speculation.session != get_session(user.id):
+                    await discard_speculation(user.id)
+
+
+router.message.middleware(SpeculationMiddleware())
+router.callback_query.middleware(SpeculationMiddleware())
+
+# ============== ДОСТАВКА ==============
+
+async def finish_generation_state(bot: Bot, job: GenerationJob):
+    """Сбросить FSM-состояние generating после доставки"""
+    state = dp.fsm.get_context(bot=bot, chat_id=job.chat_id, user_id=job.user_id)
+    if await state.get_state() == IdeaGeneration.generating.state:
+        await state.clear()
+
+async def deliver_job(bot: Bot, job: GenerationJob):
+    """Отправить готовый отчёт; уже отправленные части пропускаются"""
+    token = correlation_id.set(job.correlation_id)
+    try:
+        await _deliver_job(bot, job)
+    finally:
+        correlation_id.reset(token)
+
+async def _deliver_job(bot: Bot, job: GenerationJob):
+    if job.status == "failed":
+        try:
+            await bot.edit_message_text(
+                "❌ Не удалось завершить генерацию. Попробуйте ещё раз.",
+                chat_id=job.chat_id,
+                message_id=job.status_message_id,
+                reply_markup=get_after_generation_keyboard()
+            )
+        except TelegramAPIError:
+            pass
+        await job_queue.run(job_queue.remove, job.job_id)
+        await finish_generation_state(bot, job)
+        return
+
+    if job.kind in ("regenerate", "partial") and job.delivered_parts == 0:
+        # Удаляем статус-сообщение, чтобы сохранить предыдущий результат
+        try:
+            await bot.delete_message(job.chat_id, job.status_message_id)
+        except TelegramAPIError:
+            pass
+    elif job.kind == "confirm" and job.delivered_parts == 0:
+        # Отменять больше нечего — убираем кнопку со статуса
+        try:
+            await bot.edit_message_reply_markup(chat_id=job.chat_id, message_id=job.status_message_id)
+        except TelegramAPIError:
+            pass
+
+    # Отчёт сохраняется до отправки: seq нужен для кнопок частичной перегенерации.
+    # Повторная доставка не создаёт копий (add идемпотентен по job_id).
+    report_seq, report = None, None
+    succeeded = bool(job.result) and not job.result.startswith(LLM_ERROR_PREFIX)
+    if succeeded:
+        if job.kind == "partial":
+            report_seq, report = await report_history.run(apply_partial_result, job)
+        else:
+            report_seq = await report_history.run(
+                report_history.add, job.user_id, job.job_id, job.session, job.result, "\n".join(job.parts)
+            )
+            report = try_parse_report(job.result)
+            if job.kind != "cached":
+                await report_cache.run(report_cache.add, job.session, job.result, job.parts)
+
+    compact = job.session.delivery in ("compact", "document")
+    if succeeded and job.kind != "partial" and compact and job.delivered_parts == 0:
+        # Один-два вызова API вместо сообщения на каждую часть
+        if await job_queue.run(job_queue.exists, job.job_id):
+            await deliver_compact(bot, job, report_seq, report)
+            await job_queue.run(job_queue.mark_part_delivered, job.job_id, len(job.parts))
+            job.delivered_parts = len(job.parts)
+
+    for i in range(job.delivered_parts, len(job.parts)):
+        if not await job_queue.run(job_queue.exists, job.job_id):
+            # Пользователь отменил генерацию, пока отчёт отправлялся
+            logger.info("Job %s cancelled during delivery after %s parts", job.job_id, i)
+            return
+        keyboard = None
+        if i == len(job.parts) - 1:
+            keyboard = get_after_generation_keyboard(report_seq, len(report.ideas) if report else 0)
+        try:
+            await bot.send_message(job.chat_id, job.parts[i], reply_markup=keyboard, parse_mode=ParseMode.HTML)
+        except TelegramForbiddenError as e:
+            # Бот заблокирован — повтор не поможет, пропускаем часть
+            logger.error("Job %s part %s not delivered: %s", job.job_id, i, e)
+        except TelegramBadRequest as e:
+            # Битый HTML от модели — та же часть простым текстом, чтобы пользователь её не потерял
+            logger.warning("Job %s part %s rejected, resending as plain text: %s", job.job_id, i, e)
+            try:
+                await bot.send_message(job.chat_id, strip_html(job.parts[i]), reply_markup=keyboard, parse_mode=None)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                logger.error("Job %s part %s not delivered: %s", job.job_id, i, e)
+        await job_queue.run(job_queue.mark_part_delivered, job.job_id, i + 1)
+        log_sampled("Job %s sent part %s/%s", job.job_id, i + 1, len(job.parts))
+
+    await job_queue.run(job_queue.remove, job.job_id)
+    logger.info("Job %s delivered: %s parts, %.1fs since enqueue",
+                job.job_id, len(job.parts), time.time() - job.created_at)
+    await finish_generation_state(bot, job)
+
+async def deliver_compact(bot: Bot, job: GenerationJob, report_seq: Optional[int], report: Optional[Report]):
+    """Отчёт одним сообщением с раскрывающимися секциями или HTML-файлом с кратким описанием"""
+    keyboard = get_after_generation_keyboard(report_seq, len(report.ideas) if report else 0)
+    if job.session.delivery == "compact":
+        text = render_compact_message(job.parts, report)
+        if text:
+            try:
+                await bot.send_message(job.chat_id, text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+                return
+            except TelegramForbiddenError as e:
+                # Бот заблокирован — файл тоже не дойдёт; задача всё равно считается доставленной
+                logger.error("Job %s compact message not delivered: %s", job.job_id, e)
+                return
+            except TelegramBadRequest as e:
+                # Разметка, которую нельзя вложить в цитату, — отправим файлом
+                logger.warning("Compact message for job %s rejected: %s", job.job_id, e)
+
+    try:
+        await bot.send_document(
+            job.chat_id,
+            BufferedInputFile(render_report_document(job.session, job.parts), filename=f"report_{report_seq or job.job_id}.html"),
+            caption=render_report_summary(job.session, report),
+            reply_markup=keyboard,
+            parse_mode=ParseMode.HTML
+        )
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        logger.error("Job %s document not delivered: %s", job.job_id, e)
+
+def apply_partial_result(job: GenerationJob) -> tuple[Optional[int], Optional[Report]]:
+    """Вклеить перегенерированную секцию в сохранённый отчёт (в потоке report_history)"""
+    seq = job.payload["seq"]
+    entry = report_history.get_entry(job.user_id, seq)
+    if entry is None:
+        return None, None
+    try:
+        report = parse_report_json(entry[1])
+        value = parse_report_section(job.payload["section"], job.result)
+    except ValueError:
+        return None, None
+
+    report = splice_report(report, job.payload["section"], job.payload["index"], value)
+    report_history.update_report(
+        job.user_id, seq, json.dumps(asdict(report), ensure_ascii=False),
+        "\n\n".join(render_report_sections(report))
+    )
+    return seq, report
+
+async def delivery_loop(bot: Bot):
+    """Доставка готовых отчётов из очереди"""
+    while True:
+        try:
+            jobs = await job_queue.run(job_queue.ready_for_delivery)
+        except sqlite3.Error as e:
+            logger.error("Delivery queue unavailable: %s", e)
+            jobs = []
+        for job in jobs:
+            try:
+                await deliver_job(bot, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Сетевые ошибки и т.п. — повторим на следующем проходе
+                logger.error("Delivery of job %s failed: %s", job.job_id, e)
+        await expire_speculations()
+        await wait_wakeup(delivery_wakeup, DELIVERY_POLL_INTERVAL)
+
+async def announce_resumed_jobs(bot: Bot, started_at: float):
+    """
+    Обновить статус-сообщения генераций, прерванных предыдущим процессом.
+    Готовые и частично доставленные задачи не трогаем — их сообщение уже не статус, их доставит delivery_loop.
+    """
+    for job in await job_queue.run(job_queue.unstarted_deliveries, started_at):
+        logger.info("Resuming job %s for user %s", job.job_id, job.user_id)
+        try:
+            await bot.edit_message_text(
+                "⏳ <b>Генерирую идеи...</b>\n\n"
+                "Бот был перезапущен, генерация продолжается — отчёт придёт сюда же.",
+                chat_id=job.chat_id,
+                message_id=job.status_message_id,
+                reply_markup=get_generation_status_keyboard(),
+                parse_mode=ParseMode.HTML
+            )
+        except TelegramAPIError:
+            pass
+
+async def on_startup(bot: Bot):
+    """Хук запуска диспетчера"""
+    # Пул — до первых потоков процесса (в том числе потоков хранилищ)
+    if LLM_WORKERS > 0:
+        await start_postprocess_pool()
+    setup_logging(background=True)
+    # Спекуляции прошлого процесса уже некому подтвердить
+    await job_queue.run(job_queue.drop_speculative)
+    background_tasks.add(loop_lag_monitor.start())
+    await announce_resumed_jobs(bot, time.time())
+    start_workers(LLM_WORKERS)
+    task = asyncio.create_task(delivery_loop(bot))
+    background_tasks.add(task)
+
+async def on_shutdown(bot: Bot):
+    """Хук остановки: дожидаемся воркеров и доставляем то, что успело сгенерироваться"""
+    await drain_workers()
+    stop_postprocess_pool()
+    for task in background_tasks:
+        task.cancel()
+    for job in await job_queue.run(job_queue.ready_for_delivery):
+        try:
+            await deliver_job(bot, job)
+        except Exception as e:
+            logger.error("Delivery of job %s failed: %s", job.job_id, e)
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+# ============== ОБРАБОТЧИКИ ==============
+
+@router.message(Command("start"))
+async def cmd_start(message: Message, state: FSMContext):
+    """Команда /start"""
+    await state.clear()
+    
+    welcome_text = """👋 <b>Привет! Я AI-генератор идей для digital-продуктов.</b>
+
+Я помогу тебе:
+• Найти перспективную идею для приложения
+• Определить ключевые фичи
+• Оценить сроки и стоимость разработки
+• Продумать монетизацию
+
+Просто укажи нишу, бюджет и целевой рынок — и получи детальный отчёт с 3-5 идеями!
+
+👇 Выбери действие:"""
+    
+    await message.answer(
+        welcome_text, 
+        reply_markup=get_main_menu_keyboard(),
+        parse_mode=ParseMode.HTML
+    )
+
+@router.message(Command("help"))
+async def cmd_help(message: Message):
+    """Команда /help"""
+    help_text = """📖 **Как пользоваться ботом:**
+
+1️⃣ Нажми "🎯 Сгенерировать идеи"
+2️⃣ Выбери или введи нишу
+3️⃣ Укажи бюджет на разработку
+4️⃣ Выбери целевой рынок
+5️⃣ Подтверди и получи отчёт!
+
+**Команды:**
+/start — Главное меню
+/help — Эта справка
+/generate — Быстрый старт генерации
+/history — История отчётов
+
+**Настройки:**
+• Количество идей: 3-5
+• Формат: подробный или краткий
+
+Если есть вопросы — пиши разработчику!"""
+    
+    await message.answer(help_text, parse_mode=ParseMode.MARKDOWN)
+
+@router.message(Command("generate"))
+async def cmd_generate(message: Message, state: FSMContext):
+    """Быстрый старт генерации"""
+    await state.set_state(IdeaGeneration.waiting_niche)
+    
+    await message.answer(
+        "🎯 **Шаг 1/3: Выбери нишу**\n\nВыбери из списка или введи свою:",
+        reply_markup=get_niche_keyboard(),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+@router.message(Command("cache_stats"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_cache_stats(message: Message):
+    """Статистика кэша отчётов (только для администраторов)"""
+    stats = report_cache.stats
+    hits = stats.exact_hits + stats.similar_hits
+    hit_rate = hits / stats.lookups * 100 if stats.lookups else 0.0
+    histogram = "\n".join(
+        f"• {bucket}–{float(bucket) + 0.1:.1f}: {count}"
+        for bucket, count in sorted(stats.score_histogram.items())
+    ) or "• нет данных"
+
+    await message.answer(
+        f"📦 <b>Кэш отчётов</b>\n\n"
+        f"Запросов: {stats.lookups}\n"
+        f"Попаданий: {hits} ({hit_rate:.1f}%)\n"
+        f"• точных: {stats.exact_hits}\n"
+        f"• по похожести: {stats.similar_hits}\n"
+        f"Промахов: {stats.misses}\n"
+        f"Ввод сопоставлен с готовой нишей/рынком: {stats.preset_matches}\n"
+        f"Отказов от похожих попаданий: {stats.similar_rejected}\n\n"
+        f"<b>Лучшее сходство свободного ввода</b> (порог {SIMILARITY_THRESHOLD}):\n{histogram}",
+        parse_mode=ParseMode.HTML
+    )
+
+@router.message(Command("spec_stats"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_spec_stats(message: Message):
+    """Статистика спекулятивной генерации (только для администраторов)"""
+    stats = speculation_stats
+    counters = await job_queue.run(job_queue.counters)
+    wasted_tokens = counters.get("speculative_wasted_tokens", 0)
+    # Вызовы спекуляций идут в воркерах — их расход берётся из общего учёта токенов
+    await usage_ledger.run(usage_ledger.flush)
+    calls, prompt_tokens, completion_tokens = await usage_ledger.run(usage_ledger.totals, "", "speculative")
+    finished = stats.attached + stats.discarded
+    hit_rate = stats.attached / finished * 100 if finished else 0.0
+
+    await message.answer(
+        f"🔮 <b>Спекулятивная генерация</b> ({'включена' if SPECULATIVE_GENERATION else 'выключена'})\n\n"
+        f"Запущено: {stats.started}\n"
+        f"Подтверждено: {stats.attached} ({hit_rate:.1f}%)\n"
+        f"Отброшено: {stats.discarded}\n"
+        f"Пропущено из-за лимита: {stats.skipped}\n"
+        f"Пропущено из-за лимита пользователя: {stats.rate_limited}\n"
+        f"Впустую вызовов LLM: {stats.wasted_generations}\n"
+        f"Впустую completion-токенов: {wasted_tokens}\n"
+        f"Оборвано вызовов (токены неизвестны): {counters.get('speculative_aborted', 0)}\n\n"
+        f"Всего на спекуляции: {calls} вызовов, prompt: {prompt_tokens}, completion: {completion_tokens}",
+        parse_mode=ParseMode.HTML
+    )
+
+@router.message(Command("queue_stats"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_queue_stats(message: Message):
+    """Состояние очереди генераций и счётчики отмен (только для администраторов)"""
+    stats = await job_queue.run(job_queue.stats)
+    counters = await job_queue.run(job_queue.counters)
+    by_status = "\n".join(f"• {status}: {count}" for status, count in sorted(stats.items())) or "• пусто"
+
+    await message.answer(
+        f"📋 <b>Очередь генераций</b>\n\n{by_status}\n\n"
+        f"<b>Отмены</b>\n"
+        f"Запрошено: {counters.get('cancel_requested', 0)}\n"
+        f"Прервано вызовов LLM: {counters.get('cancel_aborted', 0)}\n"
+        f"Отброшено готовых отчётов: {counters.get('cancel_discarded', 0)}\n\n"
+        f"<b>Отказы по лимитам</b> (этот процесс)\n"
+        f"Генерации: {quota.rejected['generation']}\n"
+        f"Навигация: {quota.rejected['navigation']}\n"
+        f"Спекуляции: {quota.rejected['speculation']}\n\n"
+        f"Отброшено повторных апдейтов: {counters.get('duplicate_updates', 0)}",
+        parse_mode=ParseMode.HTML
+    )
+
+@router.message(Command("llm_stats"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_llm_stats(message: Message):
+    """Состояние LLM-бэкендов этого процесса (только для администраторов)"""
+    lines = []
+    for backend in llm_router.backends:
+        stats = llm_router.stats[backend.name]
+        latency = f"{stats.latency:.1f} с" if stats.latency is not None else "—"
+        lines.append(
+            f"<b>{html.escape(backend.name)}</b> ({html.escape(backend.model)})\n"
+            f"Задержка: {latency}, ошибки: {llm_router.error_rate(backend):.0%}\n"
+            f"В работе: {stats.in_flight}/{backend.max_concurrency}, вызовов: {stats.calls}, ошибок: {stats.errors}"
+        )
+
+    await message.answer(
+        "🧠 <b>LLM-бэкенды</b>\n\n" + ("\n\n".join(lines) or "Не настроены"),
+        parse_mode=ParseMode.HTML
+    )
+
+@router.message(Command("usage"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_usage(message: Message, command: CommandObject):
+    """Расход токенов: главные потребители и самые дорогие комбинации (только для администраторов)"""
+    days = int(command.args) if command.args and command.args.isdigit() else 7
+    since_day = time.strftime("%Y-%m-%d", time.localtime(time.time() - (days - 1) * 86400))
+    await usage_ledger.run(usage_ledger.flush)
+    calls, prompt_tokens, completion_tokens = await usage_ledger.run(usage_ledger.totals, since_day)
+    by_status = await usage_ledger.run(usage_ledger.top, ("status",), since_day)
+    top_users = await usage_ledger.run(usage_ledger.top, ("user_id",), since_day)
+    top_combinations = await usage_ledger.run(
+        usage_ledger.top, ("niche_key", "budget", "market_key", "ideas_count", "report_format"), since_day
+    )
+
+    def num(value: int) -> str:
+        return f"{value:,}".replace(",", " ")
+
+    statuses = ", ".join(f"{status}: {n}" for status, n, _, _ in by_status) or "нет данных"
+    users = "\n".join(
+        f"• {user_id or 'пакетная'}: {num(tokens)} ток. за {n} выз."
+        for user_id, n, tokens, _ in top_users
+    ) or "• нет данных"
+    combinations = "\n".join(
+        f"• {html.escape(niche)} / {budget} / {html.escape(market)} / {ideas}×{fmt}: "
+        f"{num(tokens)} ток., ~{num(tokens // n)} за вызов, {latency:.1f} с"
+        for niche, budget, market, ideas, fmt, n, tokens, latency in top_combinations
+    ) or "• нет данных"
+
+    await message.answer(
+        f"💰 <b>Расход токенов за {days} дн.</b>\n\n"
+        f"Вызовов: {calls} ({statuses}), prompt: {num(prompt_tokens)}, completion: {num(completion_tokens)}\n\n"
+        f"<b>Главные потребители</b>\n{users}\n\n"
+        f"<b>Самые дорогие комбинации</b> (ниша / бюджет / рынок / идей×формат)\n{combinations}",
+        parse_mode=ParseMode.HTML
+    )
+
+@router.message(Command("loop_stats"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_loop_stats(message: Message):
+    """Задержка event loop и пул постобработки (только для администраторов)"""
+    lag = loop_lag_monitor.percentiles()
+    lag_text = ", ".join(f"{name}: {value * 1000:.0f} мс" for name, value in lag.items()) or "нет замеров"
+    pool_text = f"{POSTPROCESS_WORKERS} процессов" if postprocess_pool else "выключен (обработка в event loop)"
+
+    await message.answer(
+        f"⏱ <b>Event loop</b>\n\n"
+        f"Задержка планирования ({len(loop_lag_monitor.samples)} замеров): {lag_text}\n"
+        f"Блокировок дольше {LOOP_LAG_THRESHOLD} с: {loop_lag_monitor.blocked_count}\n\n"
+        f"Пул постобработки: {pool_text}, ответы от {POSTPROCESS_INLINE_LIMIT} символов",
+        parse_mode=ParseMode.HTML
+    )
+
+def parse_profile_seconds(args: Optional[str], default: float) -> float:
+    """Длительность из аргумента команды, не больше PROFILE_MAX_SECONDS"""
+    for arg in (args or "").split():
+        with suppress(ValueError):
+            return min(max(float(arg), 1.0), PROFILE_MAX_SECONDS)
+    return default
+
+@router.message(Command("profile"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_profile(message: Message, command: CommandObject):
+    """CPU-профиль event loop: /profile [секунд] [cprofile] (только для администраторов)"""
+    if profiling_lock.locked():
+        await message.answer("⏳ Профиль уже снимается, дождитесь результата.")
+        return
+    seconds = parse_profile_seconds(command.args, 30)
+    deterministic = "cprofile" in (command.args or "").split()
+
+    async with profiling_lock:
+        await message.answer(f"🔬 Снимаю {'cProfile' if deterministic else 'сэмплирующий'} профиль, {seconds:.0f} с...")
+        if deterministic:
+            report = await cprofile_event_loop(seconds)
+        else:
+            report = await sample_event_loop(seconds, PROFILE_SAMPLE_INTERVAL)
+    await message.answer_document(BufferedInputFile(
+        report.encode("utf-8"), filename=f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+    ))
+
+@router.message(Command("memprofile"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_memprofile(message: Message, command: CommandObject):
+    """Топ выделений памяти: /memprofile [секунд] (только для администраторов)"""
+    if profiling_lock.locked():
+        await message.answer("⏳ Профиль уже снимается, дождитесь результата.")
+        return
+    seconds = parse_profile_seconds(command.args, 15)
+
+    async with profiling_lock:
+        await message.answer(f"🧠 Отслеживаю выделения памяти {seconds:.0f} с...")
+        report = await trace_allocations(seconds)
+    await message.answer_document(BufferedInputFile(
+        report.encode("utf-8"), filename=f"memory-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+    ))
+
+# ============== INLINE MODE ==============
+
+def parse_inline_offset(offset: str) -> tuple[str, int]:
+    """Смещение инлайн-выдачи: h<N> — по своей истории, c<N> — по общему кэшу"""
+    if offset[:1] in ("h", "c") and offset[1:].isdigit():
+        return offset[0], int(offset[1:])
+    return "h", 0
+
+def render_inline_text(hit: SearchHit, bot_username: str) -> str:
+    """Текст отправляемого отчёта; слишком длинный сокращается с пометкой, где взять полный"""
+    note = f"✂️ <i>Отчёт сокращён. Полная версия — у @{html.escape(bot_username)}</i>"
+    text = render_compact_message(hit.parts, try_parse_report(hit.result), note)
+    if text:
+        return text
+    # Не помещаются даже заголовки — начало отчёта простым текстом
+    body = strip_html("\n\n".join(hit.parts))
+    body = body[:TELEGRAM_TEXT_LIMIT - visible_length(note) - 3].rstrip() + "…"
+    return f"{html.escape(body)}\n\n{note}"
+
+@router.inline_query()
+async def inline_report_search(query: InlineQuery):
+    """
+    @bot запрос в любом чате: сначала свои отчёты из истории, затем общий кэш
+    по предустановленным нишам и рынкам. LLM не вызывается.
+    """
+    source, position = parse_inline_offset(query.offset)
+    hits: list[tuple[str, SearchHit]] = []
+    next_offset = ""
+    if source == "h":
+        own, has_more = await report_history.run(
+            report_history.search, query.from_user.id, query.query, position, INLINE_PAGE_SIZE
+        )
+        hits += [(f"h{position + i}", hit) for i, hit in enumerate(own)]
+        if has_more:
+            next_offset = f"h{position + len(own)}"
+        else:
+            source, position = "c", 0
+    if source == "c" and len(hits) < INLINE_PAGE_SIZE:
+        shared, has_more = await report_cache.run(
+            report_cache.search, query.query, position, INLINE_PAGE_SIZE - len(hits)
+        )
+        hits += [(f"c{position + i}", hit) for i, hit in enumerate(shared)]
+        if has_more:
+            next_offset = f"c{position + len(shared)}"
+
+    bot_username = (await query.bot.me()).username
+    results = []
+    for result_id, hit in hits:
+        budget_display = next((display for display, code in BUDGETS if code == hit.budget), hit.budget)
+        results.append(InlineQueryResultArticle(
+            id=f"{zlib.crc32(hit.result.encode('utf-8')):x}-{result_id}",
+            title=f"{hit.niche_display} · {hit.market_display}",
+            description=f"{budget_display} · идей: {hit.ideas_count}\n" + "; ".join(hit.titles),
+            input_message_content=InputTextMessageContent(
+                message_text=render_inline_text(hit, bot_username), parse_mode=ParseMode.HTML
+            ),
+        ))
+
+    # Выдача зависит от истории пользователя — Telegram не должен отдавать её другим
+    await query.answer(results, cache_time=60, is_personal=True, next_offset=next_offset)
+
+# ============== CALLBACK HANDLERS ==============
+
+@router.callback_query(F.data == "main_menu")
+async def cb_main_menu(callback: CallbackQuery, state: FSMContext):
+    """Возврат в главное меню"""
+    await state.clear()
+    
+    # Проверяем, есть ли сообщение после генерации (с клавиатурой after_generation)
+    # Если да - отправляем новое сообщение вместо редактирования, чтобы сохранить результат
+    try:
+        if callback.message.reply_markup and callback.message.reply_markup.inline_keyboard:
+            # Проверяем, есть ли кнопка "Сгенерировать ещё" (признак сообщения после генерации)
+            buttons_text = [btn.text for row in callback.message.reply_markup.inline_keyboard for btn in row]
+            if "🔄 Сгенерировать ещё" in buttons_text or "📚 К истории" in buttons_text:
+                # Это сообщение после генерации - отправляем новое
+                await callback.message.answer(
+                    "🏠 **Главное меню**\n\nВыбери действие:",
+                    reply_markup=get_main_menu_keyboard(),
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                await callback.answer()  # Убираем "часики" на кнопке
+                return
+    except:
+        pass
+    
+    # Обычное редактирование для других случаев
+    await callback.message.edit_text(
+        "🏠 **Главное меню**\n\nВыбери действие:",
+        reply_markup=get_main_menu_keyboard(),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+@router.callback_query(F.data == "generate")
+async def cb_generate(callback: CallbackQuery, state: FSMContext):
+    """Начало генерации"""
+    await state.set_state(IdeaGeneration.waiting_niche)
+    
+    # Проверяем, есть ли сообщение после генерации
+    try:
+        if callback.message.reply_markup and callback.message.reply_markup.inline_keyboard:
+            buttons_text = [btn.text for row in callback.message.reply_markup.inline_keyboard for btn in row]
+            if "🔄 Сгенерировать ещё" in buttons_text:
+                # Это сообщение после генерации - отправляем новое
+                await callback.message.answer(
+                    "🎯 **Шаг 1/3: Выбери нишу**\n\nВыбери из списка или введи свою:",
+                    reply_markup=get_niche_keyboard(),
+                    parse_mode=ParseMode.MARKDOWN
+                )
                 await callback.answer()
                 return
     except:
@@ -791,6 +4139,119 @@ async def cb_format_select(callback: CallbackQuery):
         parse_mode=ParseMode.MARKDOWN
     )
 
+@router.callback_query(F.data == "settings_delivery")
+async def cb_settings_delivery(callback: CallbackQuery):
+    """Настройка доставки отчёта"""
+    await callback.message.edit_text(
+        "📬 **Доставка отчёта**\n\n"
+        "• Несколькими сообщениями — подробный отчёт целиком в чате\n"
+        "• Одним сообщением — идеи свёрнуты, раскрываются по нажатию\n"
+        "• HTML-файлом — полный отчёт файлом и краткое описание",
+        reply_markup=get_delivery_keyboard(),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+@router.callback_query(F.data.startswith("delivery_"))
+async def cb_delivery_select(callback: CallbackQuery):
+    """Выбор доставки"""
+    delivery = callback.data.removeprefix("delivery_")
+    delivery_name = next((display for display, code in DELIVERY_MODES if code == delivery), None)
+    if delivery_name is None:
+        # Кнопка от старой версии бота или подделанный callback
+        await callback.answer("⚠️ Неизвестный способ доставки", show_alert=True)
+        return
+    session = get_session(callback.from_user.id)
+    session.delivery = delivery
+
+    await callback.answer(f"✅ Установлено: {delivery_name}")
+    await callback.message.edit_text(
+        "🛠 **Настройки**\n\nВыбери параметр для изменения:",
+        reply_markup=get_settings_keyboard(session),
+        parse_mode=ParseMode.MARKDOWN
+    )
+
+# ============== HISTORY ==============
+
+async def show_history_page(message: Message, user_id: int, before: Optional[int] = None,
+                            after: Optional[int] = None, edit: bool = True):
+    """Показать страницу истории отчётов"""
+    reports, has_newer, has_older = await report_history.run(
+        report_history.page, user_id, before, after, HISTORY_PAGE_SIZE
+    )
+
+    if reports:
+        text = "📚 <b>История отчётов</b>\n\nВыбери отчёт, чтобы получить его снова:"
+    else:
+        text = "📚 <b>История отчётов</b>\n\nПока пусто — сгенерируй первый отчёт!"
+
+    if edit:
+        await message.edit_text(
+            text,
+            reply_markup=get_history_keyboard(reports, has_newer, has_older),
+            parse_mode=ParseMode.HTML
+        )
+    else:
+        await message.answer(
+            text,
+            reply_markup=get_history_keyboard(reports, has_newer, has_older),
+            parse_mode=ParseMode.HTML
+        )
+
+@router.message(Command("history"))
+async def cmd_history(message: Message):
+    """Команда /history"""
+    await show_history_page(message, message.from_user.id, edit=False)
+
+@router.callback_query(F.data == "history")
+async def cb_history(callback: CallbackQuery):
+    """История отчётов"""
+    # Под отчётом из истории — отправляем новое сообщение, чтобы не затереть отчёт
+    buttons_text = []
+    if callback.message.reply_markup:
+        buttons_text = [btn.text for row in callback.message.reply_markup.inline_keyboard for btn in row]
+    edit = "📚 К истории" not in buttons_text
+
+    await show_history_page(callback.message, callback.from_user.id, edit=edit)
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("history_before_") | F.data.startswith("history_after_"))
+async def cb_history_page(callback: CallbackQuery):
+    """Листание истории"""
+    direction, seq = callback.data.removeprefix("history_").split("_")
+    if direction == "before":
+        await show_history_page(callback.message, callback.from_user.id, before=int(seq))
+    else:
+        await show_history_page(callback.message, callback.from_user.id, after=int(seq))
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("history_show_"))
+async def cb_history_show(callback: CallbackQuery):
+    """Повторная отправка отчёта из истории (без вызова LLM)"""
+    seq = int(callback.data.removeprefix("history_show_"))
+    found = await report_history.run(report_history.get_html, callback.from_user.id, seq)
+    if found is None:
+        await callback.answer("❌ Отчёт больше не хранится", show_alert=True)
+        return
+    await callback.answer()
+
+    summary, report_html = found
+    header = (
+        f"📚 <b>Отчёт #{summary.seq}</b> от {time.strftime('%d.%m.%Y', time.localtime(summary.created_at))}\n"
+        f"🎯 {html.escape(summary.niche_display)} · 💰 {html.escape(summary.budget_display)} · "
+        f"🌍 {html.escape(summary.market_display)}\n\n"
+    )
+    parts = split_long_message(header + report_html)
+
+    for i, part in enumerate(parts):
+        if i == len(parts) - 1:
+            await callback.message.answer(
+                part,
+                reply_markup=get_history_report_keyboard(),
+                parse_mode=ParseMode.HTML
+            )
+        else:
+            await callback.message.answer(part, parse_mode=ParseMode.HTML)
+
 @router.callback_query(F.data == "cancel")
 async def cb_cancel(callback: CallbackQuery, state: FSMContext):
     """Отмена"""
@@ -834,8 +4295,13 @@ async def cb_niche_select(callback: CallbackQuery, state: FSMContext):
 async def msg_custom_niche(message: Message, state: FSMContext):
     """Ввод своей ниши"""
     session = get_session(message.from_user.id)
-    session.niche = "custom"
-    session.niche_display = message.text.strip()
+    preset = report_cache.match_preset(message.text, "niche")
+    if preset:
+        # Ввод почти совпадает с готовой нишей — используем её (и её кэш)
+        session.niche_display, session.niche = preset
+    else:
+        session.niche = "custom"
+        session.niche_display = message.text.strip()
     
     await state.set_state(IdeaGeneration.waiting_budget)
     await message.answer(
@@ -898,16 +4364,22 @@ async def cb_market_select(callback: CallbackQuery, state: FSMContext):
     
     await state.set_state(IdeaGeneration.confirming)
     await show_confirmation(callback.message, session)
+    await start_speculation(callback.from_user.id, callback.message.chat.id, callback.message.message_id, session)
 
 @router.message(StateFilter(IdeaGeneration.waiting_custom_market))
 async def msg_custom_market(message: Message, state: FSMContext):
     """Ввод своего рынка"""
     session = get_session(message.from_user.id)
-    session.market = "custom"
-    session.market_display = message.text.strip()
+    preset = report_cache.match_preset(message.text, "market")
+    if preset:
+        session.market_display, session.market = preset
+    else:
+        session.market = "custom"
+        session.market_display = message.text.strip()
     
     await state.set_state(IdeaGeneration.confirming)
-    await show_confirmation(message, session, edit=False)
+    confirm_msg = await show_confirmation(message, session, edit=False)
+    await start_speculation(message.from_user.id, confirm_msg.chat.id, confirm_msg.message_id, session)
 
 @router.callback_query(F.data == "back_to_budget", StateFilter(IdeaGeneration.waiting_market))
 async def cb_back_to_budget(callback: CallbackQuery, state: FSMContext):
@@ -922,7 +4394,7 @@ async def cb_back_to_budget(callback: CallbackQuery, state: FSMContext):
 
 # ============== CONFIRMATION & GENERATION ==============
 
-async def show_confirmation(message: Message, session: UserSession, edit: bool = True):
+async def show_confirmation(message: Message, session: UserSession, edit: bool = True) -> Message:
     """Показать подтверждение"""
     confirm_text = f"""📋 **Проверь данные:**
 
@@ -934,13 +4406,13 @@ async def show_confirmation(message: Message, session: UserSession, edit: bool =
 Всё верно? Нажми "Сгенерировать" для получения отчёта."""
     
     if edit:
-        await message.edit_text(
+        return await message.edit_text(
             confirm_text,
             reply_markup=get_confirm_keyboard(),
             parse_mode=ParseMode.MARKDOWN
         )
     else:
-        await message.answer(
+        return await message.answer(
             confirm_text,
             reply_markup=get_confirm_keyboard(),
             parse_mode=ParseMode.MARKDOWN
@@ -965,31 +4437,63 @@ async def cb_confirm_generate(callback: CallbackQuery, state: FSMContext):
     session = get_session(callback.from_user.id)
     
     await state.set_state(IdeaGeneration.generating)
+
+    if await attach_speculation(callback.from_user.id, session):
+        # Генерация уже идёт (или готова) с момента выбора рынка
+        await callback.message.edit_text(
+            "⏳ **Генерирую идеи...**\n\n"
+            "Это может занять 30-60 секунд. AI анализирует нишу, рынок и формирует персонализированные рекомендации.",
+            reply_markup=get_generation_status_keyboard(),
+            parse_mode=ParseMode.MARKDOWN
+        )
+        delivery_wakeup.set()
+        return
+
+    cached = await report_cache.run(report_cache.lookup, session)
+    if cached:
+        # Такой (или очень похожий) отчёт уже есть — отдаём без вызова LLM
+        if cached.similar:
+            report_cache.note_similar_hit(callback.from_user.id)
+            status_text = (
+                "♻️ <b>Нашёл готовый отчёт по очень похожему запросу</b>\n\n"
+                "Нужны другие варианты — нажми «🔄 Сгенерировать ещё»."
+            )
+        else:
+            status_text = "♻️ <b>Готовый отчёт по этим параметрам</b>\n\nНужны другие варианты — нажми «🔄 Сгенерировать ещё»."
+        await callback.message.edit_text(status_text, parse_mode=ParseMode.HTML)
+
+        # Сразу готовой задачей: воркер не должен успеть забрать её и вызвать LLM
+        await job_queue.run(
+            job_queue.enqueue_done,
+            callback.from_user.id,
+            callback.message.chat.id,
+            callback.message.message_id,
+            "cached",
+            replace(session),
+            cached.result,
+            cached.parts
+        )
+        delivery_wakeup.set()
+        return
+
     await callback.message.edit_text(
         "⏳ **Генерирую идеи...**\n\n"
         "Это может занять 30-60 секунд. AI анализирует нишу, рынок и формирует персонализированные рекомендации.",
+        reply_markup=get_generation_status_keyboard(),
         parse_mode=ParseMode.MARKDOWN
     )
     
-    # Генерация
-    result = await llm_client.generate_ideas(session)
-    
-    # Отправляем результат (может быть длинным)
-    await state.clear()
-    
-    # Обработка и отправка результата
-    processed_result = process_ai_response(result)
-    parts = split_long_message(processed_result)
-    
-    for i, part in enumerate(parts):
-        if i == len(parts) - 1:
-            await callback.message.answer(
-                part,
-                reply_markup=get_after_generation_keyboard(),
-                parse_mode=ParseMode.HTML
-            )
-        else:
-            await callback.message.answer(part, parse_mode=ParseMode.HTML)
+    # Генерацию выполнит LLM-воркер, отчёт отправит delivery_loop.
+    # В очередь пишется снимок сессии — настройки могут поменяться.
+    await job_queue.run(
+        job_queue.enqueue,
+        callback.from_user.id,
+        callback.message.chat.id,
+        callback.message.message_id,
+        "confirm",
+        replace(session)
+    )
+    queue_wakeup.set()
 
 @router.callback_query(F.data == "regenerate")
 async def cb_regenerate(callback: CallbackQuery, state: FSMContext):
@@ -1000,6 +4504,7 @@ async def cb_regenerate(callback: CallbackQuery, state: FSMContext):
         await callback.answer("❌ Сначала введите параметры", show_alert=True)
         return
     
+    report_cache.note_regenerate(callback.from_user.id)
     await state.set_state(IdeaGeneration.generating)
     
     # Отправляем НОВОЕ сообщение о генерации вместо редактирования,
@@ -1007,31 +4512,83 @@ async def cb_regenerate(callback: CallbackQuery, state: FSMContext):
     status_msg = await callback.message.answer(
         "⏳ **Генерирую новые идеи...**\n\n"
         "Использую те же параметры, но AI сгенерирует другие варианты.",
+        reply_markup=get_generation_status_keyboard(),
         parse_mode=ParseMode.MARKDOWN
     )
     await callback.answer()  # Убираем "часики" на кнопке
     
-    result = await llm_client.generate_ideas(session)
-    await state.clear()
-    
-    # Удаляем статус-сообщение
-    try:
-        await status_msg.delete()
-    except:
-        pass
-    
-    processed_result = process_ai_response(result)
-    parts = split_long_message(processed_result)
-    
-    for i, part in enumerate(parts):
-        if i == len(parts) - 1:
-            await callback.message.answer(
-                part,
-                reply_markup=get_after_generation_keyboard(),
-                parse_mode=ParseMode.HTML
-            )
-        else:
-            await callback.message.answer(part, parse_mode=ParseMode.HTML)
+    await job_queue.run(
+        job_queue.enqueue,
+        callback.from_user.id,
+        status_msg.chat.id,
+        status_msg.message_id,
+        "regenerate",
+        replace(session)
+    )
+    queue_wakeup.set()
+
+@router.callback_query(F.data.startswith("partial_"))
+async def cb_partial_regenerate(callback: CallbackQuery):
+    """Перегенерация одной идеи или плана монетизации в готовом отчёте"""
+    _, seq, section, *rest = callback.data.split("_")
+    entry = await report_history.run(report_history.get_entry, callback.from_user.id, int(seq))
+    if entry is None:
+        await callback.answer("❌ Отчёт больше не хранится", show_alert=True)
+        return
+
+    session, raw = entry
+    report = try_parse_report(raw)
+    index = int(rest[0]) if rest else 0
+    if report is None or (section == "idea" and not 1 <= index <= len(report.ideas)):
+        await callback.answer("❌ Эту часть отчёта нельзя перегенерировать", show_alert=True)
+        return
+
+    status_text = f"⏳ <b>Заменяю идею #{index}...</b>" if section == "idea" else "⏳ <b>Подбираю другой план монетизации...</b>"
+    status_msg = await callback.message.answer(
+        status_text, reply_markup=get_generation_status_keyboard(), parse_mode=ParseMode.HTML
+    )
+    await callback.answer()
+
+    await job_queue.run(
+        job_queue.enqueue,
+        callback.from_user.id,
+        status_msg.chat.id,
+        status_msg.message_id,
+        "partial",
+        session,
+        {"seq": int(seq), "section": section, "index": index, "context": compact_report_context(report)}
+    )
+    queue_wakeup.set()
+
+@router.callback_query(F.data == "cancel_generation")
+async def cb_cancel_generation(callback: CallbackQuery, state: FSMContext):
+    """Отмена генерации по кнопке под статус-сообщением"""
+    cancelled = await job_queue.run(
+        job_queue.cancel_for_message, callback.from_user.id, callback.message.chat.id, callback.message.message_id
+    )
+    if not cancelled:
+        await callback.answer("Генерация уже завершена")
+        with suppress(TelegramAPIError):
+            await callback.message.edit_reply_markup(reply_markup=None)
+        return
+
+    job_ids = [job_id for job_id, _ in cancelled]
+    # Вызов в этом процессе прерываем сразу, в отдельных воркерах — cancellation_watcher
+    generation_registry.cancel(job_ids)
+    await job_queue.run(job_queue.incr, "cancel_requested", len(cancelled))
+    discarded = sum(1 for _, status in cancelled if status in ("done", "failed"))
+    if discarded:
+        await job_queue.run(job_queue.incr, "cancel_discarded", discarded)
+    logger.info("User %s cancelled jobs %s", callback.from_user.id, job_ids)
+
+    if await state.get_state() == IdeaGeneration.generating.state:
+        await state.clear()
+    await callback.answer()
+    await callback.message.edit_text(
+        "❌ Генерация отменена.\n\n🏠 **Главное меню**\n\nВыбери действие:",
+        reply_markup=get_main_menu_keyboard(),
+        parse_mode=ParseMode.MARKDOWN
+    )
 
 # ============== FALLBACK HANDLERS ==============
 
@@ -1071,6 +4628,163 @@ async def msg_fallback_general(message: Message, state: FSMContext):
             reply_markup=get_main_menu_keyboard()
         )
 
+# ============== ПАКЕТНАЯ ГЕНЕРАЦИЯ ==============
+
+class RateLimiter:
+    """Не больше rate запусков в секунду (равномерно)"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _preset(value: str, presets: list[tuple[str, str]]) -> tuple[str, str]:
+    """(код, отображаемое название) для кода из списка или свободного текста"""
+    for display, code in presets:
+        if value == code and code != "custom":
+            return code, display
+    return "custom", value
+
+def batch_row_to_session(row: dict) -> UserSession:
+    """Строка CSV/JSONL (niche, budget, market[, ideas_count, report_format]) → сессия"""
+    for key in ("niche", "budget", "market"):
+        if not str(row.get(key) or "").strip():
+            raise ValueError(f"не задано поле {key}")
+    niche, niche_display = _preset(str(row["niche"]).strip(), NICHES)
+    budget, budget_display = _preset(str(row["budget"]).strip(), BUDGETS)
+    market, market_display = _preset(str(row["market"]).strip(), MARKETS)
+    return UserSession(
+        niche=niche, niche_display=niche_display,
+        budget=budget, budget_display=budget_display,
+        market=market, market_display=market_display,
+        ideas_count=int(row.get("ideas_count") or 4),
+        report_format=str(row.get("report_format") or "detailed"),
+    )
+
+def read_batch_rows(path: str) -> list[dict]:
+    """Комбинации из CSV или JSONL; id строки — поле id или номер строки"""
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    for number, row in enumerate(rows, 1):
+        row["id"] = str(row.get("id") or number)
+    return rows
+
+def read_batch_checkpoint(path: str) -> set[str]:
+    """id строк, уже успешно записанных в выходной JSONL"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Строка, оборванная при прерывании, — перегенерируем
+                continue
+            if not record.get("error"):
+                done.add(str(record["id"]))
+    return done
+
+async def run_batch(input_path: str, output_path: str, concurrency: int, rate: float):
+    """Пакетная генерация отчётов с возобновлением по выходному файлу"""
+    if not llm_router.backends:
+        raise ValueError("Не настроен ни один LLM-бэкенд: укажите CEREBRAS_API_KEY или LLM_BACKENDS!")
+
+    rows = read_batch_rows(input_path)
+    done_ids = read_batch_checkpoint(output_path)
+    pending = [row for row in rows if row["id"] not in done_ids]
+    logger.info("Batch: %s rows, %s already done, %s to generate", len(rows), len(rows) - len(pending), len(pending))
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for row in pending:
+        queue.put_nowait(row)
+
+    limiter = RateLimiter(rate)
+    completed, failed = 0, 0
+    started = time.monotonic()
+
+    def log_progress():
+        elapsed = time.monotonic() - started
+        throughput = completed / elapsed * 60 if elapsed else 0.0
+        eta = (len(pending) - completed) / (completed / elapsed) if completed else 0.0
+        logger.info(
+            "Batch progress: %s/%s (%s failed), %.1f rows/min, ETA %.0f min",
+            completed, len(pending), failed, throughput, eta / 60
+        )
+
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        with open(output_path, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                # Последняя строка оборвана прерыванием — начинаем с новой
+                f.write(b"\n")
+
+    with open(output_path, "a", encoding="utf-8") as output:
+        async def batch_worker():
+            nonlocal completed, failed
+            while True:
+                try:
+                    row = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+
+                correlation_id.set(f"batch-{row['id']}")
+                record = {"id": row["id"], "niche": row.get("niche"), "budget": row.get("budget"), "market": row.get("market")}
+                try:
+                    session = batch_row_to_session(row)
+                    await limiter.wait()
+                    call_started = time.monotonic()
+                    result = (await llm_client.generate_ideas(session)).text
+                    record["latency"] = round(time.monotonic() - call_started, 2)
+                    if result.startswith(LLM_ERROR_PREFIX):
+                        record["error"] = result
+                    else:
+                        record.update(
+                            ideas_count=session.ideas_count,
+                            report_format=session.report_format,
+                            raw=result,
+                            parts=await postprocess(render_llm_result, result),
+                        )
+                except ValueError as e:
+                    record["error"] = str(e)
+
+                if "error" in record:
+                    failed += 1
+                completed += 1
+                # Строка целиком и сразу на диск — это и есть чекпоинт
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+
+        async def progress_reporter():
+            while True:
+                await asyncio.sleep(10)
+                log_progress()
+
+        await start_postprocess_pool()
+        setup_logging(background=True)
+        reporter = asyncio.create_task(progress_reporter())
+        flusher = asyncio.create_task(usage_flush_loop())
+        try:
+            await asyncio.gather(*(batch_worker() for _ in range(max(concurrency, 1))))
+        finally:
+            reporter.cancel()
+            flusher.cancel()
+            stop_postprocess_pool()
+            await usage_ledger.run(usage_ledger.flush)
+            log_progress()
+
 # ============== MAIN ==============
 
 async def main():
@@ -1080,11 +4794,36 @@ async def main():
     # Проверка конфигурации
     if not BOT_TOKEN:
         raise ValueError("BOT_TOKEN не установлен!")
-    if not CEREBRAS_API_KEY:
-        raise ValueError("CEREBRAS_API_KEY не установлен!")
+    if not llm_router.backends:
+        raise ValueError("Не настроен ни один LLM-бэкенд: укажите CEREBRAS_API_KEY или LLM_BACKENDS!")
     
     # Запуск
+    bot = Bot(token=BOT_TOKEN)
     await dp.start_polling(bot)
 
+def parse_args() -> argparse.Namespace:
+    """Аргументы командной строки"""
+    parser = argparse.ArgumentParser(description="AI-генератор идей для digital-продуктов")
+    commands = parser.add_subparsers(dest="command")
+
+    worker_parser = commands.add_parser("worker", help="LLM-воркеры очереди генераций без Telegram-бота")
+    worker_parser.add_argument(
+        "--concurrency", type=int, default=max(LLM_WORKERS, 1),
+        help="Количество параллельных генераций в процессе"
+    )
+
+    batch_parser = commands.add_parser("batch", help="Пакетная генерация отчётов из CSV/JSONL без Telegram")
+    batch_parser.add_argument("input", help="CSV или JSONL с полями niche, budget, market[, ideas_count, report_format, id]")
+    batch_parser.add_argument("output", help="JSONL с результатами (дописывается; служит чекпоинтом)")
+    batch_parser.add_argument("--concurrency", type=int, default=4, help="Параллельных запросов к LLM")
+    batch_parser.add_argument("--rate", type=float, default=1.0, help="Не больше запросов в секунду (0 — без ограничения)")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    args = parse_args()
+    if args.command == "worker":
+        asyncio.run(run_worker(args.concurrency))
+    elif args.command == "batch":
+        asyncio.run(run_batch(args.input, args.output, args.concurrency, args.rate))
+    else:
+        asyncio.run(main())
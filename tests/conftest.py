@@ -0,0 +1,117 @@
+"""Общая подготовка тестов: бот импортируется с данными во временном каталоге"""
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+# До импорта bot: хранилища создаются при импорте модуля
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.setdefault("LOG_FORMAT", "text")
+# Никаких настоящих LLM-бэкендов: тесты поднимают свои
+os.environ["CEREBRAS_API_KEY"] = ""
+os.environ["LLM_BACKENDS"] = ""
+
+import bot  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_loop_primitives(monkeypatch):
+    """Примитивы asyncio уровня модуля привязываются к первому циклу — каждому тесту свои"""
+    monkeypatch.setattr(bot, "queue_wakeup", asyncio.Event())
+    monkeypatch.setattr(bot, "delivery_wakeup", asyncio.Event())
+    monkeypatch.setattr(bot, "profiling_lock", asyncio.Lock())
+
+
+@pytest.fixture
+def make_store(tmp_path):
+    """Хранилище SQLiteStore в отдельном файле: make_store(JobQueue) или make_store(ProcessedUpdates, 10)"""
+    stores = []
+
+    def factory(cls, *args, name: str = None):
+        store = cls(str(tmp_path / (name or f"{cls.__name__.lower()}.db")), *args)
+        stores.append(store)
+        return store
+
+    yield factory
+    for store in stores:
+        store.executor.shutdown(wait=True)
+        store.conn.close()
+
+
+@pytest.fixture
+def session():
+    """Полностью заполненная сессия генерации"""
+    return bot.UserSession(
+        niche="education", niche_display="📚 Образование", budget="small", budget_display="💵 $5,000 - $15,000 (малый)",
+        market="russia_cis", market_display="🇷🇺 Россия / СНГ", ideas_count=3
+    )
+
+
+@pytest.fixture
+def stores(make_store, monkeypatch):
+    """Свежие хранилища вместо общих хранилищ модуля"""
+    for name, cls in (
+        ("job_queue", bot.JobQueue), ("report_history", bot.ReportHistory),
+        ("report_cache", bot.ReportCache), ("usage_ledger", bot.UsageLedger),
+    ):
+        monkeypatch.setattr(bot, name, make_store(cls))
+    return bot
+
+
+class RecordingBot:
+    """Заглушка Bot: запоминает вызовы API; fail(method, exc) — упасть на следующем вызове"""
+
+    id = 42
+
+    def __init__(self):
+        self.calls = []
+        self.failures = {}
+
+    def fail(self, method: str, error: Exception, times: int = 1):
+        self.failures[method] = [error] * times
+
+    def __getattr__(self, method: str):
+        async def call(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            errors = self.failures.get(method)
+            if errors:
+                raise errors.pop(0)
+            return True
+        return call
+
+    def sent(self, method: str = "send_message") -> list:
+        return [(args, kwargs) for name, args, kwargs in self.calls if name == method]
+
+
+@pytest.fixture
+def fake_bot():
+    return RecordingBot()
+
+
+@pytest.fixture
+def report_json():
+    """JSON-отчёт по схеме: report_json(ideas=3, filler=1) — filler удлиняет тексты"""
+    import json
+
+    def factory(ideas: int = 3, filler: int = 1, **overrides) -> str:
+        data = {
+            "analysis": "Рынок растёт. " * filler,
+            "ideas": [
+                {
+                    "title": f"Идея {i}",
+                    "value": f"Ценность идеи {i}. " * filler,
+                    "audience": "Студенты и преподаватели",
+                    "features": [f"Фича {i}.{j}" for j in range(1, 4)],
+                }
+                for i in range(1, ideas + 1)
+            ],
+            "timeline": {"mvp": "2 месяца", "full": "6 месяцев"},
+            "cost": {"mvp": "10000 $", "full": "40000 $"},
+            "monetization": ["Подписка", "Фримиум"],
+            "risks": ["Конкуренция", "Удержание"],
+        }
+        data.update(overrides)
+        return json.dumps(data, ensure_ascii=False)
+
+    return factory
@@ -0,0 +1,90 @@
+"""Пакетная генерация: входные файлы, чекпоинт и возобновление после прерывания"""
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+def test_rows_from_csv_and_jsonl(tmp_path):
+    csv_path = tmp_path / "rows.csv"
+    csv_path.write_text("niche,budget,market\nfintech,small,usa\neducation,large,europe\n", encoding="utf-8")
+    jsonl_path = tmp_path / "rows.jsonl"
+    jsonl_path.write_text('{"id": "a", "niche": "food", "budget": "small", "market": "usa"}\n\n', encoding="utf-8")
+
+    assert [row["id"] for row in bot.read_batch_rows(str(csv_path))] == ["1", "2"]
+    assert bot.read_batch_rows(str(jsonl_path))[0]["id"] == "a"
+
+
+def test_row_to_session():
+    session = bot.batch_row_to_session({"niche": "fintech", "budget": "small", "market": "Казахстан", "ideas_count": "3"})
+    assert (session.niche, session.niche_display) == ("fintech", "💰 Финтех")
+    assert (session.market, session.market_display) == ("custom", "Казахстан")
+    assert session.ideas_count == 3 and session.report_format == "detailed"
+    with pytest.raises(ValueError, match="budget"):
+        bot.batch_row_to_session({"niche": "fintech", "budget": " ", "market": "usa"})
+
+
+def test_checkpoint_skips_errors_and_torn_lines(tmp_path):
+    output = tmp_path / "out.jsonl"
+    output.write_text('{"id": "1", "raw": "ok"}\n{"id": "2", "error": "timeout"}\n{"id": "3", "ra', encoding="utf-8")
+    assert bot.read_batch_checkpoint(str(output)) == {"1"}
+    assert bot.read_batch_checkpoint(str(tmp_path / "missing.jsonl")) == set()
+
+
+def test_rate_limiter_spaces_starts():
+    async def scenario():
+        limiter = bot.RateLimiter(50)
+        started = time.monotonic()
+        for _ in range(6):
+            await limiter.wait()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) >= 0.09
+
+
+@pytest.fixture
+def batch(stores, monkeypatch):
+    """run_batch без настоящих бэкендов и пула; возвращает список сгенерированных ниш"""
+    monkeypatch.setattr(bot, "llm_router", SimpleNamespace(backends=["stub"]))
+    monkeypatch.setattr(bot, "POSTPROCESS_WORKERS", 0)
+    generated = []
+
+    async def generate_ideas(session, user_id=0, purpose="report"):
+        generated.append(session.niche)
+        if session.niche == "games":
+            return bot.Completion(f"{bot.LLM_ERROR_PREFIX}: все бэкенды недоступны")
+        return bot.Completion(f"**Идеи для {session.niche}**")
+
+    monkeypatch.setattr(bot.llm_client, "generate_ideas", generate_ideas)
+    yield generated
+    bot.setup_logging(background=False)
+
+
+def test_batch_resumes_after_interruption(batch, tmp_path):
+    rows = tmp_path / "rows.jsonl"
+    rows.write_text("".join(
+        json.dumps({"id": str(i), "niche": niche, "budget": "small", "market": "usa"}) + "\n"
+        for i, niche in enumerate(["fintech", "food", "games", "travel"], 1)
+    ), encoding="utf-8")
+    output = tmp_path / "out.jsonl"
+    # Прерванный прогон: первая строка готова, вторая оборвана на середине
+    output.write_text('{"id": "1", "raw": "готово"}\n{"id": "2", "ra', encoding="utf-8")
+
+    asyncio.run(bot.run_batch(str(rows), str(output), concurrency=2, rate=0))
+    assert sorted(batch) == ["food", "games", "travel"]
+
+    records = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines() if line.startswith('{"id": "')
+               and line.endswith("}")]
+    by_id = {record["id"]: record for record in records}
+    assert by_id["2"]["parts"] and "Идеи для food" in by_id["2"]["parts"][0]
+    assert by_id["3"]["error"].startswith(bot.LLM_ERROR_PREFIX)
+    assert "latency" in by_id["4"]
+
+    # Повторный запуск догенерирует только строку с ошибкой
+    batch.clear()
+    asyncio.run(bot.run_batch(str(rows), str(output), concurrency=2, rate=0))
+    assert batch == ["games"]
@@ -0,0 +1,76 @@
+"""Отмена генерации: удаление из очереди и прерывание вызова LLM в этом и в другом процессе"""
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def hanging_llm(stores, monkeypatch):
+    """Вызов LLM, который длится, пока его не прервут; возвращает список начатых задач"""
+    monkeypatch.setattr(bot, "JOB_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(bot, "draining", False)
+    started = []
+
+    async def generate_ideas(job_session, user_id=0, purpose="report"):
+        started.append(user_id)
+        if user_id == 1:
+            await asyncio.sleep(3600)
+        return bot.Completion("Идеи")
+
+    monkeypatch.setattr(bot.llm_client, "generate_ideas", generate_ideas)
+    return started
+
+
+def test_cancel_for_message_removes_only_that_generation(stores, session):
+    mine = bot.job_queue.enqueue(1, 10, 100, "confirm", session)
+    bot.job_queue.enqueue(1, 10, 101, "regenerate", session)
+    bot.job_queue.enqueue(1, 10, 100, "speculative", session)
+    bot.job_queue.enqueue(2, 10, 100, "confirm", session)
+
+    assert bot.job_queue.cancel_for_message(1, 10, 100) == [(mine.job_id, "queued")]
+    assert bot.job_queue.cancel_for_message(1, 10, 100) == []
+    assert mine.job_id not in bot.job_queue.existing([mine.job_id])
+
+
+def test_cancelled_call_is_aborted_and_worker_continues(hanging_llm, session):
+    cancelled = bot.job_queue.enqueue(1, 10, 100, "confirm", session)
+    other = bot.job_queue.enqueue(2, 20, 200, "confirm", session)
+
+    async def scenario():
+        worker = asyncio.create_task(bot.llm_worker("w1"))
+        while not bot.generation_registry.for_user(1):
+            await asyncio.sleep(0.01)
+        bot.job_queue.cancel_for_message(1, 10, 100)
+        assert bot.generation_registry.cancel([cancelled.job_id]) == 1
+        while not bot.job_queue.ready_for_delivery():
+            assert not worker.done()
+            await asyncio.sleep(0.01)
+        worker.cancel()
+
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert [job.job_id for job in bot.job_queue.ready_for_delivery()] == [other.job_id]
+    assert bot.job_queue.counters()["cancel_aborted"] == 1
+    assert bot.generation_registry.running_ids() == []
+
+
+def test_watcher_aborts_calls_cancelled_by_another_process(hanging_llm, session, monkeypatch):
+    monkeypatch.setattr(bot, "CANCEL_POLL_INTERVAL", 0.01)
+    job = bot.job_queue.enqueue(1, 10, 100, "confirm", session)
+
+    async def scenario():
+        worker = asyncio.create_task(bot.llm_worker("w1"))
+        watcher = asyncio.create_task(bot.cancellation_watcher())
+        while not bot.generation_registry.for_user(1):
+            await asyncio.sleep(0.01)
+        # Процесс бота удаляет задачу из общей очереди, реестр воркера он не видит
+        bot.job_queue.cancel_for_message(1, 10, 100)
+        while not bot.job_queue.counters().get("cancel_aborted"):
+            await asyncio.sleep(0.01)
+        worker.cancel()
+        watcher.cancel()
+
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+    assert bot.job_queue.existing([job.job_id]) == set()
+    assert bot.job_queue.ready_for_delivery() == []
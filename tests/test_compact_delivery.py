@@ -0,0 +1,104 @@
+"""Доставка отчёта одним сообщением"""
+import asyncio
+import re
+
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import SendMessage
+
+import bot
+
+
+def headings(text: str) -> list[str]:
+    """Строки, видимые без раскрытия цитат"""
+    visible = re.sub(r"<blockquote expandable>.*?</blockquote>", "", text, flags=re.S)
+    return [line for line in visible.split("\n") if line]
+
+
+def test_json_report_fits_in_full(report_json):
+    report = bot.parse_report_json(report_json())
+    text = bot.render_compact_message(bot.pack_sections(bot.render_report_sections(report)), report)
+
+    assert "Краткий анализ ниши" in text and "Риски и рекомендации" in text
+    assert text.count("<blockquote expandable>") == len(bot.render_report_sections(report))
+    assert bot.visible_length(text) <= bot.TELEGRAM_TEXT_LIMIT
+
+
+def test_long_json_report_drops_only_analysis_and_risks(report_json):
+    # Анализ и риски сами по себе не влезают, без них — влезает
+    report = bot.parse_report_json(report_json(
+        ideas=3, analysis="Анализ. " * 400, risks=["Риск. " * 300]
+    ))
+    text = bot.render_compact_message([], report)
+
+    assert "Краткий анализ ниши" not in text and "Риски и рекомендации" not in text
+    assert "План монетизации" in text and "Сроки разработки" in text
+    assert "Идея #3" in text
+
+
+def test_huge_json_report_is_shortened_with_all_headings(report_json):
+    report = bot.parse_report_json(report_json(ideas=5, filler=80))
+    text = bot.render_compact_message([], report)
+
+    assert bot.visible_length(text) <= bot.TELEGRAM_TEXT_LIMIT
+    for section in bot.render_report_sections(report):
+        assert section.split("\n")[0] in text
+    assert text.endswith(bot.SHORTENED_NOTE)
+    assert "…" in text
+
+
+def test_markdown_report_keeps_every_heading_visible():
+    raw = (
+        "Вступление.\n\n"
+        "## 📊 Анализ ниши\nРынок растёт.\n\n"
+        "## 💡 Идея 1: Трекер\n**Фичи:**\n- раз\n- два\n\n"
+        "## 💡 Идея 2: Планер\nОписание."
+    )
+    text = bot.render_compact_message(bot.render_llm_result(raw), None)
+
+    assert headings(text) == [
+        "📄 <b>Отчёт</b>",
+        "<b>📊 Анализ ниши</b>",
+        "<b>💡 Идея 1: Трекер</b>",
+        "<b>💡 Идея 2: Планер</b>",
+    ]
+    # Подписи внутри секции («Фичи:») секцию не начинают
+    assert "<b>Фичи:</b>" in text.split("<b>💡 Идея 1: Трекер</b>")[1]
+
+
+def test_long_markdown_report_is_shortened():
+    raw = "\n\n".join(f"## Идея {i}\n" + "Очень подробное описание. " * 120 for i in range(1, 6))
+    parts = bot.render_llm_result(raw)
+    text = bot.render_compact_message(parts, None)
+
+    assert len(parts) > 1
+    assert bot.visible_length(text) <= bot.TELEGRAM_TEXT_LIMIT
+    assert headings(text) == [f"<b>Идея {i}</b>" for i in range(1, 6)] + [bot.SHORTENED_NOTE]
+
+
+def test_shortening_gives_up_when_headings_alone_do_not_fit():
+    sections = [f"<b>Заголовок {i}</b>\nтекст" for i in range(400)]
+    assert bot.shorten_sections(sections, bot.TELEGRAM_TEXT_LIMIT) is None
+
+
+def test_unknown_delivery_mode_falls_back(session):
+    session.delivery = "telepathy"
+    keyboard = bot.get_settings_keyboard(session)
+    texts = [row[0].text for row in keyboard.inline_keyboard]
+    assert f"📬 Доставка: {bot.DELIVERY_MODES[0][0]}" in texts
+
+
+def test_blocked_user_compact_job_is_removed(stores, session, fake_bot, report_json):
+    session.delivery = "compact"
+    job = stores.job_queue.enqueue(1, 10, 100, "confirm", session)
+    stores.job_queue.claim("w1", 60)
+    stores.job_queue.complete(job.job_id, report_json(), ["<b>1</b>", "<b>2</b>"])
+    (job,) = stores.job_queue.ready_for_delivery()
+    blocked = TelegramForbiddenError(method=SendMessage(chat_id=10, text="x"), message="bot was blocked by the user")
+    fake_bot.fail("send_message", blocked)
+
+    asyncio.run(bot.deliver_job(fake_bot, job))
+
+    # Ни файла, ни повторной доставки: задача снята с очереди
+    assert len(fake_bot.sent("send_message")) == 1 and not fake_bot.sent("send_document")
+    assert not stores.job_queue.exists(job.job_id)
+    assert stores.job_queue.ready_for_delivery() == []
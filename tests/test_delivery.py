@@ -0,0 +1,62 @@
+"""Доставка готовых отчётов из очереди"""
+import asyncio
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.methods import SendMessage
+
+import bot
+
+
+def telegram_error(cls, message: str):
+    return cls(method=SendMessage(chat_id=10, text="x"), message=message)
+
+
+def finished_job(stores, session, parts):
+    job = stores.job_queue.enqueue(1, 10, 100, "confirm", session)
+    stores.job_queue.claim("w1", 60)
+    stores.job_queue.complete(job.job_id, "Идеи", parts)
+    return stores.job_queue.ready_for_delivery()[0]
+
+
+def test_parts_are_sent_in_order_and_job_removed(stores, session, fake_bot):
+    job = finished_job(stores, session, ["<b>1</b>", "<b>2</b>"])
+
+    asyncio.run(bot.deliver_job(fake_bot, job))
+
+    sent = fake_bot.sent()
+    assert [args[1] for args, _ in sent] == ["<b>1</b>", "<b>2</b>"]
+    assert sent[0][1]["reply_markup"] is None and sent[1][1]["reply_markup"] is not None
+    assert not stores.job_queue.exists(job.job_id)
+
+
+def test_bad_html_is_resent_as_plain_text(stores, session, fake_bot):
+    job = finished_job(stores, session, ["<b>Идея &amp; план</i>", "<b>2</b>"])
+    fake_bot.fail("send_message", telegram_error(TelegramBadRequest, "can't parse entities"))
+
+    asyncio.run(bot.deliver_job(fake_bot, job))
+
+    sent = fake_bot.sent()
+    assert len(sent) == 3
+    args, kwargs = sent[1]
+    assert args[1] == "Идея & план" and kwargs["parse_mode"] is None
+    assert sent[2][0][1] == "<b>2</b>"
+
+
+def test_blocked_user_part_is_skipped(stores, session, fake_bot):
+    job = finished_job(stores, session, ["<b>1</b>", "<b>2</b>"])
+    fake_bot.fail("send_message", telegram_error(TelegramForbiddenError, "bot was blocked by the user"))
+
+    asyncio.run(bot.deliver_job(fake_bot, job))
+
+    # Без повторной отправки простым текстом
+    assert len(fake_bot.sent()) == 2
+    assert not stores.job_queue.exists(job.job_id)
+
+
+def test_cancelled_job_stops_delivery(stores, session, fake_bot):
+    job = finished_job(stores, session, ["<b>1</b>", "<b>2</b>"])
+    stores.job_queue.remove(job.job_id)
+
+    asyncio.run(bot.deliver_job(fake_bot, job))
+
+    assert fake_bot.sent() == []
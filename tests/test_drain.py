@@ -0,0 +1,110 @@
+"""Остановка процесса: воркеры доделывают генерации, недоделанные возобновляет следующий процесс"""
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def workers(stores, monkeypatch):
+    """Воркеры и флаг остановки — свои на каждый тест"""
+    monkeypatch.setattr(bot, "draining", False)
+    monkeypatch.setattr(bot, "worker_tasks", set())
+    monkeypatch.setattr(bot, "JOB_POLL_INTERVAL", 0.01)
+
+    def start():
+        task = asyncio.create_task(bot.llm_worker("w1"))
+        bot.worker_tasks.add(task)
+        task.add_done_callback(bot.worker_tasks.discard)
+        return task
+
+    return start
+
+
+def fake_generation(monkeypatch, delay: float):
+    async def generate_ideas(job_session, user_id=0, purpose="report"):
+        await asyncio.sleep(delay)
+        return bot.Completion("Идеи")
+
+    monkeypatch.setattr(bot.llm_client, "generate_ideas", generate_ideas)
+
+
+def job_state(job_id: int) -> tuple[str, int]:
+    return bot.job_queue.conn.execute(
+        "SELECT status, attempts FROM generation_jobs WHERE job_id = ?", (job_id,)
+    ).fetchone()
+
+
+async def wait_running(job_id: int):
+    while job_state(job_id)[0] != "running":
+        await asyncio.sleep(0.01)
+
+
+def test_drain_lets_in_flight_generation_finish(workers, session, monkeypatch):
+    fake_generation(monkeypatch, 0.1)
+    monkeypatch.setattr(bot, "DRAIN_TIMEOUT", 5)
+    job = bot.job_queue.enqueue(1, 10, 100, "confirm", session)
+
+    async def scenario():
+        worker = workers()
+        await wait_running(job.job_id)
+        await bot.drain_workers()
+        return worker
+
+    worker = asyncio.run(scenario())
+    assert worker.done() and not worker.cancelled()
+    (ready,) = bot.job_queue.ready_for_delivery()
+    assert ready.job_id == job.job_id and ready.status == "done"
+
+
+def test_drain_timeout_returns_job_to_queue(workers, session, monkeypatch):
+    fake_generation(monkeypatch, 3600)
+    monkeypatch.setattr(bot, "DRAIN_TIMEOUT", 0.1)
+    job = bot.job_queue.enqueue(1, 10, 100, "confirm", session)
+
+    async def scenario():
+        workers()
+        await wait_running(job.job_id)
+        started = time.monotonic()
+        await bot.drain_workers()
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 2
+    # Прерванная задача ждёт следующий процесс, попытка не засчитана
+    assert job_state(job.job_id) == ("queued", 0)
+    assert bot.job_queue.claim("next-process", 60).job_id == job.job_id
+
+
+def test_new_jobs_are_not_taken_while_draining(workers, session, monkeypatch):
+    fake_generation(monkeypatch, 0)
+    monkeypatch.setattr(bot, "draining", True)
+    job = bot.job_queue.enqueue(1, 10, 100, "confirm", session)
+
+    async def scenario():
+        await asyncio.wait_for(workers(), 1)
+
+    asyncio.run(scenario())
+    assert job_state(job.job_id)[0] == "queued"
+
+
+def test_resumed_jobs_get_their_status_message_updated(stores, session, fake_bot):
+    # Готовый, частично доставленный и взятый из кэша отчёты — их статус-сообщения уже не «Генерирую»
+    for user_id, delivered in ((4, 0), (5, 1)):
+        bot.job_queue.enqueue(user_id, 40, 400, "confirm", session)
+        job = bot.job_queue.claim("w1", 60)
+        bot.job_queue.complete(job.job_id, "Идеи", ["1", "2"])
+        bot.job_queue.mark_part_delivered(job.job_id, delivered)
+    bot.job_queue.enqueue_done(6, 60, 600, "cached", session, "Идеи", ["1"])
+    first = bot.job_queue.enqueue(1, 10, 100, "confirm", session)
+    bot.job_queue.enqueue(2, 20, 200, "speculative", session)
+    second = bot.job_queue.enqueue(3, 30, 300, "regenerate", session)
+    assert bot.job_queue.claim("w1", 60).job_id == first.job_id
+    fake_bot.fail("edit_message_text", bot.TelegramAPIError(method=None, message="message to edit not found"))
+
+    asyncio.run(bot.announce_resumed_jobs(fake_bot, time.time() + 1))
+    edited = [(kwargs["chat_id"], kwargs["message_id"]) for _, kwargs in fake_bot.sent("edit_message_text")]
+    # Объявляются только ждущие и идущие генерации (не спекуляции); ошибка одного сообщения не мешает остальным
+    assert edited == [(first.chat_id, first.status_message_id), (second.chat_id, second.status_message_id)]
+    assert "Бот был перезапущен" in fake_bot.sent("edit_message_text")[1][0][0]
@@ -0,0 +1,94 @@
+"""Инлайн-поиск: своя история и общий кэш по предустановленным нишам"""
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeInlineQuery:
+    def __init__(self, user_id: int, text: str, offset: str = ""):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.query = text
+        self.offset = offset
+        self.bot = SimpleNamespace(me=self.me)
+        self.answered = None
+
+    async def me(self):
+        return SimpleNamespace(username="ideas_bot")
+
+    async def answer(self, results, **kwargs):
+        self.answered = (results, kwargs)
+
+
+def search(user_id: int, text: str, offset: str = ""):
+    query = FakeInlineQuery(user_id, text, offset)
+    asyncio.run(bot.inline_report_search(query))
+    return query.answered
+
+
+def custom(session, niche: str):
+    return bot.replace(session, niche="custom", niche_display=niche)
+
+
+def test_history_search_is_per_user_and_by_prefix(make_store, session, report_json):
+    history = make_store(bot.ReportHistory)
+    history.add(1, None, session, report_json(), "<b>1</b>")
+    history.add(1, None, custom(session, "Ветеринарные клиники"), "Идея #1: Запись к врачу", "<b>2</b>")
+    history.add(2, None, custom(session, "Ветеринарные аптеки"), "текст", "<b>3</b>")
+
+    hits, has_more = history.search(1, "ветер", 0, 10)
+    assert [hit.niche_display for hit in hits] == ["Ветеринарные клиники"] and not has_more
+    assert hits[0].titles == ["Запись к врачу"] and hits[0].parts == ["<b>2</b>"]
+    assert [hit.titles for hit in history.search(1, "обра иде", 0, 10)[0]] == [["Идея 1", "Идея 2", "Идея 3"]]
+    assert history.search(1, "аптеки", 0, 10) == ([], False)
+    # Пустой запрос — вся своя история, новые первыми, страницами
+    page, has_more = history.search(1, "", 0, 1)
+    assert page[0].niche_display == "Ветеринарные клиники" and has_more
+
+
+def test_cache_search_skips_custom_input_and_is_lazy(make_store, session):
+    cache = make_store(bot.ReportCache)
+    cache.add(session, "Идея #1: Курсы", ["a"])
+    cache.add(custom(session, "Образование для ветеринаров"), "Идея #1: Секрет", ["b"])
+    assert cache.search_index is None
+
+    hits, _ = cache.search("образов", 0, 10)
+    assert [hit.parts for hit in hits] == [["a"]]
+    assert cache.search_index is not None
+    cache.add(bot.replace(session, budget="large"), "Идея #1: Вебинары", ["c"])
+    assert {tuple(hit.parts) for hit in cache.search("образов", 0, 10)[0]} == {("a",), ("c",)}
+
+
+def test_inline_results_own_history_first_then_shared_cache(stores, session, monkeypatch):
+    monkeypatch.setattr(bot, "INLINE_PAGE_SIZE", 2)
+    stores.report_history.add(7, None, session, "Идея #1: Свой", "<b>мой отчёт</b>")
+    stores.report_cache.add(session, "Идея #1: Общий", ["<b>общий отчёт</b>"])
+    stores.report_cache.add(bot.replace(session, budget="large"), "Идея #1: Второй", ["<b>второй</b>"])
+
+    results, kwargs = search(7, "образ")
+    assert kwargs["is_personal"] and kwargs["next_offset"] == "c1"
+    assert "мой отчёт" in results[0].input_message_content.message_text
+    more, kwargs = search(7, "образ", kwargs["next_offset"])
+    assert len(more) == 1 and kwargs["next_offset"] == ""
+    assert len({r.id for r in results + more}) == 3
+
+    # Чужая история другому пользователю не видна
+    others, _ = search(8, "образ")
+    assert all("мой отчёт" not in r.input_message_content.message_text for r in others)
+
+
+def test_inline_text_notes_truncation():
+    hit = bot.SearchHit("Ниша", "small", "Рынок", 3, [], "raw", ["<b>Заголовок</b>\n" + "текст " * 2000])
+    text = bot.render_inline_text(hit, "ideas_bot")
+    assert bot.visible_length(text) <= bot.TELEGRAM_TEXT_LIMIT
+    assert text.endswith("Полная версия — у @ideas_bot</i>")
+
+    headings_only = bot.SearchHit("Ниша", "small", "Рынок", 3, [], "raw", ["\n".join(f"<b>Раздел {i}</b>" for i in range(600))])
+    text = bot.render_inline_text(headings_only, "ideas_bot")
+    assert bot.visible_length(text) <= bot.TELEGRAM_TEXT_LIMIT and "✂️" in text
+
+
+def test_parse_inline_offset():
+    assert bot.parse_inline_offset("") == ("h", 0)
+    assert bot.parse_inline_offset("c12") == ("c", 12)
+    assert bot.parse_inline_offset("garbage") == ("h", 0)
@@ -0,0 +1,141 @@
+"""Очередь генераций: аренда, повторная выдача, завершение и работа из event loop"""
+import asyncio
+import sqlite3
+
+import pytest
+
+import bot
+
+
+def test_claim_leases_job_once(make_store, session):
+    queue = make_store(bot.JobQueue)
+    job = queue.enqueue(1, 10, 100, "confirm", session)
+
+    claimed = queue.claim("w1", lease_seconds=60)
+    assert claimed.job_id == job.job_id
+    assert claimed.status == "running" and claimed.attempts == 1
+    assert claimed.session == session
+    # Пока аренда не истекла, задачу никто другой не получит
+    assert queue.claim("w2", lease_seconds=60) is None
+
+
+def test_expired_lease_is_reclaimed_until_max_attempts(make_store, session, monkeypatch):
+    monkeypatch.setattr(bot, "MAX_JOB_ATTEMPTS", 2)
+    queue = make_store(bot.JobQueue)
+    job = queue.enqueue(1, 10, 100, "confirm", session)
+
+    assert queue.claim("w1", lease_seconds=-1).attempts == 1
+    # Воркер «упал»: аренда истекла — задачу забирает другой
+    assert queue.claim("w2", lease_seconds=-1).attempts == 2
+    # Попытки исчерпаны — задача помечается failed и уходит в доставку
+    assert queue.claim("w3", lease_seconds=60) is None
+    [failed] = queue.ready_for_delivery()
+    assert failed.job_id == job.job_id and failed.status == "failed"
+
+
+def test_complete_first_writer_wins(make_store, session):
+    queue = make_store(bot.JobQueue)
+    job = queue.enqueue(1, 10, 100, "confirm", session)
+    queue.claim("w1", lease_seconds=60)
+
+    assert queue.complete(job.job_id, "raw", ["part 1", "part 2"])
+    assert not queue.complete(job.job_id, "other", ["late"])
+    [done] = queue.ready_for_delivery()
+    assert done.result == "raw" and done.parts == ["part 1", "part 2"]
+
+    queue.mark_part_delivered(job.job_id, 1)
+    assert queue.ready_for_delivery()[0].delivered_parts == 1
+    queue.remove(job.job_id)
+    assert not queue.exists(job.job_id)
+
+
+def test_release_returns_job_without_counting_attempt(make_store, session):
+    queue = make_store(bot.JobQueue)
+    job = queue.enqueue(1, 10, 100, "confirm", session)
+    queue.claim("w1", lease_seconds=60)
+
+    # Чужой воркер вернуть задачу не может
+    queue.release(job.job_id, "w2")
+    assert queue.claim("w2", lease_seconds=60) is None
+
+    queue.release(job.job_id, "w1")
+    assert queue.claim("w2", lease_seconds=60).attempts == 1
+
+
+def test_speculative_jobs_go_last_and_are_not_delivered(make_store, session):
+    queue = make_store(bot.JobQueue)
+    speculative = queue.enqueue(1, 10, 100, "speculative", session)
+    confirmed = queue.enqueue(2, 20, 200, "confirm", session)
+
+    assert queue.claim("w1", 60).job_id == confirmed.job_id
+    assert queue.claim("w1", 60).job_id == speculative.job_id
+    queue.complete(speculative.job_id, "raw", ["part"])
+    assert queue.ready_for_delivery() == []
+    assert queue.promote(speculative.job_id)
+    assert [job.job_id for job in queue.ready_for_delivery()] == [speculative.job_id]
+
+
+def test_run_executes_in_store_thread_and_retries_busy(make_store, session, monkeypatch):
+    monkeypatch.setattr(bot, "SQLITE_LOCK_RETRIES", 3)
+    queue = make_store(bot.JobQueue)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            error = sqlite3.OperationalError("database is locked")
+            error.sqlite_errorcode = sqlite3.SQLITE_BUSY
+            raise error
+        return "ok"
+
+    async def scenario():
+        job = await queue.run(queue.enqueue, 1, 10, 100, "confirm", session)
+        return job, await queue.run(flaky)
+
+    job, result = asyncio.run(scenario())
+    assert result == "ok" and len(calls) == 3
+    assert queue.exists(job.job_id)
+
+
+def test_run_gives_up_on_other_errors(make_store):
+    queue = make_store(bot.JobQueue)
+
+    def broken():
+        raise sqlite3.OperationalError("no such table: nope")
+
+    async def scenario():
+        await queue.run(broken)
+
+    with pytest.raises(sqlite3.OperationalError, match="no such table"):
+        asyncio.run(scenario())
+
+
+def test_worker_survives_job_errors(make_store, session, monkeypatch):
+    queue = make_store(bot.JobQueue)
+    monkeypatch.setattr(bot, "job_queue", queue)
+    monkeypatch.setattr(bot, "JOB_POLL_INTERVAL", 0.01)
+    calls = []
+
+    async def generate_ideas(job_session, user_id=None, purpose="report"):
+        calls.append(user_id)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return bot.Completion("Идеи")
+
+    monkeypatch.setattr(bot.llm_client, "generate_ideas", generate_ideas)
+    first = queue.enqueue(1, 10, 100, "confirm", session)
+    second = queue.enqueue(2, 20, 200, "confirm", session)
+
+    async def scenario():
+        worker = asyncio.create_task(bot.llm_worker("w1"))
+        while len(queue.ready_for_delivery()) < 2:
+            assert not worker.done(), worker
+            await asyncio.sleep(0.01)
+        worker.cancel()
+
+    asyncio.run(scenario())
+    done = {job.job_id: job for job in queue.ready_for_delivery()}
+    assert set(done) == {first.job_id, second.job_id}
+    assert all(job.status == "done" and job.parts for job in done.values())
+    # Упавшая задача выдана повторно с засчитанной попыткой
+    assert done[first.job_id].attempts == 2
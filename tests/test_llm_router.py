@@ -0,0 +1,212 @@
+"""Маршрутизация запросов между LLM-бэкендами на локальном OpenAI-совместимом сервере-заглушке"""
+import asyncio
+import json
+import re
+from contextlib import asynccontextmanager
+
+import pytest
+
+import bot
+
+MESSAGES = [{"role": "user", "content": "Идеи"}]
+
+
+class StubLLMServer:
+    """Минимальный /chat/completions: задержка, код ответа и учёт оборванных клиентом запросов"""
+
+    def __init__(self, content: str = "ok", delay: float = 0.0, status: int = 200):
+        self.content = content
+        self.delay = delay
+        self.status = status
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.aborted = 0
+        self.server = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/v1"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = int(re.search(rb"content-length: *(\d+)", head, re.I).group(1))
+        json.loads(await reader.readexactly(length))
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            # Пока «думаем», следим, не закрыл ли клиент соединение
+            eof = asyncio.ensure_future(reader.read(1))
+            done, _ = await asyncio.wait({eof}, timeout=self.delay)
+            if done:
+                self.aborted += 1
+                return
+            eof.cancel()
+            payload = json.dumps({
+                "choices": [{"message": {"role": "assistant", "content": self.content}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 20},
+            }).encode()
+            writer.write(
+                b"HTTP/1.1 %d STUB\r\nContent-Type: application/json\r\nContent-Length: %d\r\n"
+                b"Connection: close\r\n\r\n" % (self.status, len(payload)) + payload
+            )
+            await writer.drain()
+        finally:
+            self.in_flight -= 1
+            writer.close()
+
+
+@asynccontextmanager
+async def router_for(*servers: StubLLMServer, max_concurrency: int = 4):
+    """Роутер с бэкендом на каждый сервер-заглушку (имена b0, b1, ...)"""
+    for server in servers:
+        server.server = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    backends = [
+        bot.OpenAICompatibleBackend(f"b{i}", "stub-model", server.base_url, None, max_concurrency)
+        for i, server in enumerate(servers)
+    ]
+    try:
+        yield bot.LLMRouter(backends)
+    finally:
+        for backend in backends:
+            await backend.client.aclose()
+        for server in servers:
+            server.server.close()
+            await server.server.wait_closed()
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        bot.LLMBackend("x", "model", 1)
+
+
+def test_error_spills_over_to_next_backend():
+    failing, healthy = StubLLMServer(status=500), StubLLMServer(content="from b1")
+
+    async def scenario():
+        async with router_for(failing, healthy) as router:
+            completion = await router.complete(MESSAGES, 100, False)
+            return completion, router
+
+    completion, router = asyncio.run(scenario())
+    assert completion.text == "from b1" and completion.backend == "b1"
+    assert completion.prompt_tokens == 10 and completion.completion_tokens == 20
+    assert failing.requests == 1 and healthy.requests == 1
+    assert router.stats["b0"].errors == 1 and router.stats["b0"].in_flight == 0
+
+
+def test_slow_backend_times_out_and_spills_over(monkeypatch):
+    monkeypatch.setattr(bot, "LLM_REQUEST_TIMEOUT", 0.2)
+    slow, fast = StubLLMServer(content="slow", delay=5), StubLLMServer(content="fast")
+
+    async def scenario():
+        async with router_for(slow, fast) as router:
+            completion = await router.complete(MESSAGES, 100, False)
+            # Сервер видит, что клиент бросил запрос по таймауту
+            while not slow.aborted:
+                await asyncio.sleep(0.01)
+            return completion
+
+    assert asyncio.run(scenario()).text == "fast"
+    assert slow.aborted == 1
+
+
+def test_all_backends_failing_raises():
+    async def scenario():
+        async with router_for(StubLLMServer(status=500), StubLLMServer(status=503)) as router:
+            await router.complete(MESSAGES, 100, False)
+
+    with pytest.raises(Exception):
+        asyncio.run(scenario())
+
+
+def test_max_concurrency_makes_requests_wait():
+    server = StubLLMServer(delay=0.05)
+
+    async def scenario():
+        async with router_for(server, max_concurrency=1) as router:
+            return await asyncio.gather(*(router.complete(MESSAGES, 100, False) for _ in range(3)))
+
+    results = asyncio.run(scenario())
+    assert [r.text for r in results] == ["ok"] * 3
+    assert server.requests == 3 and server.max_in_flight == 1
+
+
+def test_busy_backend_overflows_to_free_one():
+    first, second = StubLLMServer(delay=0.1), StubLLMServer(delay=0.1)
+
+    async def scenario():
+        async with router_for(first, second, max_concurrency=1) as router:
+            return await asyncio.gather(*(router.complete(MESSAGES, 100, False) for _ in range(2)))
+
+    assert {r.backend for r in asyncio.run(scenario())} == {"b0", "b1"}
+
+
+def test_faster_backend_is_preferred_by_ewma():
+    slow, fast = StubLLMServer(content="slow", delay=0.1), StubLLMServer(content="fast")
+
+    async def scenario():
+        async with router_for(slow, fast) as router:
+            # Оба ещё не опробованы — первые запросы уходят на каждый
+            await router.complete(MESSAGES, 100, False)
+            await router.complete(MESSAGES, 100, False)
+            return [(await router.complete(MESSAGES, 100, False)).backend for _ in range(3)], router
+
+    backends, router = asyncio.run(scenario())
+    assert backends == ["b1"] * 3
+    assert router.stats["b0"].latency > router.stats["b1"].latency
+
+
+def test_error_rate_outweighs_latency():
+    flaky, steady = StubLLMServer(delay=0.1), StubLLMServer(delay=0.15)
+
+    async def scenario():
+        async with router_for(flaky, steady) as router:
+            for _ in range(3):
+                await router.complete(MESSAGES, 100, False)
+            assert (await router.complete(MESSAGES, 100, False)).backend == "b0"
+            # Более быстрый бэкенд начинает отвечать ошибками
+            flaky.status = 500
+            before = flaky.requests
+            for _ in range(5):
+                assert (await router.complete(MESSAGES, 100, False)).backend == "b1"
+            failed = flaky.requests - before
+            flaky.status = 200
+            return failed, (await router.complete(MESSAGES, 100, False)).backend, router
+
+    failed, backend, router = asyncio.run(scenario())
+    # После пары ошибок запросы перестают начинаться с него, пока доля ошибок не затухнет
+    assert failed < 5
+    assert backend == "b1"
+    assert router.error_rate(router.backends[0]) > 0.3
+
+
+def test_error_rate_decays_over_time(monkeypatch):
+    router = bot.LLMRouter([bot.OpenAICompatibleBackend("b0", "m", "http://127.0.0.1:9", None, 1)])
+    router._record(router.backends[0], None)
+    fresh = router.error_rate(router.backends[0])
+    clock = bot.time.monotonic() + router.ERROR_HALF_LIFE
+    monkeypatch.setattr(bot.time, "monotonic", lambda: clock)
+    assert router.error_rate(router.backends[0]) == pytest.approx(fresh / 2, rel=0.01)
+
+
+def test_cancellation_aborts_http_request():
+    server = StubLLMServer(delay=5)
+
+    async def scenario():
+        async with router_for(server) as router:
+            call = asyncio.create_task(router.complete(MESSAGES, 100, False))
+            while not server.requests:
+                await asyncio.sleep(0.01)
+            call.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await call
+            while not server.aborted:
+                await asyncio.sleep(0.01)
+            return router
+
+    router = asyncio.run(asyncio.wait_for(scenario(), 3))
+    assert server.aborted == 1
+    assert router.stats["b0"].in_flight == 0
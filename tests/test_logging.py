@@ -0,0 +1,105 @@
+"""Логи: фоновый поток вывода, процессы пула и correlation_id задач"""
+import asyncio
+import json
+import logging
+import threading
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def restore_logging():
+    yield
+    bot.setup_logging(background=False)
+
+
+def bot_handlers() -> list[str]:
+    """Обработчики, поставленные setup_logging (pytest добавляет к корневому логгеру свои)"""
+    return [
+        type(handler).__name__ for handler in logging.getLogger().handlers
+        if any(isinstance(f, bot.CorrelationFilter) for f in handler.filters)
+    ]
+
+
+def log_from_pool(message: str) -> list[str]:
+    logging.getLogger("bot").warning(message)
+    return bot_handlers()
+
+
+def test_logging_is_direct_until_started(restore_logging):
+    assert bot.log_listener is None
+    assert bot_handlers() == ["StreamHandler"]
+
+    bot.setup_logging(background=True)
+    first = bot.log_listener
+    assert first is not None and first._thread is not None
+    bot.setup_logging(background=True)
+    # Прежний поток остановлен, а не брошен
+    assert first._thread is None
+    assert bot.log_listener is not first
+    assert bot_handlers() == ["QueueHandler"]
+
+
+def test_json_lines_carry_correlation_id(restore_logging, capfd, monkeypatch):
+    monkeypatch.setattr(bot, "LOG_FORMAT", "json")
+    bot.setup_logging(background=True)
+    token = bot.correlation_id.set("u123")
+    try:
+        bot.logger.info("Job %s enqueued", 7, extra={"job_id": 7})
+    finally:
+        bot.correlation_id.reset(token)
+    bot.setup_logging(background=False)
+    entry = json.loads(capfd.readouterr().err.strip().splitlines()[-1])
+    assert entry["correlation_id"] == "u123"
+    assert entry["message"] == "Job 7 enqueued" and entry["job_id"] == 7
+
+
+@pytest.mark.skipif("fork" not in bot.multiprocessing.get_all_start_methods(), reason="нужен fork")
+def test_pool_forked_before_log_thread_writes_directly(restore_logging, monkeypatch):
+    monkeypatch.setattr(bot, "POSTPROCESS_WORKERS", 1)
+
+    async def scenario():
+        await bot.start_postprocess_pool()
+        bot.setup_logging(background=True)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                bot.postprocess_pool, log_from_pool, "hello from pool"
+            )
+        finally:
+            bot.stop_postprocess_pool()
+
+    # Процесс пула пишет напрямую: очереди без потока-читателя у него нет
+    assert asyncio.run(asyncio.wait_for(scenario(), 30)) == ["StreamHandler"]
+
+
+def test_worker_resets_correlation_id_after_job(stores, session, monkeypatch):
+    monkeypatch.setattr(bot, "JOB_POLL_INTERVAL", 0.01)
+    seen = []
+
+    async def generate_ideas(job_session, user_id=0, purpose="report"):
+        seen.append(("job", bot.correlation_id.get()))
+        return bot.Completion("Идеи")
+
+    real_wait = bot.wait_wakeup
+
+    async def wait_wakeup(event, timeout):
+        seen.append(("idle", bot.correlation_id.get()))
+        await real_wait(event, timeout)
+
+    monkeypatch.setattr(bot.llm_client, "generate_ideas", generate_ideas)
+    monkeypatch.setattr(bot, "wait_wakeup", wait_wakeup)
+
+    async def scenario():
+        token = bot.correlation_id.set("u1")
+        bot.job_queue.enqueue(1, 10, 100, "confirm", session)
+        bot.correlation_id.reset(token)
+        worker = asyncio.create_task(bot.llm_worker("w1"))
+        while not any(kind == "idle" for kind, _ in seen[1:]):
+            await asyncio.sleep(0.01)
+        worker.cancel()
+
+    asyncio.run(scenario())
+    assert seen[0] == ("job", "u1")
+    assert seen[1] == ("idle", "-")
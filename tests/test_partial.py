@@ -0,0 +1,88 @@
+"""Частичная перегенерация: короткий контекст, разбор новой секции и вклейка в сохранённый отчёт"""
+import asyncio
+import json
+from dataclasses import replace
+
+import pytest
+
+import bot
+
+NEW_IDEA = {"title": "Новая идея", "value": "Другая ценность", "audience": "Родители", "features": ["Фича A", "Фича B"]}
+
+
+class RecordingRouter:
+    """Вместо LLMRouter: запоминает сообщения и отвечает новой идеей"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def complete(self, messages, max_tokens, json_mode):
+        self.messages.append(messages)
+        return bot.Completion(json.dumps(NEW_IDEA))
+
+
+def test_context_is_compact(report_json):
+    report = bot.parse_report_json(report_json(filler=50))
+    context = bot.compact_report_context(report)
+    assert "Идея #2: Идея 2" in context and "Монетизация: Подписка; Фримиум" in context
+    # Фичи и риски в контекст не идут, анализ обрезан
+    assert "Фича 1.1" not in context and "Конкуренция" not in context
+    assert len(context.splitlines()[0]) == len("Анализ: ") + 300
+
+
+@pytest.mark.parametrize("text", [json.dumps(NEW_IDEA), json.dumps({"idea": NEW_IDEA}), f"```json\n{json.dumps(NEW_IDEA)}\n```"])
+def test_idea_section_is_parsed(text):
+    idea = bot.parse_report_section("idea", text)
+    assert idea.title == "Новая идея" and idea.features == ("Фича A", "Фича B")
+
+
+def test_invalid_section_is_rejected():
+    with pytest.raises(ValueError):
+        bot.parse_report_section("monetization", '{"monetization": [" "]}')
+    parts = bot.render_partial_result({"section": "idea", "index": 2}, "не JSON")
+    assert parts == ["❌ Не удалось перегенерировать эту часть отчёта. Попробуйте ещё раз."]
+
+
+def test_splice_replaces_only_the_section(report_json):
+    report = bot.parse_report_json(report_json())
+    idea = bot.parse_report_section("idea", json.dumps(NEW_IDEA))
+    spliced = bot.splice_report(report, "idea", 2, idea)
+    assert [i.title for i in spliced.ideas] == ["Идея 1", "Новая идея", "Идея 3"]
+    assert spliced.monetization == report.monetization
+
+    spliced = bot.splice_report(report, "monetization", 0, ("Разовая покупка",))
+    assert spliced.monetization == ("Разовая покупка",) and spliced.ideas == report.ideas
+
+
+def test_partial_result_is_rendered():
+    parts = bot.render_partial_result({"section": "idea", "index": 2}, json.dumps(NEW_IDEA))
+    assert "Идея #2 заменена" in parts[0] and "💡 <b>Идея #2: Новая идея</b>" in parts[0]
+
+
+def test_partial_result_is_saved_to_history(stores, session, report_json):
+    seq = bot.report_history.add(1, None, session, report_json(), "html")
+    job = bot.job_queue.enqueue(1, 10, 100, "partial", session, {"seq": seq, "section": "idea", "index": 3, "context": ""})
+
+    saved_seq, report = bot.apply_partial_result(replace(job, result=json.dumps(NEW_IDEA)))
+    assert saved_seq == seq and report.ideas[2].title == "Новая идея"
+    stored = bot.parse_report_json(bot.report_history.get_entry(1, seq)[1])
+    assert stored == report
+    assert "Новая идея" in bot.report_history.get_html(1, seq)[1]
+
+    # Отчёт удалён или ответ не по схеме — история не меняется
+    assert bot.apply_partial_result(replace(job, result="не JSON")) == (None, None)
+    assert bot.apply_partial_result(replace(job, payload={**job.payload, "seq": 99})) == (None, None)
+
+
+def test_section_prompt_asks_for_one_section(make_store, session):
+    router = RecordingRouter()
+    client = bot.LLMClient(router, make_store(bot.UsageLedger))
+    instruction = bot.PARTIAL_INSTRUCTIONS["idea"].format(index=2)
+
+    completion = asyncio.run(client.regenerate_section(session, "Идея #2: Идея 2", instruction, 1))
+    (messages,) = router.messages
+    system = messages[0]["content"]
+    # Не схема полного отчёта: модель не должна возвращать весь отчёт вместо секции
+    assert system == bot.SECTION_SYSTEM_PROMPT and '"analysis"' not in system
+    assert '"features"' in system and '"monetization"' in system
+    assert bot.parse_report_section("idea", completion.text).title == "Новая идея"
@@ -0,0 +1,77 @@
+"""Постобработка в пуле процессов и сторож задержки event loop"""
+import asyncio
+import os
+import signal
+import time
+
+import pytest
+
+import bot
+
+needs_fork = pytest.mark.skipif("fork" not in bot.multiprocessing.get_all_start_methods(), reason="нужен fork")
+
+
+def where(text: str) -> tuple[int, str, int]:
+    """Функция постобработки для теста: в каком процессе и с каким correlation_id выполнилась"""
+    return os.getpid(), bot.correlation_id.get(), len(text)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(bot, "POSTPROCESS_WORKERS", 1)
+    monkeypatch.setattr(bot, "POSTPROCESS_INLINE_LIMIT", 100)
+    yield
+    bot.stop_postprocess_pool()
+
+
+@needs_fork
+def test_large_outputs_go_to_the_pool(pool):
+    async def scenario():
+        await bot.start_postprocess_pool()
+        bot.correlation_id.set("u7")
+        return await bot.postprocess(where, "короткий"), await bot.postprocess(where, "x" * 500)
+
+    small, large = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert small == (os.getpid(), "u7", 8)
+    assert large[0] != os.getpid()
+    # correlation_id генерации доходит и до процесса пула
+    assert large[1:] == ("u7", 500)
+
+
+@needs_fork
+def test_broken_pool_falls_back_to_inline(pool):
+    async def scenario():
+        await bot.start_postprocess_pool()
+        for pid in list(bot.postprocess_pool._processes):
+            os.kill(pid, signal.SIGKILL)
+        return await bot.postprocess(where, "x" * 500)
+
+    result = asyncio.run(asyncio.wait_for(scenario(), 30))
+    assert result[0] == os.getpid()
+    assert bot.postprocess_pool is None
+
+
+def test_lag_monitor_reports_blocking_code(caplog):
+    monitor = bot.LoopLagMonitor(0.01, 0.1)
+
+    async def scenario():
+        task = monitor.start()
+        await asyncio.sleep(0.05)
+        time.sleep(0.3)  # обработчик, заблокировавший loop
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+    with caplog.at_level("WARNING", logger="bot"):
+        asyncio.run(scenario())
+    assert monitor.stopped.is_set()
+    assert monitor.blocked_count == 1
+    assert monitor.percentiles()["max"] >= 0.25
+    (record,) = [r for r in caplog.records if "Event loop blocked" in r.getMessage()]
+    assert "test_lag_monitor_reports_blocking_code" in record.getMessage()
+
+
+def test_percentiles():
+    monitor = bot.LoopLagMonitor(1, 1)
+    assert monitor.percentiles() == {}
+    monitor.samples.extend(i / 100 for i in range(100))
+    assert monitor.percentiles() == {"p50": 0.5, "p95": 0.95, "p99": 0.99, "max": 0.99}
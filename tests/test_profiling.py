@@ -0,0 +1,57 @@
+"""Профилирование работающего бота: сэмплы event loop и снимок памяти"""
+import asyncio
+import threading
+import time
+
+import bot
+
+
+def test_parse_profile_seconds(monkeypatch):
+    monkeypatch.setattr(bot, "PROFILE_MAX_SECONDS", 120)
+    assert bot.parse_profile_seconds("10 cprofile", 30) == 10
+    assert bot.parse_profile_seconds("cprofile", 30) == 30
+    assert bot.parse_profile_seconds("0.1", 30) == 1.0
+    assert bot.parse_profile_seconds("9999", 30) == 120
+
+
+def busy_handler(seconds: float):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+def test_sampler_sees_blocking_code():
+    async def scenario():
+        profile = asyncio.create_task(bot.sample_event_loop(0.3, 0.005))
+        await asyncio.sleep(0.05)
+        busy_handler(0.2)
+        return await profile
+
+    report = asyncio.run(scenario())
+    assert "Собственное время" in report
+    assert "test_profiling.py:busy_handler" in report
+
+
+def test_memory_report_is_built_off_the_event_loop(monkeypatch):
+    threads = {}
+
+    def recording(func):
+        def wrapper(*args):
+            threads[func.__name__] = threading.get_ident()
+            return func(*args)
+        return wrapper
+
+    monkeypatch.setattr(bot, "format_allocations", recording(bot.format_allocations))
+    monkeypatch.setattr(bot, "gc_census", recording(bot.gc_census))
+
+    async def scenario():
+        keep = [bytearray(1024) for _ in range(100)]
+        report = await bot.trace_allocations(0.01)
+        del keep
+        return report, threading.get_ident()
+
+    report, loop_thread = asyncio.run(scenario())
+    assert "Топ мест выделения" in report and "по типам" in report
+    assert set(threads) == {"format_allocations", "gc_census"}
+    assert loop_thread not in threads.values()
+    assert not bot.tracemalloc.is_tracing()
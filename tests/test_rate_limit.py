@@ -0,0 +1,132 @@
+"""Лимиты частоты запросов: token bucket в памяти и в SQLite, ответы об отказе"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.types import CallbackQuery, User
+
+import bot
+
+USER = User(id=1, is_bot=False, first_name="Тест")
+
+
+class Clock:
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def buckets(request, make_store):
+    if request.param == "memory":
+        return bot.TokenBuckets(100)
+    return make_store(bot.SQLiteTokenBuckets, 100)
+
+
+def test_parse_rate():
+    assert bot.parse_rate("6/600") == (6.0, 600.0)
+    assert bot.parse_rate("5") == (5.0, 1.0)
+    assert bot.parse_rate("0") is None and bot.parse_rate("") is None
+    with pytest.raises(ValueError):
+        bot.parse_rate("много/минуту")
+
+
+def test_bucket_drains_and_refills(buckets, clock):
+    limits = [("generation:1", (3.0, 60.0))]
+    assert [buckets.take(limits) for _ in range(3)] == [0.0] * 3
+    assert buckets.take(limits) == pytest.approx(20.0)
+    clock.now += 20
+    assert buckets.take(limits) == 0.0
+    assert buckets.take(limits) > 0
+
+
+def test_take_is_all_or_nothing(buckets, clock):
+    user, shared = ("generation:1", (5.0, 60.0)), ("generation:*", (1.0, 60.0))
+    assert buckets.take([user, shared]) == 0.0
+    assert buckets.take([user, shared]) == pytest.approx(60.0)
+    # Отказ общей корзины не списал токен из пользовательской
+    for _ in range(4):
+        assert buckets.take([user]) == 0.0
+    assert buckets.take([user]) > 0
+
+
+def test_memory_buckets_evict_least_recent(clock):
+    buckets = bot.TokenBuckets(2)
+    for key in ("a", "b", "a", "c"):
+        buckets.take([(key, (1.0, 60.0))])
+    assert list(buckets.buckets) == ["a", "c"]
+
+
+def test_sqlite_buckets_forget_full_ones(make_store, clock):
+    buckets = make_store(bot.SQLiteTokenBuckets, 2)
+    buckets.take([("a", (1.0, 10.0))])
+    clock.now += 60
+    buckets.take([("b", (1.0, 10.0))])
+    keys = [key for (key,) in buckets.conn.execute("SELECT key FROM buckets")]
+    assert keys == ["b"]
+
+
+@pytest.fixture
+def quota(monkeypatch, clock):
+    monkeypatch.setattr(bot, "RATE_LIMIT_NAVIGATION", "1/60")
+    monkeypatch.setattr(bot, "RATE_LIMIT_GENERATION", "1/60")
+    return bot.QuotaMiddleware(bot.TokenBuckets(100))
+
+
+def test_user_is_told_once_per_window(quota, clock, monkeypatch):
+    answers = []
+
+    async def answer(self, text=None, show_alert=None, **kwargs):
+        answers.append(("callback", text))
+
+    async def message_answer(text, **kwargs):
+        answers.append(("message", text))
+
+    monkeypatch.setattr(CallbackQuery, "answer", answer)
+    callback = CallbackQuery(id="cb", from_user=USER, chat_instance="ci", data="back_to_menu")
+    message = SimpleNamespace(answer=message_answer)
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event)
+
+    async def scenario():
+        for event in (callback, callback, message, callback):
+            await quota(handler, event, {"event_from_user": USER})
+        clock.now += 61
+        for event in (callback, message, message):
+            await quota(handler, event, {"event_from_user": USER})
+
+    asyncio.run(scenario())
+    assert handled == [callback, callback]
+    assert answers[0][0] == "callback" and answers[0][1].startswith("⏳")
+    # Дальше в том же окне: только пустой answer на кнопку, на сообщение — ничего
+    assert answers[1] == ("callback", None)
+    # Новое окно — снова одно предупреждение
+    assert answers[2][0] == "message" and answers[2][1].startswith("⏳")
+    assert len(answers) == 3
+    assert quota.rejected["navigation"] == 5
+
+
+def test_admins_are_not_limited(quota, monkeypatch):
+    monkeypatch.setattr(bot, "ADMIN_IDS", {USER.id})
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event)
+
+    async def scenario():
+        for _ in range(5):
+            await quota(handler, SimpleNamespace(), {"event_from_user": USER})
+
+    asyncio.run(scenario())
+    assert len(handled) == 5
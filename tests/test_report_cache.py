@@ -0,0 +1,91 @@
+"""Кэш отчётов: поиск похожего свободного ввода и очистка устаревших"""
+import time
+
+import bot
+
+
+def custom_session(session, niche: str, market: str = None):
+    session.niche, session.niche_display = "custom", niche
+    if market:
+        session.market, session.market_display = "custom", market
+    return session
+
+
+def test_minhash_ranks_candidates_and_forgets_removed():
+    index = bot.MinHashIndex()
+    for text in ("фитнес приложения", "фитнес приложение для йоги", "бухгалтерия"):
+        index.add(text)
+
+    ranked = index.candidates("фитнес приложение")
+    assert [text for text, _ in ranked][:2] == ["фитнес приложения", "фитнес приложение для йоги"]
+    assert ranked[0][1] > ranked[1][1] and all(text != "бухгалтерия" for text, _ in ranked)
+    assert index.query("фитнес приложения") == ("фитнес приложения", 1.0)
+
+    index.remove("фитнес приложения")
+    assert index.query("фитнес приложения")[0] != "фитнес приложения"
+    index.remove("фитнес приложение для йоги")
+    index.remove("бухгалтерия")
+    assert index.shingles == {} and index.buckets == {}
+
+
+def test_exact_and_similar_hits(make_store, session):
+    cache = make_store(bot.ReportCache)
+    cache.add(custom_session(session, "Фитнес-приложения"), "отчёт", ["часть"])
+
+    exact = cache.lookup(custom_session(bot.replace(session), "фитнес приложения"))
+    assert exact.result == "отчёт" and not exact.similar
+    similar = cache.lookup(custom_session(bot.replace(session), "Фитнес приложение"))
+    assert similar.parts == ["часть"] and similar.similar
+    assert cache.lookup(custom_session(bot.replace(session), "Ветеринария")) is None
+    assert (cache.stats.exact_hits, cache.stats.similar_hits, cache.stats.misses) == (1, 1, 1)
+
+
+def test_lookup_tries_less_similar_candidates(make_store, session):
+    cache = make_store(bot.ReportCache)
+    # Самый похожий вариант есть только для другого бюджета
+    cache.add(bot.replace(custom_session(session, "фитнес приложении"), budget="large"), "другой бюджет", ["x"])
+    cache.add(custom_session(bot.replace(session), "фитнес приложениях"), "нужный", ["y"])
+    query = custom_session(bot.replace(session), "фитнес приложение")
+    [(best, _), (second, score)] = cache.niche_index.candidates("фитнес приложение")
+    assert (best, second) == ("фитнес приложении", "фитнес приложениях") and score >= bot.SIMILARITY_THRESHOLD
+
+    found = cache.lookup(query)
+    assert found is not None and found.result == "нужный" and found.similar
+
+
+def test_prune_expired_cleans_in_memory_indices(make_store, session, monkeypatch):
+    cache = make_store(bot.ReportCache)
+    cache.search("", 0, 10)
+    cache.add(bot.replace(session), "пресет", ["y"])
+    cache.add(custom_session(session, "Фитнес-приложения", "Латинская Америка"), "старый", ["x"])
+    assert "фитнес приложения" in cache.niche_index.shingles
+    assert cache.search_index.entries
+
+    monkeypatch.setattr(bot.time, "time", lambda: time.monotonic() + 10 ** 10)
+    cache.prune_expired()
+
+    assert cache.niche_index.shingles == {} and cache.market_index.shingles == {}
+    assert cache.search_index.entries == {} and cache.search_index.words == []
+
+
+def test_prune_keeps_strings_still_in_use(make_store, session, monkeypatch):
+    cache = make_store(bot.ReportCache)
+    now = time.time()
+    monkeypatch.setattr(bot.time, "time", lambda: now - bot.REPORT_CACHE_TTL_HOURS * 3600 - 1)
+    cache.add(custom_session(session, "Фитнес-приложения"), "старый", ["x"])
+    monkeypatch.setattr(bot.time, "time", lambda: now)
+    cache.add(bot.replace(custom_session(session, "Фитнес-приложения"), budget="large"), "свежий", ["y"])
+
+    assert "фитнес приложения" in cache.niche_index.shingles
+    assert cache.lookup(custom_session(bot.replace(session, budget="large"), "Фитнес-приложения")).result == "свежий"
+
+
+def test_cached_job_is_enqueued_as_done(make_store, session):
+    queue = make_store(bot.JobQueue)
+    job = queue.enqueue_done(1, 10, 100, "cached", session, "отчёт", ["часть"])
+
+    # Воркеру забирать нечего — задача сразу в доставке
+    assert queue.claim("w1", 60) is None
+    [ready] = queue.ready_for_delivery()
+    assert ready.job_id == job.job_id and ready.status == "done"
+    assert ready.result == "отчёт" and ready.parts == ["часть"]
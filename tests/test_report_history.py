@@ -0,0 +1,95 @@
+"""История отчётов: листание по seq, квоты и вытеснение устаревших"""
+import random
+import string
+
+import pytest
+
+import bot
+
+
+def noise(size: int, seed: int) -> str:
+    """Плохо сжимаемый текст — размер записи почти равен size"""
+    rnd = random.Random(seed)
+    return "".join(rnd.choice(string.ascii_letters + string.digits) for _ in range(size))
+
+
+@pytest.fixture
+def history(make_store):
+    return make_store(bot.ReportHistory)
+
+
+def seqs(history, user_id: int = 1) -> list[int]:
+    return [seq for (seq,) in history.conn.execute("SELECT seq FROM reports WHERE user_id = ? ORDER BY seq", (user_id,))]
+
+
+def test_pages_by_seq_boundaries(history, session):
+    for i in range(12):
+        history.add(1, None, session, f"Отчёт {i}", f"<b>Отчёт {i}</b>")
+    history.add(2, None, session, "Чужой", "Чужой")
+
+    def page(**kwargs):
+        reports, has_newer, has_older = history.page(1, limit=5, **kwargs)
+        return [r.seq for r in reports], has_newer, has_older
+
+    assert page() == ([12, 11, 10, 9, 8], False, True)
+    assert page(before=8) == ([7, 6, 5, 4, 3], True, True)
+    assert page(before=3) == ([2, 1], True, False)
+    assert page(after=2) == ([7, 6, 5, 4, 3], True, True)
+    assert page(after=7) == ([12, 11, 10, 9, 8], False, True)
+    assert history.page(3) == ([], False, False)
+
+
+def test_same_job_is_stored_once(history, session):
+    assert history.add(1, 77, session, "Отчёт", "Отчёт") == 1
+    assert history.add(1, 77, session, "Отчёт", "Отчёт") == 1
+    assert seqs(history) == [1]
+
+
+def test_count_quota_drops_oldest(history, session, monkeypatch):
+    monkeypatch.setattr(bot, "HISTORY_MAX_REPORTS", 5)
+    for i in range(8):
+        history.add(1, None, session, f"Отчёт {i}", "html")
+    history.add(2, None, session, "Чужой", "html")
+    assert seqs(history) == [4, 5, 6, 7, 8]
+    # Нумерация продолжается, а не переиспользуется
+    assert history.add(1, None, session, "Новый", "html") == 9
+    assert seqs(history) == [5, 6, 7, 8, 9]
+    assert seqs(history, 2) == [1]
+
+
+def test_byte_quota_drops_oldest(history, session, monkeypatch):
+    history.add(1, None, session, noise(2000, 0), "html")
+    (size,) = history.conn.execute("SELECT size FROM reports").fetchone()
+    monkeypatch.setattr(bot, "HISTORY_MAX_BYTES", int(size * 3.5))
+    for i in range(1, 6):
+        history.add(1, None, session, noise(2000, i), "html")
+    assert seqs(history) == [4, 5, 6]
+
+
+def test_grown_report_reapplies_quota(history, session, monkeypatch):
+    for i in range(4):
+        history.add(1, None, session, f"Отчёт {i}", "html")
+    (total,) = history.conn.execute("SELECT SUM(size) FROM reports").fetchone()
+    monkeypatch.setattr(bot, "HISTORY_MAX_BYTES", total + 3000)
+    # Частичная перегенерация раздула самый новый отчёт
+    history.update_report(1, 4, noise(4000, 1), "html")
+    assert seqs(history)[-1] == 4
+    assert len(seqs(history)) < 4
+    (total,) = history.conn.execute("SELECT SUM(size) FROM reports").fetchone()
+    assert total <= bot.HISTORY_MAX_BYTES
+    assert history.get_entry(1, 4)[1] == noise(4000, 1)
+
+
+def test_update_of_missing_report_is_ignored(history, session):
+    history.update_report(1, 42, "raw", "html")
+    assert seqs(history) == []
+
+
+def test_expired_reports_are_pruned_periodically(history, session, monkeypatch):
+    monkeypatch.setattr(bot.ReportHistory, "PRUNE_EVERY", 3)
+    history.add(1, None, session, "Старый", "html")
+    history.conn.execute("UPDATE reports SET created_at = 0")
+    history.add(1, None, session, "Новый", "html")
+    assert seqs(history) == [1, 2]
+    history.add(1, None, session, "Ещё", "html")
+    assert seqs(history) == [2, 3]
@@ -0,0 +1,85 @@
+"""JSON-отчёт: проверка схемы, повторный запрос и отрисовка по шаблонам"""
+import asyncio
+import json
+
+import pytest
+
+import bot
+
+
+class ScriptedRouter:
+    """Вместо LLMRouter: отдаёт ответы по очереди и запоминает промпты"""
+
+    def __init__(self, *texts: str):
+        self.texts = list(texts)
+        self.prompts = []
+
+    async def complete(self, messages, max_tokens, json_mode):
+        assert json_mode
+        self.prompts.append(messages[-1]["content"])
+        return bot.Completion(self.texts.pop(0), prompt_tokens=100, completion_tokens=500, backend="stub")
+
+
+@pytest.fixture
+def json_mode(monkeypatch, make_store):
+    monkeypatch.setattr(bot, "OUTPUT_MODE", "json")
+    return make_store(bot.UsageLedger)
+
+
+def test_valid_report_is_parsed(report_json):
+    report = bot.parse_report_json("```json\n" + report_json() + "\n```", ideas_count=3)
+    assert [idea.title for idea in report.ideas] == ["Идея 1", "Идея 2", "Идея 3"]
+    assert report.monetization == ("Подписка", "Фримиум")
+
+
+@pytest.mark.parametrize("overrides, error", [
+    ({"risks": []}, "report.risks"),
+    ({"risks": ["  ", ""]}, "report.risks"),
+    ({"monetization": "Подписка"}, "report.monetization"),
+    ({"analysis": " "}, "report.analysis"),
+    ({"cost": {"mvp": "1 $"}}, "cost.full"),
+    ({"ideas": 0}, "report.ideas"),
+])
+def test_schema_violations_are_rejected(report_json, overrides, error):
+    with pytest.raises(ValueError, match=error):
+        bot.parse_report_json(report_json(**overrides))
+
+
+def test_blank_features_are_rejected(report_json):
+    data = json.loads(report_json())
+    data["ideas"][1]["features"] = [" "]
+    with pytest.raises(ValueError, match=r"ideas\[1\]\.features"):
+        bot.parse_report_json(json.dumps(data))
+
+
+def test_ideas_count_is_checked(report_json):
+    with pytest.raises(ValueError, match="ожидается идей — 5, получено — 3"):
+        bot.parse_report_json(report_json(), ideas_count=5)
+    assert len(bot.parse_report_json(report_json()).ideas) == 3
+
+
+def test_invalid_report_is_asked_again(json_mode, session, report_json):
+    router = ScriptedRouter(report_json(ideas=2), report_json(ideas=3))
+    completion = asyncio.run(bot.LLMClient(router, json_mode).generate_ideas(session, 1))
+    assert completion.text == report_json(ideas=3)
+    assert len(router.prompts) == 2
+    assert "Предыдущий ответ отклонён: report.ideas" in router.prompts[1]
+    # Токены обеих попыток — в результате (важно для учёта спекуляций)
+    assert (completion.prompt_tokens, completion.completion_tokens) == (200, 1000)
+
+
+def test_second_invalid_report_becomes_an_error(json_mode, session):
+    router = ScriptedRouter("Вот ваши идеи: ...", '{"ideas": []}', "не дойдёт")
+    completion = asyncio.run(bot.LLMClient(router, json_mode).generate_ideas(session, 1))
+    assert completion.text.startswith(bot.LLM_ERROR_PREFIX)
+    assert "не по схеме" in completion.text and "{\"ideas\"" not in completion.text
+    assert len(router.prompts) == 2 and completion.completion_tokens == 1000
+
+
+def test_report_is_rendered_by_templates(report_json):
+    parts = bot.render_llm_result(report_json(analysis="Рынок <b>растёт</b>, объём 1500000 $"))
+    text = "\n".join(parts)
+    assert "📊 <b>Краткий анализ ниши</b>" in text
+    assert "&lt;b&gt;растёт&lt;/b&gt;" in text and "1 500 000 $" in text
+    assert "💡 <b>Идея #3: Идея 3</b>" in text
+    assert all(len(part) <= bot.TELEGRAM_TEXT_LIMIT for part in parts)
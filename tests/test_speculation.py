@@ -0,0 +1,155 @@
+"""Спекулятивная генерация: учёт потраченных впустую токенов и отмена при уходе с шага подтверждения"""
+import asyncio
+from dataclasses import replace
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def speculation(stores, session, monkeypatch):
+    """Чистые счётчики спекуляций и лимиты; возвращает функцию запуска спекуляции для пользователя 1"""
+    monkeypatch.setattr(bot, "SPECULATIVE_GENERATION", True)
+    monkeypatch.setattr(bot, "speculation_stats", bot.SpeculationStats())
+    monkeypatch.setattr(bot, "speculations", {})
+    monkeypatch.setattr(bot, "user_sessions", {1: session})
+    monkeypatch.setattr(bot, "quota", bot.QuotaMiddleware(bot.TokenBuckets(100)))
+
+    async def start():
+        await bot.start_speculation(1, 10, 100, bot.replace(session))
+        return bot.speculations[1]
+
+    return start
+
+
+class FakeState:
+    def __init__(self, state):
+        self.state = state
+
+    async def get_state(self):
+        return self.state
+
+
+def wasted_tokens() -> int:
+    return bot.job_queue.counters().get("speculative_wasted_tokens", 0)
+
+
+def test_discarding_finished_speculation_counts_real_tokens(speculation):
+    async def scenario():
+        spec = await speculation()
+        job = bot.job_queue.claim("w1", 60)
+        assert job.job_id == spec.job_id
+        bot.job_queue.complete(job.job_id, "Идеи", ["Идеи"], 321)
+        await bot.discard_speculation(1)
+
+    asyncio.run(scenario())
+    assert wasted_tokens() == 321
+    assert bot.speculation_stats.wasted_generations == 1
+    assert bot.job_queue.count_speculative() == 0
+
+
+def test_speculation_discarded_mid_generation_is_counted_by_worker(speculation, monkeypatch):
+    purposes = []
+
+    async def generate_ideas(job_session, user_id=0, purpose="report"):
+        purposes.append(purpose)
+        # Пользователь ушёл в меню, пока модель ещё отвечала
+        await bot.discard_speculation(1)
+        return bot.Completion("Идеи", prompt_tokens=50, completion_tokens=700)
+
+    monkeypatch.setattr(bot.llm_client, "generate_ideas", generate_ideas)
+
+    async def scenario():
+        await speculation()
+        await bot.process_job("w1", bot.job_queue.claim("w1", 60))
+
+    asyncio.run(scenario())
+    assert purposes == ["speculative"]
+    assert wasted_tokens() == 700
+    assert bot.speculation_stats.wasted_generations == 1
+    assert bot.job_queue.ready_for_delivery() == []
+
+
+def test_speculation_aborted_by_watcher_is_not_a_user_cancel(speculation, monkeypatch):
+    monkeypatch.setattr(bot, "CANCEL_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(bot, "JOB_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(bot, "draining", False)
+
+    async def generate_ideas(job_session, user_id=0, purpose="report"):
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(bot.llm_client, "generate_ideas", generate_ideas)
+
+    async def scenario():
+        await speculation()
+        worker = asyncio.create_task(bot.llm_worker("w1"))
+        watcher = asyncio.create_task(bot.cancellation_watcher())
+        while not bot.generation_registry.for_user(1):
+            await asyncio.sleep(0.01)
+        # Пользователь ушёл в меню посреди вызова; оборвёт его сторож, как в другом процессе
+        await bot.discard_speculation(1)
+        while not bot.job_queue.counters().get("speculative_aborted"):
+            await asyncio.sleep(0.01)
+        worker.cancel()
+        watcher.cancel()
+
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+    counters = bot.job_queue.counters()
+    assert counters["speculative_aborted"] == 1
+    assert "cancel_aborted" not in counters and wasted_tokens() == 0
+    assert bot.speculation_stats.wasted_generations == 1
+
+
+def test_queued_speculation_wastes_nothing(speculation):
+    async def scenario():
+        await speculation()
+        await bot.discard_speculation(1)
+
+    asyncio.run(scenario())
+    assert wasted_tokens() == 0
+    assert bot.speculation_stats.discarded == 1 and bot.speculation_stats.wasted_generations == 0
+
+
+@pytest.mark.parametrize("state, changed, kept", [
+    (bot.IdeaGeneration.confirming.state, False, True),
+    # Главное меню, /start, настройки — FSM ушёл с шага подтверждения
+    (None, False, False),
+    (bot.IdeaGeneration.waiting_market.state, False, False),
+    # Шаг тот же, но параметры сессии уже другие
+    (bot.IdeaGeneration.confirming.state, True, False),
+])
+def test_middleware_discards_when_leaving_confirmation(speculation, state, changed, kept):
+    async def handler(event, data):
+        if changed:
+            bot.user_sessions[1] = replace(bot.user_sessions[1], budget="large")
+        return "handled"
+
+    async def scenario():
+        await speculation()
+        data = {"event_from_user": SimpleNamespace(id=1), "state": FakeState(state)}
+        return await bot.SpeculationMiddleware()(handler, SimpleNamespace(), data)
+
+    assert asyncio.run(scenario()) == "handled"
+    assert (1 in bot.speculations) is kept
+    assert bot.job_queue.count_speculative() == (1 if kept else 0)
+
+
+def test_speculation_takes_a_token_from_its_own_bucket(speculation, monkeypatch):
+    monkeypatch.setattr(bot, "RATE_LIMIT_SPECULATION", "1/600")
+    monkeypatch.setattr(bot, "RATE_LIMIT_GENERATION", "1/600")
+    monkeypatch.setattr(bot, "quota", bot.QuotaMiddleware(bot.TokenBuckets(100)))
+
+    async def scenario():
+        await speculation()
+        await bot.discard_speculation(1)
+        # Второй выбор рынка подряд — токена нет, вызов LLM не начинается
+        await bot.start_speculation(1, 10, 100, bot.user_sessions[1])
+
+    asyncio.run(scenario())
+    assert 1 not in bot.speculations and bot.job_queue.count_speculative() == 0
+    assert (bot.speculation_stats.started, bot.speculation_stats.rate_limited) == (1, 1)
+    assert bot.quota.rejected["speculation"] == 1
+    # Корзина генераций не тронута: подтверждение не упрётся в лимит из-за спекуляции
+    assert asyncio.run(bot.quota.acquire(1, "generation")) == 0
@@ -0,0 +1,68 @@
+"""Повторно доставленные апдейты не доходят до обработчиков"""
+import asyncio
+
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import AnswerCallbackQuery
+from aiogram.types import CallbackQuery, Update, User
+
+import bot
+
+USER = User(id=1, is_bot=False, first_name="Тест")
+
+
+def callback_update(update_id: int, callback_id: str = "cb1") -> Update:
+    return Update(
+        update_id=update_id,
+        callback_query=CallbackQuery(id=callback_id, from_user=USER, chat_instance="ci", data="confirm_generate"),
+    )
+
+
+def run_updates(middleware, updates, fake_bot) -> list[int]:
+    """Прогнать апдейты через middleware; вернуть update_id, дошедшие до обработчика"""
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.update_id)
+
+    async def scenario():
+        for update in updates:
+            await middleware(handler, update, {"bot": fake_bot})
+
+    asyncio.run(scenario())
+    return handled
+
+
+def test_duplicates_are_dropped(make_store, stores, fake_bot):
+    middleware = bot.DeduplicateUpdatesMiddleware(make_store(bot.ProcessedUpdates, 100))
+    handled = run_updates(middleware, [
+        callback_update(1, "cb1"),
+        callback_update(1, "cb1"),  # тот же апдейт после перезапуска
+        callback_update(2, "cb1"),  # повтор webhook: другой update_id, тот же callback
+        callback_update(3, "cb2"),
+    ], fake_bot)
+    assert handled == [1, 3]
+    assert bot.job_queue.counters()["duplicate_updates"] == 2
+
+
+def test_dropped_callback_is_answered(make_store, stores, fake_bot):
+    middleware = bot.DeduplicateUpdatesMiddleware(make_store(bot.ProcessedUpdates, 100))
+    run_updates(middleware, [callback_update(1), callback_update(1)], fake_bot)
+    assert fake_bot.sent("answer_callback_query") == [(("cb1",), {})]
+
+
+def test_answer_errors_are_suppressed(make_store, stores, fake_bot):
+    middleware = bot.DeduplicateUpdatesMiddleware(make_store(bot.ProcessedUpdates, 100))
+    fake_bot.fail(
+        "answer_callback_query", TelegramNetworkError(AnswerCallbackQuery(callback_query_id="cb1"), "timeout")
+    )
+    handled = run_updates(middleware, [callback_update(1), callback_update(1), callback_update(2, "cb2")], fake_bot)
+    assert handled == [1, 2]
+
+
+def test_processed_updates_are_bounded(make_store):
+    processed = make_store(bot.ProcessedUpdates, 10)
+    for update_id in range(300):
+        assert processed.add_all([f"update:{update_id}"])
+    (count,) = processed.conn.execute("SELECT COUNT(*) FROM processed_updates").fetchone()
+    assert count <= 10 + 100
+    assert not processed.add_all(["update:299"])
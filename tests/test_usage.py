@@ -0,0 +1,99 @@
+"""Учёт токенов: срезы, статусы вызовов и миграция старой таблицы"""
+import asyncio
+import sqlite3
+
+import pytest
+
+import bot
+
+TODAY = "0000-00-00"  # since_day: всё, что есть
+
+
+class ScriptedRouter:
+    """Вместо LLMRouter: отдаёт ответ, падает или висит, пока вызов не отменят"""
+
+    def __init__(self, outcome):
+        self.outcome = outcome
+
+    async def complete(self, messages, max_tokens, json_mode):
+        if self.outcome == "hang":
+            await asyncio.sleep(3600)
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return self.outcome
+
+
+def test_calls_are_summed_per_slice(make_store, session):
+    ledger = make_store(bot.UsageLedger)
+    ledger.record(1, "report", session, bot.Completion("a", 100, 400, latency=2.0))
+    ledger.record(1, "report", session, bot.Completion("b", 100, 600, latency=4.0))
+    ledger.record(2, "speculative", session, bot.Completion("c", 50, 300, latency=1.0))
+    ledger.flush()
+    ledger.record(1, "report", session, bot.Completion("d", 10, 10, latency=1.0))
+    ledger.flush()
+
+    assert ledger.totals(TODAY) == (4, 260, 1310)
+    assert ledger.totals(TODAY, "speculative") == (1, 50, 300)
+    (user, calls, tokens, latency), _ = ledger.top(("user_id",), TODAY)
+    assert (user, calls, tokens) == (1, 3, 1220)
+    assert latency == pytest.approx(7.0 / 3)
+
+
+def test_failed_and_cancelled_calls_are_recorded(make_store, session):
+    ledger = make_store(bot.UsageLedger)
+
+    async def scenario():
+        ok = await bot.LLMClient(ScriptedRouter(bot.Completion("Идеи", 10, 20)), ledger).generate_ideas(session, 1)
+        failed = await bot.LLMClient(ScriptedRouter(RuntimeError("all down")), ledger).generate_ideas(session, 1)
+        call = asyncio.create_task(bot.LLMClient(ScriptedRouter("hang"), ledger).generate_ideas(session, 1))
+        await asyncio.sleep(0.01)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+        return ok, failed
+
+    ok, failed = asyncio.run(scenario())
+    assert ok.text == "Идеи"
+    assert failed.text.startswith(bot.LLM_ERROR_PREFIX)
+    ledger.flush()
+    by_status = {status: (calls, tokens) for status, calls, tokens, _ in ledger.top(("status",), TODAY)}
+    assert by_status == {"ok": (1, 30), "error": (1, 0), "cancelled": (1, 0)}
+
+
+def test_busy_database_keeps_pending_calls(make_store, session):
+    ledger = make_store(bot.UsageLedger)
+    ledger.conn.execute("PRAGMA busy_timeout = 0")
+    ledger.record(1, "report", session, bot.Completion("a", 100, 400, latency=2.0))
+    # Другой процесс держит блокировку записи — BEGIN IMMEDIATE получает SQLITE_BUSY
+    path = ledger.conn.execute("PRAGMA database_list").fetchone()[2]
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError) as error:
+        ledger.flush()
+    assert error.value.sqlite_errorcode == sqlite3.SQLITE_BUSY
+    other.execute("ROLLBACK")
+    other.close()
+
+    ledger.flush()
+    assert ledger.totals(TODAY) == (1, 100, 400)
+
+
+def test_old_table_is_migrated_with_ok_status(tmp_path, make_store):
+    path = tmp_path / "usagetotals.db"
+    conn = sqlite3.connect(path)
+    conn.execute(
+        """CREATE TABLE usage (
+            day TEXT NOT NULL, user_id INTEGER NOT NULL, purpose TEXT NOT NULL, niche_key TEXT NOT NULL,
+            budget TEXT NOT NULL, market_key TEXT NOT NULL, ideas_count INTEGER NOT NULL,
+            report_format TEXT NOT NULL, calls INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL, latency REAL NOT NULL,
+            PRIMARY KEY (day, user_id, purpose, niche_key, budget, market_key, ideas_count, report_format)
+        )"""
+    )
+    conn.execute("INSERT INTO usage VALUES ('2024-01-01', 7, 'report', 'education', 'small', 'russia_cis', 3, "
+                 "'markdown', 2, 100, 200, 3.0)")
+    conn.commit()
+    conn.close()
+
+    ledger = make_store(bot.UsageLedger, name=path.name)
+    assert ledger.top(("user_id", "status"), TODAY) == [(7, "ok", 2, 300, 1.5)]